@@ -0,0 +1,49 @@
+"""Concurrency benchmark for the claim engine
+
+Fires N parallel gens at one service and checks that no account is handed
+out twice. Run with: python benchmarks/bench_claims.py [gens] [stock]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.claims import ClaimEngine
+from utils.stock_store import BACKENDS
+
+
+async def run(backend_name, gens, stock):
+    with tempfile.TemporaryDirectory() as directory:
+        backend = BACKENDS[backend_name](directory)
+        backend.add('netflix', [f'user{i}:pass{i}' for i in range(stock)])
+        engine = ClaimEngine(backend)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(engine.claim('netflix') for _ in range(gens)))
+        elapsed = time.perf_counter() - start
+
+        delivered = [r for r in results if r is not None]
+        duplicates = len(delivered) - len(set(delivered))
+        remaining = backend.count('netflix')
+        engine.close()
+        if hasattr(backend, 'close'):
+            backend.close()
+
+    print(f'{backend_name:>8}: {gens} gens in {elapsed * 1000:.1f} ms, '
+          f'delivered={len(delivered)} duplicates={duplicates} remaining={remaining}')
+    assert duplicates == 0, 'an account was delivered twice'
+    assert len(delivered) + remaining == stock, 'an account was lost'
+
+
+def main():
+    gens = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    stock = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    for backend_name in BACKENDS:
+        asyncio.run(run(backend_name, gens, stock))
+
+
+if __name__ == '__main__':
+    main()
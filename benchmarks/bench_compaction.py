@@ -0,0 +1,97 @@
+"""Compaction and snapshot cost for the indexed stock backend
+
+Fills one service, claims a share of it (tombstones), then compacts it while
+other threads keep claiming, reporting compaction time, bytes read and
+written, and claim latency during the rewrite. Ends with a gzip snapshot of
+what is left. Run with: python benchmarks/bench_compaction.py [lines] [claimed share]
+"""
+import gzip
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.stock_store import IndexedStockBackend
+
+
+def io_counters():
+    """(read_bytes, write_bytes) from /proc, counting page cache hits as reads too"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except OSError:
+        return 0, 0
+
+
+def claim_while(backend, stop, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        reserved = backend.reserve('netflix', 1)
+        backend.commit('netflix', [token for token, _ in reserved])
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.001)
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    share = float(sys.argv[2]) if len(sys.argv) > 2 else 0.6
+    with tempfile.TemporaryDirectory() as directory:
+        backend = IndexedStockBackend(directory)
+        started = time.perf_counter()
+        batch = 200_000
+        for first in range(0, lines, batch):
+            backend.add('netflix', (f'user{i}@example.com:password{i}' for i in range(first, min(first + batch, lines))))
+        print(f'filled {lines} lines in {time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        claimed = 0
+        target = int(lines * share)
+        while claimed < target:
+            claimed += len(backend.claim_many('netflix', min(100_000, target - claimed)))
+        print(f'tombstoned {claimed} lines in {time.perf_counter() - started:.1f}s')
+
+        size = lambda: sum(os.path.getsize(os.path.join(directory, f'netflix.{ext}')) for ext in ('dat', 'idx'))
+        before = size()
+        stop = threading.Event()
+        latencies = []
+        claimer = threading.Thread(target=claim_while, args=(backend, stop, latencies))
+        claimer.start()
+        time.sleep(0.2)
+        baseline = len(latencies)
+
+        read_before, written_before = io_counters()
+        started = time.perf_counter()
+        reclaimed = backend.compact('netflix', min_ratio=0.0, min_dead=1)
+        elapsed = time.perf_counter() - started
+        read_after, written_after = io_counters()
+        stop.set()
+        claimer.join()
+
+        during = latencies[baseline:]
+        print(f'compacted in {elapsed:.2f}s: {before / 1e6:.0f} MB -> {size() / 1e6:.0f} MB, '
+              f'reclaimed {reclaimed / 1e6:.0f} MB')
+        print(f'  read {(read_after - read_before) / 1e6:.0f} MB, wrote {(written_after - written_before) / 1e6:.0f} MB '
+              f'({(written_after - written_before) / max(elapsed, 1e-9) / 1e6:.0f} MB/s)')
+        if during:
+            during.sort()
+            print(f'  {len(during)} claims during compaction: p50 {statistics.median(during) * 1000:.2f} ms, '
+                  f'p99 {during[int(len(during) * 0.99)] * 1000:.2f} ms, max {during[-1] * 1000:.2f} ms')
+
+        started = time.perf_counter()
+        snapshot = os.path.join(directory, 'netflix.txt.gz')
+        with gzip.open(snapshot, 'wt', encoding='utf-8') as f:
+            for line in backend.iter_live('netflix'):
+                f.write(line + '\n')
+        print(f'snapshot of {backend.count("netflix")} lines in {time.perf_counter() - started:.1f}s, '
+              f'{os.path.getsize(snapshot) / 1e6:.0f} MB compressed')
+        backend.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Embed construction benchmark
+
+Builds the same replies with create_embed and with cached embed templates,
+and reports time and allocated memory blocks per reply for a near-static
+error reply and for a cmdlist page.
+Run with: python benchmarks/bench_embeds.py [replies]
+"""
+import importlib
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Cogs import the bot module as `main`
+sys.modules.setdefault('main', importlib.import_module('bot'))
+
+from main import bot
+
+PREFIX = '$'
+SERVICES = ['netflix', 'spotify', 'minecraft', 'disney', 'hulu']
+COMMANDS = [(f'command_{i} <arg>', f'Description of command {i}') for i in range(8)]
+
+
+def out_of_stock_legacy(i):
+    service = SERVICES[i % len(SERVICES)]
+    return bot.create_embed(
+        title=f"{bot.emoji['error']} Out of Stock",
+        description=f"No accounts available for **{service}**.\nTry again later or check other services with `{PREFIX}stock`.",
+        color=bot.colors['error']
+    )
+
+
+def out_of_stock_template(i):
+    service = SERVICES[i % len(SERVICES)]
+    return bot.embed_template(
+        title=f"{bot.emoji['error']} Out of Stock",
+        description=f"No accounts available for **{{service}}**.\nTry again later or check other services with `{PREFIX}stock`.",
+        color=bot.colors['error']
+    ).render(service=service)
+
+
+def cmdlist_legacy(i):
+    return bot.create_embed(
+        title=f"{bot.emoji['info']} Available Commands",
+        description="**General Commands**",
+        color=bot.colors['primary'],
+        fields=[(f"`{PREFIX}{cmd}`", desc, False) for cmd, desc in COMMANDS]
+    )
+
+
+CMDLIST_PAGE = bot.embed_template(
+    title=f"{bot.emoji['info']} Available Commands",
+    description="**General Commands**",
+    color=bot.colors['primary'],
+    fields=[(f"`{PREFIX}{cmd}`", desc, False) for cmd, desc in COMMANDS]
+)
+
+
+def cmdlist_template(i):
+    # The cog keeps its page templates, a reply only renders them
+    return CMDLIST_PAGE.render()
+
+
+def measure(build, replies):
+    build(0)
+    start = time.perf_counter()
+    for i in range(replies):
+        build(i)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [build(i) for i in range(1000)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del kept
+    return elapsed / replies * 1e6, blocks / 1000, size / 1000
+
+
+def main():
+    replies = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = {}
+    for name, legacy, template in (
+        ('out of stock', out_of_stock_legacy, out_of_stock_template),
+        ('cmdlist page', cmdlist_legacy, cmdlist_template),
+    ):
+        print(name)
+        for label, build in (('create_embed', legacy), ('template', template)):
+            us, blocks, size = measure(build, replies)
+            results[name, label] = us
+            print(f'  {label:<13} {us:7.2f} us/reply {blocks:6.1f} blocks/reply {size:8.0f} B/reply')
+
+    # Same payload either way, apart from the timestamp
+    for legacy, template in ((out_of_stock_legacy, out_of_stock_template), (cmdlist_legacy, cmdlist_template)):
+        a, b = legacy(3).to_dict(), template(3).to_dict()
+        a.pop('timestamp'), b.pop('timestamp')
+        assert a == b, (a, b)
+
+
+if __name__ == '__main__':
+    main()
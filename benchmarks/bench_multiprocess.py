@@ -0,0 +1,75 @@
+"""Multi-process claim stress test for the sqlite backend
+
+Starts several processes that each run their own claim engine against the
+same stock directory, like shards split across processes, and checks that
+no account is handed out twice and none is lost. Vouch updates from every
+process are checked the same way.
+Run with: python benchmarks/bench_multiprocess.py [processes] [gens per process] [stock]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.claims import ClaimEngine
+from utils.stock_store import SqliteStockBackend
+from utils.vouch_store import SqliteVouchStore
+
+
+def worker(directory, gens, results):
+    sys.path.insert(0, ROOT)
+
+    async def run():
+        backend = SqliteStockBackend(directory)
+        engine = ClaimEngine(backend)
+        claimed = await asyncio.gather(*(engine.claim('netflix') for _ in range(gens)))
+        engine.close()
+        backend.close()
+        return [c for c in claimed if c is not None]
+
+    vouches = SqliteVouchStore(os.path.join(directory, 'vouches.json')).load()
+    for _ in range(gens):
+        vouches.add(1)
+    results.put(asyncio.run(run()))
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    gens = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    stock = int(sys.argv[3]) if len(sys.argv) > 3 else 3000
+    with tempfile.TemporaryDirectory() as directory:
+        backend = SqliteStockBackend(directory)
+        backend.add('netflix', (f'user{i}:pass{i}' for i in range(stock)))
+        SqliteVouchStore(os.path.join(directory, 'vouches.json')).load()
+
+        results = multiprocessing.Queue()
+        start = time.perf_counter()
+        workers = [multiprocessing.Process(target=worker, args=(directory, gens, results)) for _ in range(processes)]
+        for p in workers:
+            p.start()
+        delivered = []
+        for _ in workers:
+            delivered.extend(results.get())
+        for p in workers:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        remaining = backend.count('netflix')
+        duplicates = len(delivered) - len(set(delivered))
+        vouches = SqliteVouchStore(os.path.join(directory, 'vouches.json')).load().get(1)
+        backend.close()
+
+    print(f'{processes} processes x {gens} gens in {elapsed:.2f}s: delivered={len(delivered)} '
+          f'duplicates={duplicates} remaining={remaining} vouches={vouches}/{processes * gens}')
+    assert duplicates == 0, 'an account was delivered twice'
+    assert len(delivered) + remaining == stock, 'an account was lost'
+    assert vouches == processes * gens, 'a vouch update was lost'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Rate limiter microbenchmark
+
+Times RateLimiter.hit() for a gen with user, role and service buckets
+across many distinct users. Run with: python benchmarks/bench_ratelimit.py [users]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.ratelimit import RateLimiter
+
+LIMITS = {
+    'gen': {
+        'user': [3, 3600],
+        'roles': {'42': [5, 3600]},
+        'services': {'netflix': [1, 86400]},
+    },
+}
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as directory:
+        limiter = RateLimiter(LIMITS, path=os.path.join(directory, 'state.json'))
+        ids = iter(range(10 ** 12))
+        roles = [7, 42, 99]
+
+        # Fresh users: every bucket is created
+        per_call = timeit.timeit(lambda: limiter.hit('gen', next(ids), roles, 'netflix'), number=users) / users
+        print(f'new user hit:      {per_call * 1e6:.2f} us')
+
+        # Repeat users: buckets exist, most calls are rejected
+        per_call = timeit.timeit(lambda: limiter.hit('gen', 5, roles, 'netflix'), number=users) / users
+        print(f'existing user hit: {per_call * 1e6:.2f} us')
+
+        # Commands with no limits configured
+        per_call = timeit.timeit(lambda: limiter.hit('cmdlist', 5, roles), number=users) / users
+        print(f'unlimited command: {per_call * 1e6:.2f} us')
+
+        per_call = timeit.timeit(limiter.snapshot, number=1)
+        print(f'snapshot of {users} users: {per_call * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Vouch listener throughput benchmark
+
+Replays a synthetic message stream through Vouches.on_message and through
+the previous name/lowercase/substring implementation, and reports how many
+messages per second each can process.
+Run with: python benchmarks/bench_vouch_listener.py [messages] [vouch ratio]
+"""
+import asyncio
+import importlib
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Cogs import the bot module as `main`
+sys.modules.setdefault('main', importlib.import_module('bot'))
+
+from cogs.vouches import Vouches
+from main import DEFAULT_CONFIG, BotConfig
+
+BOT_ID = 1000
+VOUCH_CHANNEL_ID = 42
+
+
+class FakeBot(BotConfig):
+    """The parts of the bot the Vouches cog touches"""
+
+    def __init__(self):
+        self.user = SimpleNamespace(id=BOT_ID)
+        self.guilds = []
+        self.handoff = {}
+        self.apply_config(DEFAULT_CONFIG)
+
+
+def make_stream(count, vouch_ratio):
+    rng = random.Random(1)
+    bot_user = SimpleNamespace(id=BOT_ID, bot=True)
+    human = SimpleNamespace(id=7, bot=False)
+    general = SimpleNamespace(id=1, name='general')
+    vouch = SimpleNamespace(id=VOUCH_CHANNEL_ID, name='bot-vouch')
+    texts = ['hello there everyone, how is it going today?' * 3, 'legit got my account thanks', 'lol']
+
+    async def reply(**kwargs):
+        pass
+
+    stream = []
+    for _ in range(count):
+        in_vouch = rng.random() < vouch_ratio
+        stream.append(SimpleNamespace(
+            channel=vouch if in_vouch else general,
+            author=human,
+            content=rng.choice(texts),
+            mentions=[bot_user] if in_vouch and rng.random() < 0.5 else [],
+            reply=reply,
+        ))
+    return stream
+
+
+async def legacy_on_message(cog, message):
+    """The listener as it was before channel IDs and the compiled matcher"""
+    if message.channel.name != 'bot-vouch':
+        return
+    if message.author.bot:
+        return
+    content = message.content.lower()
+    if 'legit' in content or 'vouch' in content or 'thanks' in content:
+        for mention in message.mentions:
+            if mention.bot and mention.id == cog.bot.user.id:
+                count = cog.store.add(message.author.id)
+                embed = cog.bot.create_embed(
+                    title=f"{cog.bot.emoji['vouch']} Vouch Recorded",
+                    description=f"Thanks for your vouch! You now have `{count}` vouches.",
+                    color=cog.bot.colors['success']
+                )
+                await message.reply(embed=embed)
+                break
+
+
+async def replay(handler, stream):
+    start = time.perf_counter()
+    for message in stream:
+        await handler(message)
+    return len(stream) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    vouch_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        cog = Vouches(FakeBot())
+        cog.vouch_channels = {1: {VOUCH_CHANNEL_ID}}
+        cog.vouch_channel_ids = frozenset({VOUCH_CHANNEL_ID})
+        stream = make_stream(count, vouch_ratio)
+
+        async def run():
+            # Interleave the runs and keep the best of each to cut noise
+            legacy = current = 0.0
+            for _ in range(3):
+                legacy = max(legacy, await replay(lambda m: legacy_on_message(cog, m), stream))
+                current = max(current, await replay(cog.on_message, stream))
+            await cog.store.close()
+            return legacy, current
+
+        legacy, current = asyncio.run(run())
+        os.chdir(ROOT)
+    print(f'{count} messages, {vouch_ratio:.1%} in the vouch channel')
+    print(f'legacy listener:  {legacy:12,.0f} msg/s')
+    print(f'current listener: {current:12,.0f} msg/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Vouch store memory and load time, JSON dict against the compact binary file
+
+Seeds data/vouches.json with N members, migrates it to the compact format,
+then loads each store in a fresh process and reports load time, resident
+memory added by the load and random lookup speed. The cog rows construct
+and load the Vouches cog the way the bot does, and report how long the
+event loop stalls and how long until the leaderboard is built.
+Run with: python benchmarks/bench_vouch_memory.py [members]
+"""
+import asyncio
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Cogs import the bot module as `main`
+sys.modules.setdefault('main', importlib.import_module('bot'))
+
+import cogs.vouches
+from main import DEFAULT_CONFIG, BotConfig
+from utils.vouch_store import CompactVouchStore, VouchStore
+
+STORES = {'json': VouchStore, 'compact': CompactVouchStore}
+
+
+def rss():
+    """Resident set size in bytes"""
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def seed(path, members):
+    rnd = random.Random(1)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for i in range(members):
+            user_id = 10 ** 17 + rnd.randrange(10 ** 17)
+            f.write(f'{"," if i else ""}"{user_id}":{rnd.randrange(1, 200)}')
+        f.write('}')
+
+
+def child(kind, path, lookups=200000):
+    before = rss()
+    started = time.perf_counter()
+    store = STORES[kind](path).load()
+    load = time.perf_counter() - started
+    loaded = rss() - before
+    # A full pass (what the leaderboard build does) pages in the whole mapping
+    started = time.perf_counter()
+    total = sum(count for _, count in store.items())
+    scan = time.perf_counter() - started
+    touched = rss() - before
+    ids = random.Random(2).sample([user_id for user_id, _ in store.items()], min(lookups, len(store)))
+    ids = [int(user_id) for user_id in ids]
+    started = time.perf_counter()
+    for user_id in ids:
+        store.get(user_id)
+    lookup = (time.perf_counter() - started) / max(len(ids), 1)
+    print(json.dumps({'load': load, 'rss': loaded, 'touched': touched, 'scan': scan, 'lookup': lookup,
+                      'users': len(store), 'total': total}))
+
+
+class FakeBot(BotConfig):
+    """The parts of the bot the Vouches cog touches while loading"""
+
+    def __init__(self):
+        self.guilds = []
+        self.handoff = {}
+        self.apply_config(DEFAULT_CONFIG)
+
+    def is_ready(self):
+        return False
+
+
+async def load_cog(kind, path):
+    """Construct and load the cog, timing the longest event loop stall until the leaderboard is ready"""
+    os.environ['VOUCH_BACKEND'] = kind
+    cogs.vouches.VOUCH_FILE = path
+    stalls = []
+
+    async def ticker():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - started - 0.001)
+
+    ticks = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    cog = cogs.vouches.Vouches(FakeBot())
+    await cog.cog_load()
+    loaded = time.perf_counter() - started
+    await cog.get_leaderboard()
+    ready = time.perf_counter() - started
+    ticks.cancel()
+    await cog.cog_unload()
+    return {'load': loaded, 'ready': ready, 'stall': max(stalls), 'users': len(cog.leaderboard)}
+
+
+def cog_child(kind, path):
+    before = rss()
+    stats = asyncio.run(load_cog(kind, path))
+    stats['rss'] = rss() - before
+    print(json.dumps(stats))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == '--cog-child':
+        cog_child(sys.argv[2], sys.argv[3])
+        return
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'vouches.json')
+        started = time.perf_counter()
+        seed(path, members)
+        print(f'seeded {members} members in {time.perf_counter() - started:.1f}s, '
+              f'{os.path.getsize(path) / 1e6:.0f} MB of JSON')
+
+        started = time.perf_counter()
+        CompactVouchStore(path).load()
+        binary = os.path.splitext(path)[0] + '.bin'
+        print(f'migrated in {time.perf_counter() - started:.1f}s, {os.path.getsize(binary) / 1e6:.0f} MB binary')
+
+        for kind in STORES:
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', kind, path],
+                capture_output=True, text=True, check=True
+            )
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f'{kind:>8}: load {stats["load"] * 1000:8.1f} ms, rss +{stats["rss"] / 1e6:7.1f} MB, '
+                  f'after a full scan +{stats["touched"] / 1e6:7.1f} MB ({stats["touched"] / stats["users"]:5.1f} B/user), '
+                  f'scan {stats["scan"]:.2f}s, get {stats["lookup"] * 1e6:.2f} us')
+
+        for kind in STORES:
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--cog-child', kind, path],
+                capture_output=True, text=True, check=True
+            )
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f'{kind + " cog":>12}: cog load {stats["load"] * 1000:8.1f} ms, leaderboard ready {stats["ready"]:.2f}s, '
+                  f'longest loop stall {stats["stall"] * 1000:6.1f} ms, rss +{stats["rss"] / 1e6:7.1f} MB '
+                  f'({stats["users"]} ranked)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Vouch persistence benchmark
+
+Measures the per-vouch cost of each VOUCH_DURABILITY mode against the old
+full json.dump(indent=4) per vouch, then simulates a crash (no close) and
+checks that reloading from snapshot plus journal loses nothing.
+Run with: python benchmarks/bench_vouches.py [members] [vouches]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.vouch_store import DURABILITY_MODES, VouchStore
+
+
+def seed(path, members):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({str(10 ** 17 + i): i % 50 for i in range(members)}, f)
+
+
+def bench_legacy(path, vouches):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    start = time.perf_counter()
+    for i in range(vouches):
+        user_id = str(10 ** 17 + i)
+        data[user_id] = data.get(user_id, 0) + 1
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+    return (time.perf_counter() - start) / vouches
+
+
+async def bench_mode(path, mode, vouches):
+    store = VouchStore(path, flush_interval=1.0, durability=mode).load()
+    expected = {str(10 ** 17 + i): store.get(10 ** 17 + i) + 1 for i in range(vouches)}
+    start = time.perf_counter()
+    for i in range(vouches):
+        store.add(10 ** 17 + i)
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    per_op = (time.perf_counter() - start) / vouches
+    # Crash: drop the store without close() or a final flush
+    if store._flush_handle is not None:
+        store._flush_handle.cancel()
+    if store._journal is not None:
+        store._journal.close()
+    reloaded = VouchStore(path, durability=mode).load()
+    lost = sum(1 for user_id, count in expected.items() if reloaded.get(user_id) != count)
+    return per_op, lost
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    vouches = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'vouches.json')
+        seed(path, members)
+        legacy = bench_legacy(path, max(1, vouches // 100))
+        print(f'  legacy: {legacy * 1e6:10.1f} us/vouch ({members} members)')
+        for mode in DURABILITY_MODES:
+            seed(path, members)
+            per_op, lost = asyncio.run(bench_mode(path, mode, vouches))
+            print(f'{mode:>8}: {per_op * 1e6:10.1f} us/vouch, lost after crash={lost}')
+            if mode != 'snapshot':
+                assert lost == 0, f'{mode} mode lost vouches after a crash'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+"""Offline load test against a local Discord stand-in
+
+Drives the real cog callbacks (Stock.gen, Stock.stock, Admin.stock_add,
+Admin.drop and Vouches.on_message) with fake contexts, members, messages
+and attachments. Sends and DMs go to a stub messaging layer with a
+configurable API latency, and attachments are downloaded from a local
+aiohttp server. Stock is generated into a temporary directory.
+
+Traffic is a trace of JSON lines, one event each:
+  {"at": 0.125, "command": "gen", "user": 42, "args": ["service3", 1]}
+  {"at": 0.130, "command": "vouch", "user": 42, "args": ["legit thanks", true, true]}
+`stock` takes no args, `stock_add` takes [service, lines] and `drop` takes
+[service, count]. Vouch args are [content, in vouch channel, mentions bot].
+Without --trace a synthetic trace is generated (--record saves it).
+
+By default events are replayed as fast as --concurrency allows. With
+--realtime they are started at their `at` offsets (divided by --speed) and
+latency counts from the scheduled start, so queueing shows up in p99.
+
+Run with: python benchmarks/loadtest.py [--services 20] [--lines 50000]
+          [--events 5000] [--backend indexed] [--trace file] [--realtime]
+"""
+import argparse
+import asyncio
+import collections
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT_ID = 1000
+GUILD_ID = 1
+VOUCH_CHANNEL_ID = 42
+GENERAL_CHANNEL_ID = 43
+DEFAULT_MIX = 'gen=60,vouch=25,stock=8,drop=5,stock_add=2'
+
+
+class FakeMessage:
+    """A sent message, enough for paginators and replies"""
+
+    def __init__(self, api, embed=None, content=None):
+        self.api = api
+        self.embed = embed
+        self.content = content
+
+    async def edit(self, **kwargs):
+        await self.api.call('edit')
+        self.embed = kwargs.get('embed', self.embed)
+        return self
+
+    async def delete(self):
+        await self.api.call('delete')
+
+
+class StubAPI:
+    """Stands in for Discord's REST API, every call waits `latency` seconds"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    async def call(self, kind):
+        self.calls[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+
+class FakeUser:
+    def __init__(self, api, user_id, roles=()):
+        self.api = api
+        self.id = user_id
+        self.bot = False
+        self.name = self.display_name = f'user{user_id}'
+        self.mention = f'<@{user_id}>'
+        self.roles = list(roles)
+        self.dms = []
+
+    async def send(self, content=None, embed=None, file=None):
+        await self.api.call('dm')
+        self.dms.append(embed)
+        return FakeMessage(self.api, embed, content)
+
+
+class FakeAttachment:
+    def __init__(self, url, filename):
+        self.url = url
+        self.filename = filename
+
+
+class FakeContext:
+    """Command context whose `finished` future resolves on the last reply of a command"""
+
+    def __init__(self, api, author, command, kwargs=None, attachments=()):
+        self.api = api
+        self.author = author
+        self.prefix = '$'
+        self.guild = SimpleNamespace(id=GUILD_ID)
+        self.channel = SimpleNamespace(id=GENERAL_CHANNEL_ID)
+        self.command = SimpleNamespace(name=command, qualified_name=command, clean_params={})
+        self.cog = None
+        self.args = []
+        self.kwargs = kwargs or {}
+        self.message = SimpleNamespace(attachments=list(attachments), author=author)
+        self.finished = asyncio.get_running_loop().create_future()
+        self.replies = []
+
+    async def send(self, content=None, embed=None, file=None, view=None):
+        await self.api.call('send')
+        self.replies.append(embed)
+        # A queued gen gets a second, final reply once a worker delivers it
+        if not self.finished.done() and not (embed is not None and embed.title and embed.title.endswith('Gen Queued')):
+            self.finished.set_result(embed.title if embed is not None else None)
+        return FakeMessage(self.api, embed, content)
+
+
+class FakeBot:
+    """The parts of the bot the cogs touch"""
+
+    command_version = 0
+
+    def __init__(self, guilds):
+        self.user = SimpleNamespace(id=BOT_ID, bot=True)
+        self.guilds = guilds
+        self.handoff = {}
+
+    def is_ready(self):
+        return True
+
+    def dispatch(self, event, *args):
+        # No listeners here, stock alerts are not part of the replay
+        pass
+
+
+def outcome(title):
+    """Strip the custom emoji from an embed title"""
+    if not title:
+        return 'no reply'
+    return title.split('> ', 1)[-1]
+
+
+def generate_stock(backend, services, lines):
+    for s in range(services):
+        name = f'service{s}'
+        backend.create(name)
+        batch = []
+        for i in range(lines):
+            batch.append(f'{name}_user{i}:pass{i}')
+            if len(batch) >= 100000:
+                backend.add(name, batch)
+                batch = []
+        if batch:
+            backend.add(name, batch)
+
+
+def synthetic_trace(events, services, users, mix, rate, seed=1):
+    rng = random.Random(seed)
+    names, weights = zip(*mix.items())
+    trace = []
+    at = 0.0
+    for _ in range(events):
+        at += rng.expovariate(rate)
+        command = rng.choices(names, weights)[0]
+        user = rng.randrange(users) + 10000
+        service = f'service{rng.randrange(services)}'
+        if command == 'gen':
+            args = [service, 1]
+        elif command == 'stock':
+            args = []
+        elif command == 'drop':
+            args = [service, rng.choice((1, 5, 25))]
+        elif command == 'stock_add':
+            args = [service, rng.choice((100, 1000, 10000))]
+        else:
+            in_channel = rng.random() < 0.5
+            args = [rng.choice(('legit thanks!', 'hello everyone', 'vouch, fast delivery')), in_channel,
+                    in_channel and rng.random() < 0.7]
+        trace.append({'at': round(at, 6), 'command': command, 'user': user, 'args': args})
+    return trace
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Harness:
+    def __init__(self, cogs, api, base_url, uploads):
+        self.stock_cog, self.admin_cog, self.vouch_cog = cogs
+        self.api = api
+        self.base_url = base_url
+        self.uploads = uploads
+        self.users = {}
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+        self.vouch_channel = SimpleNamespace(id=VOUCH_CHANNEL_ID, name='bot-vouch')
+        self.general_channel = SimpleNamespace(id=GENERAL_CHANNEL_ID, name='general')
+
+    def user(self, user_id):
+        member = self.users.get(user_id)
+        if member is None:
+            member = self.users[user_id] = FakeUser(self.api, user_id)
+        return member
+
+    async def run_event(self, event, started=None):
+        """Run one trace event to completion and record its latency"""
+        from utils.ratelimit import QuotaExceeded, get_rate_limiter
+
+        command = event['command']
+        args = event['args']
+        author = self.user(event['user'])
+        started = time.perf_counter() if started is None else started
+
+        if command == 'vouch':
+            content, in_channel, mentions_bot = args
+
+            async def reply(**kwargs):
+                await self.api.call('send')
+
+            message = SimpleNamespace(
+                channel=self.vouch_channel if in_channel else self.general_channel,
+                author=author,
+                content=content,
+                mentions=[SimpleNamespace(id=BOT_ID, bot=True)] if mentions_bot else [],
+                reply=reply
+            )
+            await self.vouch_cog.on_message(message)
+            self.outcomes[command]['handled'] += 1
+            self.latencies[command].append(time.perf_counter() - started)
+            return
+
+        # Parsed the way a slash invocation fills ctx.kwargs
+        kwargs = dict(zip(('service', 'amount') if command == 'gen' else ('service',), args))
+        attachments = ()
+        if command == 'stock_add':
+            name = f'upload{len(self.uploads)}.txt'
+            self.uploads[name] = ''.join(
+                f'{args[0]}_new{random.getrandbits(48):x}:pass\n' for _ in range(args[1])
+            ).encode('utf-8')
+            attachments = [FakeAttachment(f'{self.base_url}/attachments/{name}', name)]
+        ctx = FakeContext(self.api, author, command, kwargs, attachments)
+
+        try:
+            if command in ('gen', 'stock'):
+                await get_rate_limiter().enforce(ctx)
+            if command == 'gen':
+                await self.stock_cog.gen.callback(self.stock_cog, ctx, *args)
+            elif command == 'stock':
+                await self.stock_cog.stock.callback(self.stock_cog, ctx)
+            elif command == 'stock_add':
+                await self.admin_cog.stock_add.callback(self.admin_cog, ctx, args[0])
+            elif command == 'drop':
+                await self.admin_cog.drop.callback(self.admin_cog, ctx, *args)
+            else:
+                raise ValueError(f'Unknown command in trace: {command}')
+            # Gens finish on dispatcher workers, wait for the final reply
+            title = await ctx.finished
+        except QuotaExceeded:
+            title = 'Rate Limited'
+        self.outcomes[command][outcome(title)] += 1
+        self.latencies[command].append(time.perf_counter() - started)
+
+
+async def replay(harness, trace, concurrency, realtime, speed):
+    if realtime:
+        loop = asyncio.get_running_loop()
+        origin = loop.time()
+        wall = time.perf_counter()
+        tasks = []
+        for event in trace:
+            delay = origin + event['at'] / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(harness.run_event(event, wall + event['at'] / speed)))
+        await asyncio.gather(*tasks)
+        return
+
+    events = iter(trace)
+
+    async def worker():
+        for event in events:
+            await harness.run_event(event)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def serve_uploads(uploads):
+    from aiohttp import web
+
+    async def handle(request):
+        body = uploads.get(request.match_info['name'])
+        if body is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=body, content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/attachments/{name}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+async def run(args, trace):
+    # Imported here, after chdir, so every store lands in the temp directory
+    sys.modules.setdefault('main', importlib.import_module('bot'))
+    from main import DEFAULT_CONFIG, BotConfig
+    from cogs.admin import Admin
+    from cogs.stock import Stock
+    from cogs.vouches import Vouches
+    from utils.claims import get_claim_engine
+    from utils.gen_log import get_log_sink
+    from utils.history import get_history
+    from utils.ratelimit import get_rate_limiter
+    from utils.stock_store import get_registry
+
+    if not args.rate_limits:
+        get_rate_limiter().limits = {}
+
+    api = StubAPI(args.api_latency / 1000)
+    uploads = {}
+    runner, base_url = await serve_uploads(uploads)
+
+    guild = SimpleNamespace(id=GUILD_ID, text_channels=[
+        SimpleNamespace(id=VOUCH_CHANNEL_ID, name='bot-vouch'),
+        SimpleNamespace(id=GENERAL_CHANNEL_ID, name='general'),
+    ])
+    # Settings and embed helpers come from the real bot class
+    bot = type('LoadTestBot', (FakeBot, BotConfig), {})([guild])
+    bot.apply_config(DEFAULT_CONFIG)
+    stock_cog, admin_cog, vouch_cog = Stock(bot), Admin(bot), Vouches(bot)
+    await stock_cog.cog_load()
+    await vouch_cog.cog_load()
+    harness = Harness((stock_cog, admin_cog, vouch_cog), api, base_url, uploads)
+
+    started = time.perf_counter()
+    await replay(harness, trace, args.concurrency, args.realtime, args.speed)
+    elapsed = time.perf_counter() - started
+
+    await stock_cog.cog_unload()
+    await vouch_cog.cog_unload()
+    await get_history().close()
+    await get_log_sink().close()
+    await runner.cleanup()
+    get_claim_engine().close()
+
+    delivered = [embed for user in harness.users.values() for embed in user.dms]
+    accounts = []
+    for embed in delivered:
+        if embed.fields:
+            for field in embed.fields:
+                accounts.extend(line.strip('`') for line in field.value.split('\n'))
+        else:
+            # A single account is sent in a code block in the description
+            accounts.append(embed.description.split('```')[1])
+    assert len(accounts) == len(set(accounts)), 'an account was delivered twice'
+    return harness, elapsed, api, len(accounts), get_registry().backend(GUILD_ID).counts()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for the gen bot cogs')
+    parser.add_argument('--services', type=int, default=20)
+    parser.add_argument('--lines', type=int, default=50000, help='accounts per service')
+    parser.add_argument('--backend', default='indexed', choices=('indexed', 'sqlite', 'text'))
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='command=weight pairs')
+    parser.add_argument('--rate', type=float, default=500.0, help='synthetic events per second')
+    parser.add_argument('--trace', help='replay this JSON lines trace instead of a synthetic one')
+    parser.add_argument('--record', help='save the synthetic trace here')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--realtime', action='store_true', help='start events at their trace offsets')
+    parser.add_argument('--speed', type=float, default=1.0, help='realtime replay speed multiplier')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='stub Discord API latency in ms')
+    parser.add_argument('--rate-limits', action='store_true', help='enforce the configured rate limits')
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace, 'r', encoding='utf-8') as f:
+            trace = [json.loads(line) for line in f if line.strip()]
+    else:
+        mix = {name: float(weight) for name, weight in (pair.split('=') for pair in args.mix.split(','))}
+        trace = synthetic_trace(args.events, args.services, args.users, mix, args.rate)
+        if args.record:
+            with open(args.record, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(event) + '\n' for event in trace)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.environ['STOCK_BACKEND'] = args.backend
+        os.environ['STOCK_DIR'] = os.path.join(directory, 'stock')
+        os.environ['GEN_WORKERS'] = os.environ.get('GEN_WORKERS', '8')
+        os.environ['GEN_QUEUE_SIZE'] = os.environ.get('GEN_QUEUE_SIZE', str(len(trace) + 1))
+        from utils.stock_store import get_registry
+
+        phase = time.perf_counter()
+        generate_stock(get_registry().backend(GUILD_ID), args.services, args.lines)
+        print(f'Generated {args.services} services x {args.lines} accounts ({args.backend}) '
+              f'in {time.perf_counter() - phase:.2f}s')
+
+        harness, elapsed, api, delivered, counts = asyncio.run(run(args, trace))
+        os.chdir(ROOT)
+
+    print(f'{len(trace)} events in {elapsed:.2f}s ({len(trace) / elapsed:,.0f} events/s), '
+          f'{delivered} accounts delivered, {sum(counts.values())} left')
+    print(f'stub API calls: {dict(api.calls)}')
+    print(f'{"command":<10} {"count":>7} {"per sec":>9} {"p50 ms":>9} {"p99 ms":>9}  outcomes')
+    for command in sorted(harness.latencies):
+        values = sorted(harness.latencies[command])
+        outcomes = ', '.join(f'{name}: {n}' for name, n in harness.outcomes[command].most_common())
+        print(f'{command:<10} {len(values):>7} {len(values) / elapsed:>9,.0f} '
+              f'{percentile(values, 0.5) * 1000:>9.2f} {percentile(values, 0.99) * 1000:>9.2f}  {outcomes}')
+
+
+if __name__ == '__main__':
+    main()
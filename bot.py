@@ -4,26 +4,39 @@ from discord.ext import commands
 from dotenv import load_dotenv
 import asyncio
 import datetime
+import hashlib
+import json
+import math
+import time
+from utils.config import ConfigError, load_config
+from utils.gen_log import get_log_sink
+from utils.history import get_history
+from utils.maintenance import get_maintenance
+from utils.metrics import get_metrics, instrument_http
+from utils.ratelimit import QuotaExceeded, get_rate_limiter
+from utils.stock_store import get_registry
+
+STARTED_AT = time.perf_counter()
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
-ADMIN_ROLE = os.getenv('ADMIN_ROLE', 'Admin')
 BOT_PREFIX = os.getenv('BOT_PREFIX', '$')
-WATERMARK = os.getenv('WATERMARK', 'Powered by Semicloud Gen')
+
+# Sharding: leave unset to let Discord pick, set SHARD_IDS to split shards across processes
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(i) for i in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+if SHARD_IDS and SHARD_COUNT is None:
+    raise SystemExit('SHARD_IDS requires SHARD_COUNT')
 
 # Define bot intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-# Create bot instance
-bot = commands.Bot(
-    command_prefix=BOT_PREFIX,
-    intents=intents,
-    help_command=None,
-    case_insensitive=True
-)
+COMMAND_HASH_FILE = 'data/command_tree.hash'
+METRICS_FILE = os.getenv('METRICS_FILE', 'data/metrics.prom')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
 
 # Custom emoji IDs (replace with your server's emoji IDs)
 EMOJI = {
@@ -46,6 +59,170 @@ COLORS = {
     'info': 0xEB459E      # Pink
 }
 
+# Built-in values, data/config.json and the environment are layered on top
+DEFAULT_CONFIG = {
+    'ADMIN_ROLE': 'Admin',
+    'WATERMARK': 'Powered by Semicloud Gen',
+    'EMOJI': dict(EMOJI),
+    'COLORS': dict(COLORS)
+}
+
+EMBED_TEMPLATE_LIMIT = 512
+
+class EmbedTemplate:
+    """Embed with its static parts built once, copied and filled in per reply"""
+    
+    def __init__(self, base, title=None, description=None):
+        self.title = title
+        self.description = description
+        self.base = base
+        self.slots = [slot for slot in discord.Embed.__slots__ if hasattr(self.base, slot)]
+    
+    def render(self, **values):
+        """Copy the prebuilt embed, formatting `{placeholders}` in the title and description"""
+        embed = discord.Embed.__new__(discord.Embed)
+        base = self.base
+        for slot in self.slots:
+            setattr(embed, slot, getattr(base, slot))
+        if '_fields' in self.slots:
+            # add_field appends to this list, the field dicts and everything else are shared
+            embed._fields = base._fields.copy()
+        if values:
+            if self.title:
+                embed.title = self.title.format(**values)
+            if self.description:
+                embed.description = self.description.format(**values)
+        embed._timestamp = datetime.datetime.now(datetime.timezone.utc)
+        return embed
+
+class BotConfig:
+    """Reloadable settings and the embeds built from them, held by the bot instance
+    
+    Cogs read them through the bot they were given rather than through module
+    globals, so every module that imported the bot file sees the same values.
+    """
+    
+    def apply_config(self, config):
+        """Swap in a validated config in one synchronous step, so no command sees half of it"""
+        self.admin_role = config['ADMIN_ROLE']
+        self.watermark = config['WATERMARK']
+        self.emoji = config['EMOJI']
+        self.colors = config['COLORS']
+        # Cached embeds carry the old emoji, colors and footer
+        self.embed_templates = {}
+    
+    def create_embed(self, title=None, description=None, color=None, fields=None, footer=True, thumbnail=None):
+        """Helper function to create consistent embeds"""
+        embed = discord.Embed(
+            title=title,
+            description=description,
+            color=color or self.colors['primary'],
+            timestamp=datetime.datetime.now()
+        )
+        
+        if fields:
+            for name, value, inline in fields:
+                embed.add_field(name=name, value=value, inline=inline)
+        
+        if footer:
+            embed.set_footer(text=self.watermark)
+        
+        if thumbnail:
+            embed.set_thumbnail(url=thumbnail)
+        
+        return embed
+    
+    def embed_template(self, title=None, description=None, color=None, fields=None, footer=True, thumbnail=None):
+        """Cached EmbedTemplate for a message type, built on first use"""
+        # Keyed by every static part, so prefix or guild specific text gets its own entry
+        key = (title, description, color, tuple(fields) if fields else None, footer, thumbnail)
+        templates = self.embed_templates
+        template = templates.get(key)
+        if template is None:
+            if len(templates) >= EMBED_TEMPLATE_LIMIT:
+                templates.pop(next(iter(templates)))
+            base = self.create_embed(
+                title=title, description=description, color=color,
+                fields=fields, footer=footer, thumbnail=thumbnail
+            )
+            template = templates[key] = EmbedTemplate(base, title, description)
+        return template
+
+class GenBot(BotConfig, commands.AutoShardedBot):
+    # Bumped whenever a command is added or removed, cached command listings key on it
+    command_version = 0
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Cog state parked by reload_cog() for the next instance to pick up, keyed by cog name
+        self.handoff = {}
+    
+    def add_command(self, command):
+        super().add_command(command)
+        self.command_version += 1
+    
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        if command is not None:
+            self.command_version += 1
+        return command
+    
+    async def setup_hook(self):
+        """One-time startup, runs before the gateway connects and never again on reconnect"""
+        phase = time.perf_counter()
+        
+        # Loop lag probe, REST call timings and the Prometheus exposition
+        instrument_http(self.http, get_metrics())
+        await get_metrics().start(
+            path=METRICS_FILE,
+            export_interval=float(os.getenv('METRICS_INTERVAL', '15')),
+            port=METRICS_PORT
+        )
+        
+        # Fill the stock count tables of every namespace once, off the event loop
+        loaded = await asyncio.to_thread(lambda: get_registry().warm())
+        print(f'Loaded stock counts for {loaded} services in {time.perf_counter() - phase:.2f}s')
+        get_rate_limiter().start()
+        # Tombstone compaction and periodic snapshots, in the background from here on
+        get_maintenance().start()
+        
+        # First run only: move the old free-text gen logs into the history database
+        imported = await asyncio.to_thread(lambda: get_history().import_text_logs())
+        if imported:
+            print(f'Imported {imported} gens from text logs into history')
+        
+        phase = time.perf_counter()
+        await load_cogs(self)
+        print(f'Loaded cogs in {time.perf_counter() - phase:.2f}s')
+        
+        phase = time.perf_counter()
+        await sync_commands(self)
+        print(f'Command sync phase took {time.perf_counter() - phase:.2f}s')
+    
+    async def close(self):
+        # Flush queued generation logs and quota state before the loop goes away
+        await get_log_sink().close()
+        await get_history().close()
+        await get_maintenance().stop()
+        await get_rate_limiter().stop()
+        await get_metrics().stop()
+        await super().close()
+
+# Create bot instance
+bot = GenBot(
+    command_prefix=BOT_PREFIX,
+    intents=intents,
+    help_command=None,
+    case_insensitive=True,
+    shard_count=SHARD_COUNT,
+    shard_ids=SHARD_IDS
+)
+
+try:
+    bot.apply_config(load_config(DEFAULT_CONFIG))
+except ConfigError as e:
+    raise SystemExit(f'Invalid configuration: {e}')
+
 # Ensure required directories exist
 os.makedirs('stock', exist_ok=True)
 os.makedirs('images', exist_ok=True)
@@ -54,125 +231,192 @@ os.makedirs('logs', exist_ok=True)
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user.name} ({bot.user.id})')
+    print(f'Shards: {sorted(bot.shards)} of {bot.shard_count}')
     print('------')
     
-    # Load cogs
-    await load_cogs()
+    # Other processes run the remaining shards against the same files
+    if SHARD_IDS and len(SHARD_IDS) < SHARD_COUNT:
+        if os.getenv('STOCK_BACKEND', 'indexed').lower() != 'sqlite' or os.getenv('VOUCH_BACKEND', 'json').lower() != 'sqlite':
+            print('WARNING: running a subset of shards without STOCK_BACKEND=sqlite and VOUCH_BACKEND=sqlite, '
+                  'processes will overwrite each other\'s stock and vouches')
+    
+    # on_ready fires again after reconnects, setup_hook has already done the heavy lifting
+    print(f'Ready {time.perf_counter() - STARTED_AT:.2f}s after start')
+
+async def load_cogs(bot):
+    """Load all cogs from the cogs directory concurrently"""
+    names = [
+        filename[:-3] for filename in os.listdir('./cogs')
+        if filename.endswith('.py') and f'cogs.{filename[:-3]}' not in bot.extensions
+    ]
+    results = await asyncio.gather(
+        *(bot.load_extension(f'cogs.{name}') for name in names),
+        return_exceptions=True
+    )
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            print(f'Failed to load cog {name}: {result}')
+        else:
+            print(f'Loaded cog: {name}')
+
+async def reload_cog(bot, name):
+    """Reload one extension in place, handing its cogs' cached state to the new instances"""
+    extension = f'cogs.{name}'
+    if extension not in bot.extensions:
+        raise commands.ExtensionNotLoaded(extension)
+    for cog in list(bot.cogs.values()):
+        if cog.__module__ == extension and hasattr(cog, 'export_state'):
+            bot.handoff[cog.qualified_name] = cog.export_state()
+    try:
+        # On failure discord.py restores the old module, whose setup adopts the state instead
+        await bot.reload_extension(extension)
+    finally:
+        for state in bot.handoff.values():
+            print(f'Reload left cog state unclaimed: {sorted(state)}')
+        bot.handoff.clear()
+
+async def reload_config(bot):
+    """Re-read and validate the config, swap it in and reload every cog onto it"""
+    bot.apply_config(load_config(DEFAULT_CONFIG))
+    # Cogs keep pages and templates rendered with the old values, reloading drops them
+    names = sorted(extension[len('cogs.'):] for extension in bot.extensions if extension.startswith('cogs.'))
+    for name in names:
+        await reload_cog(bot, name)
+    return names
+
+def command_tree_hash(bot):
+    """Hash of the slash command payloads we would send to Discord"""
+    payload = []
+    for command in bot.tree.get_commands():
+        try:
+            payload.append(command.to_dict(bot.tree))
+        except TypeError:
+            # discord.py < 2.4 takes no tree argument
+            payload.append(command.to_dict())
+    payload.sort(key=lambda c: c['name'])
+    data = json.dumps([bot.application_id, payload], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+async def sync_commands(bot):
+    """Sync slash commands, but only when the command tree changed since the last sync"""
+    digest = command_tree_hash(bot)
+    if os.getenv('FORCE_SYNC', 'false').lower() != 'true' and os.path.exists(COMMAND_HASH_FILE):
+        with open(COMMAND_HASH_FILE, 'r', encoding='utf-8') as f:
+            if f.read().strip() == digest:
+                print('Slash commands unchanged, skipping sync')
+                return
     
-    # Sync slash commands
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} slash commands")
     except Exception as e:
         print(f"Error syncing slash commands: {e}")
+        return
+    
+    os.makedirs(os.path.dirname(COMMAND_HASH_FILE), exist_ok=True)
+    with open(COMMAND_HASH_FILE, 'w', encoding='utf-8') as f:
+        f.write(digest)
+
+@bot.event
+async def on_command(ctx):
+    ctx.metrics_started = time.perf_counter()
 
-async def load_cogs():
-    """Load all cogs from the cogs directory"""
-    for filename in os.listdir('./cogs'):
-        if filename.endswith('.py'):
-            try:
-                await bot.load_extension(f'cogs.{filename[:-3]}')
-                print(f'Loaded cog: {filename[:-3]}')
-            except Exception as e:
-                print(f'Failed to load cog {filename}: {e}')
+def record_command(ctx, status):
+    """Record a finished command's latency"""
+    started = getattr(ctx, 'metrics_started', None)
+    if started is not None and ctx.command is not None:
+        get_metrics().observe('command_seconds', time.perf_counter() - started, command=ctx.command.qualified_name, status=status)
+
+@bot.event
+async def on_command_completion(ctx):
+    record_command(ctx, 'ok')
 
 @bot.event
 async def on_command_error(ctx, error):
     """Global error handler"""
+    bot = ctx.bot
+    command = ctx.command.qualified_name if ctx.command else 'unknown'
+    get_metrics().inc('command_errors_total', command=command, error=type(error).__name__)
+    record_command(ctx, 'error')
+    
     if isinstance(error, commands.CommandNotFound):
         return
     elif isinstance(error, commands.MissingRequiredArgument):
-        embed = create_embed(
-            title=f"{EMOJI['error']} Missing Argument",
+        embed = bot.embed_template(
+            title=f"{bot.emoji['error']} Missing Argument",
             description=f"Please provide all required arguments.\n\n**Usage:**\n`{ctx.prefix}{ctx.command.name} {ctx.command.signature}`",
-            color=COLORS['error']
-        )
+            color=bot.colors['error']
+        ).render()
+        await ctx.send(embed=embed)
+    elif isinstance(error, QuotaExceeded) and math.isinf(error.retry_after):
+        embed = bot.embed_template(
+            title=f"{bot.emoji['warning']} Slow Down",
+            description=f"That's more than the {error.scope} limit for `{ctx.command.name}` allows at once.\nTry a smaller amount.",
+            color=bot.colors['warning']
+        ).render()
+        await ctx.send(embed=embed)
+    elif isinstance(error, QuotaExceeded):
+        minutes, seconds = divmod(int(error.retry_after) + 1, 60)
+        wait = f"{minutes}m {seconds}s" if minutes else f"{seconds}s"
+        embed = bot.embed_template(
+            title=f"{bot.emoji['warning']} Slow Down",
+            description=f"You've hit the {error.scope} limit for `{ctx.command.name}`.\nTry again in `{{wait}}`.",
+            color=bot.colors['warning']
+        ).render(wait=wait)
         await ctx.send(embed=embed)
     elif isinstance(error, commands.MissingPermissions):
-        embed = create_embed(
-            title=f"{EMOJI['error']} Missing Permissions",
+        embed = bot.embed_template(
+            title=f"{bot.emoji['error']} Missing Permissions",
             description="You don't have permission to use this command.",
-            color=COLORS['error']
-        )
+            color=bot.colors['error']
+        ).render()
         await ctx.send(embed=embed)
     elif isinstance(error, commands.CheckFailure):
-        embed = create_embed(
-            title=f"{EMOJI['error']} Access Denied",
+        embed = bot.embed_template(
+            title=f"{bot.emoji['error']} Access Denied",
             description="You don't have the required role to use this command.",
-            color=COLORS['error']
-        )
+            color=bot.colors['error']
+        ).render()
         await ctx.send(embed=embed)
     else:
-        embed = create_embed(
-            title=f"{EMOJI['error']} Error Occurred",
+        embed = bot.create_embed(
+            title=f"{bot.emoji['error']} Error Occurred",
             description=f"An unexpected error occurred: ```{str(error)}```",
-            color=COLORS['error']
+            color=bot.colors['error']
         )
         await ctx.send(embed=embed)
         raise error
 
-def create_embed(title=None, description=None, color=None, fields=None, footer=True, thumbnail=None):
-    """Helper function to create consistent embeds"""
-    embed = discord.Embed(
-        title=title,
-        description=description,
-        color=color or COLORS['primary'],
-        timestamp=datetime.datetime.now()
-    )
-    
-    if fields:
-        for name, value, inline in fields:
-            embed.add_field(name=name, value=value, inline=inline)
-    
-    if footer:
-        embed.set_footer(text=WATERMARK)
-    
-    if thumbnail:
-        embed.set_thumbnail(url=thumbnail)
-    
-    return embed
+def chunk_field_values(lines, limit=1024, max_fields=25, max_total=5500):
+    """Pack lines into embed field values, or return None if they can't fit in one embed"""
+    values = []
+    current = ''
+    for line in lines:
+        if len(line) > limit:
+            return None
+        if current and len(current) + 1 + len(line) > limit:
+            values.append(current)
+            current = line
+        else:
+            current = f'{current}\n{line}' if current else line
+    if current:
+        values.append(current)
+    if len(values) > max_fields or sum(len(v) for v in values) > max_total:
+        return None
+    return values
 
 def log_generation(user_id, service, account):
-    """Log account generation to file"""
+    """Log account generation to file, `account` may be a list for batch gens"""
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    log_entry = f"[{timestamp}] User: {user_id} | Service: {service} | Account: {account}\n"
-    
-    with open('logs/gen_logs.txt', 'a', encoding='utf-8') as f:
-        f.write(log_entry)
-
-def get_stock_count(service):
-    """Get the number of accounts in stock for a service"""
-    file_path = f'stock/{service.lower()}.txt'
-    if not os.path.exists(file_path):
-        return 0
-    
-    with open(file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    
-    return len(lines)
-
-def get_random_account(service):
-    """Get and remove a random account from stock"""
-    file_path = f'stock/{service.lower()}.txt'
-    if not os.path.exists(file_path):
-        return None
-    
-    with open(file_path, 'r', encoding='utf-8') as f:
-        accounts = f.readlines()
-    
-    if not accounts:
-        return None
-    
-    # Select random account and remove it
-    import random
-    account = random.choice(accounts)
-    accounts.remove(account)
-    
-    # Write updated stock back to file
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.writelines(accounts)
+    accounts = account if isinstance(account, (list, tuple)) else [account]
+    log_entry = ''.join(
+        f"[{timestamp}] User: {user_id} | Service: {service} | Account: {acc}\n"
+        for acc in accounts
+    )
     
-    return account.strip()
+    # Written in batches by the background log sink and history store
+    get_log_sink().write(log_entry)
+    get_history().record(user_id, service, accounts)
 
 if __name__ == '__main__':
     bot.run(TOKEN)
\ No newline at end of file
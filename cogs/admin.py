@@ -1,8 +1,18 @@
 import discord
 from discord.ext import commands
-import os
 import aiohttp
-from main import create_embed, EMOJI, COLORS
+import asyncio
+import io
+import time
+from main import chunk_field_values, reload_cog, reload_config, sync_commands
+from utils.claims import get_claim_engine
+from utils.config import ConfigError
+from utils.gen_limits import get_gen_limits
+from utils.history import get_history, parse_window
+from utils.metrics import get_metrics
+from utils.stock_alerts import get_stock_alerts, notify_stock_change
+from utils.stock_import import get_importer
+from utils.stock_store import get_registry
 
 class Admin(commands.Cog):
     def __init__(self, bot):
@@ -10,133 +20,319 @@ class Admin(commands.Cog):
     
     async def cog_check(self, ctx):
         """Check if user has admin role"""
-        admin_role = discord.utils.get(ctx.guild.roles, name=ADMIN_ROLE)
+        admin_role = discord.utils.get(ctx.guild.roles, name=self.bot.admin_role)
         if not admin_role:
             return False
         return admin_role in ctx.author.roles
     
     @commands.hybrid_command(name='stock_add', description='Add stock to a service (Admin only)')
     async def stock_add(self, ctx, service: str):
-        """Add accounts to a service's stock via file upload"""
+        """Append accounts from an uploaded file to a service's stock"""
         if not ctx.message.attachments:
-            embed = create_embed(
-                title=f"{EMOJI['error']} Missing File",
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Missing File",
                 description="Please upload a .txt file with accounts.",
-                color=COLORS['error']
-            )
+                color=self.bot.colors['error']
+            ).render()
             await ctx.send(embed=embed)
             return
         
         attachment = ctx.message.attachments[0]
         if not attachment.filename.endswith('.txt'):
-            embed = create_embed(
-                title=f"{EMOJI['error']} Invalid File",
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Invalid File",
                 description="Please upload a .txt file.",
-                color=COLORS['error']
-            )
+                color=self.bot.colors['error']
+            ).render()
             await ctx.send(embed=embed)
             return
         
-        # Download the file
-        file_path = f'stock/{service.lower()}.txt'
-        await attachment.save(file_path)
+        # Stream the upload in chunks, deduplicating against existing stock
+        async with aiohttp.ClientSession() as session:
+            async with session.get(attachment.url) as response:
+                response.raise_for_status()
+                result = await get_importer().import_chunks(
+                    service, response.content.iter_chunked(1 << 20), backend=get_registry().backend(ctx.guild)
+                )
+        await notify_stock_change(self.bot, ctx.guild, service)
         
-        # Count lines added
-        with open(file_path, 'r', encoding='utf-8') as f:
-            count = len(f.readlines())
-        
-        embed = create_embed(
-            title=f"{EMOJI['success']} Stock Added",
-            description=f"Successfully added `{count}` accounts to **{service}** stock.",
-            color=COLORS['success']
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Stock Added",
+            description=f"Successfully added `{result.added}` accounts to **{service}** stock.",
+            color=self.bot.colors['success'],
+            fields=[
+                ("Added", f"`{result.added}`", True),
+                ("Duplicates", f"`{result.duplicates}`", True),
+                ("Rejected", f"`{result.rejected}`", True)
+            ]
         )
         await ctx.send(embed=embed)
     
     @commands.hybrid_command(name='create', description='Create a new service file (Admin only)')
     async def create(self, ctx, service: str):
         """Create a new empty service file"""
-        file_path = f'stock/{service.lower()}.txt'
-        if os.path.exists(file_path):
-            embed = create_embed(
-                title=f"{EMOJI['error']} Service Exists",
-                description=f"**{service}** already exists.",
-                color=COLORS['error']
-            )
+        backend = get_registry().backend(ctx.guild)
+        if not await get_claim_engine().run(backend.create, service):
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Service Exists",
+                description=f"**{{service}}** already exists.",
+                color=self.bot.colors['error']
+            ).render(service=service)
             await ctx.send(embed=embed)
             return
         
-        open(file_path, 'w').close()
-        
-        embed = create_embed(
-            title=f"{EMOJI['success']} Service Created",
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Service Created",
             description=f"Created new service: **{service}**",
-            color=COLORS['success']
+            color=self.bot.colors['success']
         )
         await ctx.send(embed=embed)
     
     @commands.hybrid_command(name='clear', description='Clear all stock for a service (Admin only)')
     async def clear(self, ctx, service: str):
         """Clear all accounts from a service"""
-        file_path = f'stock/{service.lower()}.txt'
-        if not os.path.exists(file_path):
-            embed = create_embed(
-                title=f"{EMOJI['error']} Service Not Found",
-                description=f"**{service}** does not exist.",
-                color=COLORS['error']
-            )
+        backend = get_registry().backend(ctx.guild)
+        if not await get_claim_engine().run(backend.exists, service):
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Service Not Found",
+                description=f"**{{service}}** does not exist.",
+                color=self.bot.colors['error']
+            ).render(service=service)
             await ctx.send(embed=embed)
             return
         
-        # Get count before clearing
-        with open(file_path, 'r', encoding='utf-8') as f:
-            count = len(f.readlines())
-        
-        open(file_path, 'w').close()
+        count = await get_claim_engine().run(backend.clear, service)
+        await get_importer().reset(service, backend=backend)
+        await notify_stock_change(self.bot, ctx.guild, service)
         
-        embed = create_embed(
-            title=f"{EMOJI['success']} Stock Cleared",
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Stock Cleared",
             description=f"Cleared `{count}` accounts from **{service}**.",
-            color=COLORS['success']
+            color=self.bot.colors['success']
         )
         await ctx.send(embed=embed)
     
     @commands.hybrid_command(name='drop', description='Drop accounts into channel (Admin only)')
     async def drop(self, ctx, service: str, count: int = 1):
         """Drop accounts into channel without removing from stock"""
-        file_path = f'stock/{service.lower()}.txt'
-        if not os.path.exists(file_path):
-            embed = create_embed(
-                title=f"{EMOJI['error']} Service Not Found",
-                description=f"**{service}** does not exist.",
-                color=COLORS['error']
-            )
+        backend = get_registry().backend(ctx.guild)
+        if not await get_claim_engine().run(backend.exists, service):
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Service Not Found",
+                description=f"**{{service}}** does not exist.",
+                color=self.bot.colors['error']
+            ).render(service=service)
             await ctx.send(embed=embed)
             return
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            accounts = f.readlines()
+        # Only the first `count` lines are read, whatever the size of the stock
+        dropped = await get_claim_engine().run(backend.peek, service, max(count, 0))
         
-        if not accounts:
-            embed = create_embed(
-                title=f"{EMOJI['error']} Out of Stock",
-                description=f"No accounts available for **{service}**.",
-                color=COLORS['error']
-            )
+        if not dropped:
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Out of Stock",
+                description=f"No accounts available for **{{service}}**.",
+                color=self.bot.colors['error']
+            ).render(service=service)
             await ctx.send(embed=embed)
             return
         
-        count = min(count, len(accounts))
-        dropped = accounts[:count]
+        count = len(dropped)
         
-        embed = create_embed(
-            title=f"{EMOJI['admin']} Accounts Dropped",
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['admin']} Accounts Dropped",
             description=f"Dropped `{count}` **{service}** accounts:",
-            color=COLORS['info']
+            color=self.bot.colors['info']
+        )
+        
+        values = chunk_field_values([f"`{acc.strip()}`" for acc in dropped])
+        if values is None:
+            # Too much for one embed, send the accounts as a file instead
+            data = io.BytesIO(''.join(f"{acc.strip()}\n" for acc in dropped).encode('utf-8'))
+            await ctx.send(embed=embed, file=discord.File(data, filename=f'{service.lower()}_drop.txt'))
+            return
+        
+        for i, value in enumerate(values):
+            embed.add_field(name="Accounts" if i == 0 else "\u200b", value=value, inline=False)
+        
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='gen_limit', description='Set how many accounts a role can gen at once (Admin only)')
+    async def gen_limit(self, ctx, role: discord.Role, amount: int):
+        """Set the per-gen account cap for a role, 0 removes it"""
+        limits = get_gen_limits()
+        limits.set_cap(role.id, amount)
+        
+        if amount > 0:
+            description = f"Members with **{role.name}** can now gen up to `{amount}` accounts at once."
+        else:
+            description = f"Removed the gen limit for **{role.name}** (default: `{limits.default}`)."
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Gen Limit Updated",
+            description=description,
+            color=self.bot.colors['success']
         )
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='stock_alert', description='Set the low-stock alert threshold for a service (Admin only)')
+    async def stock_alert(self, ctx, service: str, threshold: int):
+        """Set when a service counts as low on stock, 0 turns its alerts off"""
+        alerts = get_stock_alerts()
+        alerts.set_threshold(service, threshold)
         
-        account_list = '\n'.join([f"`{acc.strip()}`" for acc in dropped])
-        embed.add_field(name="Accounts", value=account_list, inline=False)
+        if threshold > 0:
+            description = f"An alert is posted when **{service}** drops to `{threshold}` accounts or fewer."
+        elif threshold == 0:
+            description = f"Low-stock alerts are off for **{service}**."
+        else:
+            description = f"**{service}** now uses the default threshold (`{alerts.default}`)."
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Stock Alert Updated",
+            description=description,
+            color=self.bot.colors['success']
+        )
+        await ctx.send(embed=embed)
+        await notify_stock_change(self.bot, ctx.guild, service)
+    
+    @commands.hybrid_command(name='history', description='Show a user\'s recent gens (Admin only)')
+    async def history(self, ctx, user: discord.User):
+        """Show the most recent accounts a user generated"""
+        history = get_history()
+        await history.flush()
+        rows, total = await asyncio.to_thread(lambda: (history.user_history(user.id), history.user_total(user.id)))
+        
+        if not rows:
+            embed = self.bot.create_embed(
+                title=f"{self.bot.emoji['info']} No History",
+                description=f"**{user.display_name}** hasn't generated any accounts.",
+                color=self.bot.colors['info']
+            )
+            await ctx.send(embed=embed)
+            return
         
+        lines = [f"<t:{ts}:R> **{service}** `{account}`" for ts, service, account in rows]
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['admin']} Gen History",
+            description=f"**{user.display_name}** has generated `{total}` accounts. Most recent:",
+            color=self.bot.colors['info']
+        )
+        for i, value in enumerate(chunk_field_values(lines) or [f"`{len(rows)}` entries too long to show"]):
+            embed.add_field(name="Recent" if i == 0 else "\u200b", value=value, inline=False)
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='stats', description='Show gen counts for a service (Admin only)')
+    async def stats(self, ctx, service: str, window: str = '24h'):
+        """Show how many accounts of a service were generated in a time window"""
+        seconds = parse_window(window)
+        if seconds is None:
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Invalid Window",
+                description="Use a number followed by `s`, `m`, `h`, `d` or `w`, e.g. `24h` or `7d`.",
+                color=self.bot.colors['error']
+            ).render()
+            await ctx.send(embed=embed)
+            return
+        
+        history = get_history()
+        await history.flush()
+        recent, total = await asyncio.to_thread(
+            lambda: (history.service_count(service, seconds), history.service_count(service))
+        )
+        
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['stock']} {service.capitalize()} Stats",
+            color=self.bot.colors['info'],
+            fields=[
+                (f"Last {window}", f"`{recent}`", True),
+                ("All time", f"`{total}`", True)
+            ]
+        )
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='metrics', description='Show bot performance metrics (Admin only)')
+    async def metrics(self, ctx):
+        """Show command latency, storage, API and event loop metrics"""
+        metrics = get_metrics()
+        ms = lambda seconds: f"{seconds * 1000:.1f}ms"
+        
+        commands_by_count = sorted(metrics.merged('command_seconds', by='command').items(), key=lambda item: -item[1].count)
+        command_lines = [
+            f"`{name}` {h.count} runs, p50 {ms(h.quantile(0.5))}, p99 {ms(h.quantile(0.99))}"
+            for name, h in commands_by_count[:8]
+        ]
+        
+        errors = sorted(metrics.counter_totals('command_errors_total', by='error').items(), key=lambda item: -item[1])
+        error_lines = [f"`{name}` {count}" for name, count in errors[:8]]
+        
+        storage = metrics.merged('storage_op_seconds', by='op')
+        storage_lines = [
+            f"`{op}` {h.count} ops, p99 {ms(h.quantile(0.99))}"
+            for op, h in sorted(storage.items(), key=lambda item: -item[1].count)[:6]
+        ]
+        read = sum(metrics.counter_totals('storage_bytes_read_total').values())
+        written = sum(metrics.counter_totals('storage_bytes_written_total').values())
+        storage_lines.append(f"Read `{read / 1024:.1f} KiB`, written `{written / 1024:.1f} KiB`")
+        
+        api = metrics.merged('api_request_seconds').get(None)
+        api_line = f"{api.count} calls, p50 {ms(api.quantile(0.5))}, p99 {ms(api.quantile(0.99))}" if api else "No calls yet"
+        lag = metrics.merged('event_loop_lag_seconds').get(None)
+        lag_line = f"p50 {ms(lag.quantile(0.5))}, p99 {ms(lag.quantile(0.99))}" if lag else "Not measured yet"
+        
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['admin']} Bot Metrics",
+            color=self.bot.colors['info'],
+            fields=[
+                ("Commands", "\n".join(command_lines) or "None yet", False),
+                ("Errors", "\n".join(error_lines) or "None", False),
+                ("Storage", "\n".join(storage_lines), False),
+                ("Discord API", api_line, True),
+                ("Event Loop Lag", lag_line, True)
+            ]
+        )
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='reload', description='Reload cogs or the config without restarting (Admin only)')
+    async def reload(self, ctx, target: str = None):
+        """Reload one cog, every cog, or the config, keeping stock, vouches and queues in memory"""
+        started = time.perf_counter()
+        try:
+            if target is None:
+                names = sorted(extension[len('cogs.'):] for extension in self.bot.extensions if extension.startswith('cogs.'))
+                for name in names:
+                    await reload_cog(self.bot, name)
+            elif target.lower() == 'config':
+                names = await reload_config(self.bot)
+            else:
+                names = [target.lower()]
+                await reload_cog(self.bot, names[0])
+        except ConfigError as e:
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Invalid Config",
+                description="Nothing was changed:\n```{problems}```",
+                color=self.bot.colors['error']
+            ).render(problems=str(e))
+            await ctx.send(embed=embed)
+            return
+        except commands.ExtensionError as e:
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Reload Failed",
+                description="The previous version is still running:\n```{error}```",
+                color=self.bot.colors['error']
+            ).render(error=str(e))
+            await ctx.send(embed=embed)
+            return
+        
+        # Only talks to Discord when a command's signature changed
+        await sync_commands(self.bot)
+        reloaded = ', '.join(f"`{name}`" for name in names)
+        description = f"Reloaded {reloaded} in `{(time.perf_counter() - started) * 1000:.0f}ms`."
+        if target is not None and target.lower() == 'config':
+            description = f"Config updated. {description}"
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Reloaded",
+            description=description,
+            color=self.bot.colors['success']
+        )
         await ctx.send(embed=embed)
 
 async def setup(bot):
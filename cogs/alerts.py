@@ -0,0 +1,117 @@
+import discord
+from discord.ext import commands
+import os
+from utils.claims import get_claim_engine
+from utils.stock_alerts import get_stock_alerts
+from utils.stock_import import get_importer
+from utils.stock_store import get_registry, normalize_service
+from utils.stock_watch import StockWatcher
+
+# Low-stock alerts and restock pickup
+#
+# Nothing here polls the stock. Gens, clears and uploads dispatch a
+# `stock_change` event with the new count, and the watcher turns files
+# dropped into a stock directory into the same event once they are
+# imported, so staff hear about low stock as soon as it happens.
+STOCK_ALERT_CHANNEL = os.getenv('STOCK_ALERT_CHANNEL', 'stock-alerts')
+STOCK_ALERT_MENTION = os.getenv('STOCK_ALERT_MENTION', 'true').lower() == 'true'
+
+class Alerts(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.handed_off = False
+        self.watcher = None
+        self.directories = {}
+        state = bot.handoff.pop('Alerts', None)
+        if state is not None:
+            # Reloaded: keep the open inotify watches, events now come to this instance
+            self.watcher = state['watcher']
+            self.watcher.callback = self.file_dropped
+            self.directories = state['directories']
+    
+    async def cog_load(self):
+        if self.watcher is not None:
+            return
+        self.watcher = StockWatcher(self.file_dropped, fallback_interval=float(os.getenv('STOCK_WATCH_INTERVAL', '10')))
+        registry = get_registry()
+        if registry.backend_name == 'text':
+            # Plain text stock is read in place and rewritten by every gen, nothing to import
+            return
+        self.directories = {registry.directory(namespace): namespace for namespace in registry.namespaces()}
+        if not self.watcher.start(list(self.directories)):
+            print(f'inotify unavailable, checking stock directories every {self.watcher.fallback_interval:g}s')
+    
+    async def cog_unload(self):
+        if not self.handed_off:
+            self.watcher.stop()
+    
+    def export_state(self):
+        """State for the instance replacing this one on reload"""
+        self.handed_off = True
+        return {'watcher': self.watcher, 'directories': self.directories}
+    
+    def file_dropped(self, directory, service, path):
+        """Watcher callback for a `.txt` file written or moved into a stock directory"""
+        if directory in self.directories:
+            self.bot.loop.create_task(self.import_file(self.directories[directory], service, path))
+    
+    async def import_file(self, namespace, service, path):
+        backend = get_registry().backend(namespace)
+        try:
+            # Same dedupe as stock_add, so a dropped file can't restock handed-out accounts
+            result = await get_importer().import_file(service, path, backend=backend)
+        except OSError as e:
+            print(f'Failed to import {path}: {e}')
+            return
+        if result is None:
+            # Duplicate event for a file that was already imported
+            return
+        count = await get_claim_engine().run(backend.count, service)
+        self.bot.dispatch('stock_change', namespace, normalize_service(service), count)
+    
+    @commands.Cog.listener()
+    async def on_stock_change(self, namespace, service, count):
+        # Guild namespaces are created on first use, watch them from then on
+        directory = get_registry().directory(namespace)
+        if self.directories and directory not in self.directories:
+            self.directories[directory] = namespace
+            self.watcher.watch(directory)
+        
+        state = get_stock_alerts().observe(namespace, service, count)
+        if state is None:
+            return
+        if namespace is None:
+            guilds = self.bot.guilds
+        else:
+            guilds = [guild for guild in [self.bot.get_guild(namespace)] if guild is not None]
+        for guild in guilds:
+            await self.post_alert(guild, service, count, state)
+    
+    async def post_alert(self, guild, service, count, state):
+        """Post a low-stock or restock notice to a guild's alert channel"""
+        channel = discord.utils.get(guild.text_channels, name=STOCK_ALERT_CHANNEL)
+        if channel is None:
+            return
+        if state == 'low':
+            embed = self.bot.create_embed(
+                title=f"{self.bot.emoji['warning']} Low Stock",
+                description=f"**{service}** is down to `{count}` accounts.",
+                color=self.bot.colors['warning']
+            )
+        else:
+            embed = self.bot.create_embed(
+                title=f"{self.bot.emoji['success']} Restocked",
+                description=f"**{service}** is back to `{count}` accounts.",
+                color=self.bot.colors['success']
+            )
+        content = None
+        role = discord.utils.get(guild.roles, name=self.bot.admin_role)
+        if state == 'low' and STOCK_ALERT_MENTION and role is not None:
+            content = role.mention
+        try:
+            await channel.send(content=content, embed=embed, allowed_mentions=discord.AllowedMentions(roles=True))
+        except discord.HTTPException as e:
+            print(f'Failed to post stock alert in {guild.name}: {e}')
+
+async def setup(bot):
+    await bot.add_cog(Alerts(bot))
\ No newline at end of file
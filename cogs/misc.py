@@ -1,19 +1,35 @@
 import discord
 from discord.ext import commands
-from main import create_embed, EMOJI, COLORS
+from utils.paginator import Paginator
 
 class Misc(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.cmdlist_pages = {}
     
     @commands.hybrid_command(name='cmdlist', description='Show all available commands')
     async def cmdlist(self, ctx):
         """Show a paginated list of all commands"""
+        # Built once per prefix, rebuilt only when commands are added or removed
+        key = (ctx.prefix, self.bot.command_version)
+        pages = self.cmdlist_pages.get(key)
+        if pages is None:
+            # Drop pages built for an older command set
+            self.cmdlist_pages = {k: v for k, v in self.cmdlist_pages.items() if k[1] == key[1]}
+            pages = self.cmdlist_pages[key] = self.build_cmdlist(ctx.prefix)
+        
+        await Paginator(lambda page: pages[page].render(), len(pages), author_id=ctx.author.id).start(ctx)
+    
+    def build_cmdlist(self, prefix):
+        """Embed templates for each cmdlist page"""
         # General commands
         general_commands = [
-            ("gen <service>", "Generate an account from stock"),
+            ("gen <service> [amount]", "Generate accounts from stock"),
             ("stock", "View available stock counts"),
+            ("queue", "View gen queue statistics"),
             ("vouches [user]", "Check a user's vouch count"),
+            ("leaderboard [page]", "Show the users with the most vouches"),
+            ("rank [user]", "Check a user's leaderboard rank"),
             ("cmdlist", "Show this command list")
         ]
         
@@ -23,65 +39,28 @@ class Misc(commands.Cog):
             ("create <service>", "Create new service file"),
             ("clear <service>", "Clear all stock for a service"),
             ("drop <service> <count>", "Drop accounts into channel"),
+            ("gen_limit <role> <amount>", "Set the max accounts per gen for a role"),
+            ("stock_alert <service> <threshold>", "Set the low-stock alert threshold for a service"),
+            ("history <user>", "Show a user's recent gens"),
+            ("stats <service> [window]", "Show gen counts for a service"),
+            ("metrics", "Show bot performance metrics"),
+            ("reload [cog|config]", "Reload cogs or the config without restarting"),
             ("remove <user> <count>", "Remove vouches from a user")
         ]
         
-        # Create embeds
-        embeds = []
-        
-        # General commands embed
-        general_fields = []
-        for cmd, desc in general_commands:
-            general_fields.append((f"`{ctx.prefix}{cmd}`", desc, False))
-        
-        general_embed = create_embed(
-            title=f"{EMOJI['info']} Available Commands",
-            description="**General Commands**",
-            color=COLORS['primary'],
-            fields=general_fields
-        )
-        embeds.append(general_embed)
-        
-        # Admin commands embed
-        admin_fields = []
-        for cmd, desc in admin_commands:
-            admin_fields.append((f"`{ctx.prefix}{cmd}`", desc, False))
-        
-        admin_embed = create_embed(
-            title=f"{EMOJI['admin']} Admin Commands",
-            description="These commands require admin permissions.",
-            color=COLORS['primary'],
-            fields=admin_fields
-        )
-        embeds.append(admin_embed)
-        
-        # Send embeds
-        if len(embeds) == 1:
-            await ctx.send(embed=embeds[0])
-        else:
-            from discord.ext import menus
-            class CmdListMenu(menus.Menu):
-                def __init__(self, embeds):
-                    super().__init__(timeout=60.0, delete_message_after=True)
-                    self.embeds = embeds
-                    self.current_page = 0
-                
-                async def send_initial_message(self, ctx, channel):
-                    return await channel.send(embed=self.embeds[0])
-                
-                @menus.button('⬅️')
-                async def on_previous(self, payload):
-                    if self.current_page > 0:
-                        self.current_page -= 1
-                        await self.message.edit(embed=self.embeds[self.current_page])
-                
-                @menus.button('➡️')
-                async def on_next(self, payload):
-                    if self.current_page < len(self.embeds) - 1:
-                        self.current_page += 1
-                        await self.message.edit(embed=self.embeds[self.current_page])
-            
-            await CmdListMenu(embeds).start(ctx)
+        pages = [
+            (f"{self.bot.emoji['info']} Available Commands", "**General Commands**", general_commands),
+            (f"{self.bot.emoji['admin']} Admin Commands", "These commands require admin permissions.", admin_commands)
+        ]
+        return [
+            self.bot.embed_template(
+                title=title,
+                description=description,
+                color=self.bot.colors['primary'],
+                fields=[(f"`{prefix}{cmd}`", desc, False) for cmd, desc in command_list]
+            )
+            for title, description, command_list in pages
+        ]
 
 async def setup(bot):
     await bot.add_cog(Misc(bot))
\ No newline at end of file
@@ -1,134 +1,280 @@
+import asyncio
 import discord
 from discord.ext import commands
+import io
 import os
-from main import create_embed, EMOJI, COLORS, log_generation, get_stock_count, get_random_account
+from main import log_generation, chunk_field_values
+from utils.claims import get_claim_engine
+from utils.dispatch import AlreadyQueued, GenDispatcher, QueueFull
+from utils.gen_limits import get_gen_limits
+from utils.metrics import get_metrics
+from utils.paginator import Paginator
+from utils.ratelimit import get_rate_limiter
+from utils.stock_alerts import notify_stock_change
+from utils.stock_store import get_registry
 
 class Stock(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-    
-    @commands.hybrid_command(name='gen', description='Generate an account from stock')
-    async def gen(self, ctx, service: str):
-        """Generate an account from the specified service"""
-        account = get_random_account(service)
-        
-        if not account:
-            embed = create_embed(
-                title=f"{EMOJI['error']} Out of Stock",
-                description=f"No accounts available for **{service}**.\nTry again later or check other services with `{ctx.prefix}stock`.",
-                color=COLORS['error']
+        self.handed_off = False
+        state = bot.handoff.pop('Stock', None)
+        if state is not None:
+            # Reloaded: queued and in-flight gens keep going on the same dispatcher
+            self.dispatcher = state['dispatcher']
+        else:
+            self.dispatcher = GenDispatcher(
+                workers=int(os.getenv('GEN_WORKERS', '4')),
+                queue_size=int(os.getenv('GEN_QUEUE_SIZE', '500')),
+                dm_concurrency=int(os.getenv('GEN_DM_CONCURRENCY', '5'))
             )
+    
+    async def cog_load(self):
+        self.dispatcher.start()
+    
+    async def cog_unload(self):
+        if not self.handed_off:
+            await self.dispatcher.stop()
+    
+    def export_state(self):
+        """State for the instance replacing this one on reload"""
+        self.handed_off = True
+        return {'dispatcher': self.dispatcher}
+    
+    @commands.hybrid_command(name='gen', description='Generate accounts from stock')
+    @commands.before_invoke(get_rate_limiter().enforce)
+    async def gen(self, ctx, service: str, amount: int = 1):
+        """Queue an account generation for the specified service"""
+        cap = get_gen_limits().cap_for(ctx.author)
+        if amount < 1 or amount > cap:
+            get_rate_limiter().refund(ctx)
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Invalid Amount",
+                description=f"You can generate between `1` and `{{cap}}` accounts at a time.",
+                color=self.bot.colors['error']
+            ).render(cap=cap)
             await ctx.send(embed=embed)
             return
         
         try:
-            # Send account to user's DMs
-            dm_embed = create_embed(
-                title=f"{EMOJI['gen']} Account Generated",
-                description=f"Here's your **{service}** account:\n```{account}```\n\n**Important:**\n- Vouch in #bot-vouch after claiming\n- Do not share this account",
-                color=COLORS['success'],
-                footer=False
+            position = self.dispatcher.submit(
+                ctx.author.id,
+                lambda: self.deliver(ctx, service, amount),
+                # Reported like an error raised by the command itself
+                on_error=lambda error: self.bot.dispatch('command_error', ctx, commands.CommandInvokeError(error))
             )
-            await ctx.author.send(embed=dm_embed)
-            
-            # Send success message in channel
-            embed = create_embed(
-                title=f"{EMOJI['success']} Account Delivered",
-                description=f"Check your DMs for the **{service}** account!\n\n**Remember to vouch in** #bot-vouch",
-                color=COLORS['success']
+        except AlreadyQueued:
+            get_rate_limiter().refund(ctx)
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['warning']} Gen In Progress",
+                description="You already have a gen in progress. Please wait for it to finish.",
+                color=self.bot.colors['warning']
+            ).render()
+            await ctx.send(embed=embed)
+            return
+        except QueueFull:
+            get_rate_limiter().refund(ctx)
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['warning']} Queue Full",
+                description="Too many gens are queued right now. Please try again in a moment.",
+                color=self.bot.colors['warning']
+            ).render()
+            await ctx.send(embed=embed)
+            return
+        
+        if position:
+            embed = self.bot.create_embed(
+                title=f"{self.bot.emoji['info']} Gen Queued",
+                description=f"You are **#{position}** in the queue.\nEstimated wait: `{self.dispatcher.estimated_wait(position):.1f}s`",
+                color=self.bot.colors['info']
             )
             await ctx.send(embed=embed)
-            
-            # Log the generation
-            log_generation(ctx.author.id, service, account)
-            
+    
+    def build_delivery(self, service, accounts):
+        """Build the DM for a gen: one embed, or a .txt attachment when it won't fit"""
+        if len(accounts) == 1:
+            description = f"Here's your **{service}** account:\n```{accounts[0]}```"
+        else:
+            description = f"Here are your `{len(accounts)}` **{service}** accounts:"
+        description += "\n\n**Important:**\n- Vouch in #bot-vouch after claiming\n- Do not share these accounts"
+        dm_embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['gen']} Account Generated",
+            description=description,
+            color=self.bot.colors['success'],
+            footer=False
+        )
+        if len(accounts) == 1:
+            return dm_embed, None
+        
+        values = chunk_field_values([f"`{acc}`" for acc in accounts])
+        if values is None:
+            return dm_embed, ''.join(f"{acc}\n" for acc in accounts).encode('utf-8')
+        for i, value in enumerate(values):
+            dm_embed.add_field(name="Accounts" if i == 0 else "\u200b", value=value, inline=False)
+        return dm_embed, None
+    
+    async def deliver(self, ctx, service, amount=1):
+        """Claim and deliver accounts, run by a dispatcher worker"""
+        engine = get_claim_engine()
+        metrics = get_metrics()
+        limiter = get_rate_limiter()
+        try:
+            with metrics.timer('gen_reserve_seconds'):
+                reservation = await engine.reserve(service, amount, backend=get_registry().backend(ctx.guild))
+        except BaseException:
+            limiter.refund(ctx)
+            raise
+        
+        if reservation is None:
+            # Nothing delivered, nothing charged
+            limiter.refund(ctx)
+            metrics.inc('gens_total', status='out_of_stock')
+            await notify_stock_change(self.bot, ctx.guild, service)
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Out of Stock",
+                description=f"No accounts available for **{{service}}**.\nTry again later or check other services with `{ctx.prefix}stock`.",
+                color=self.bot.colors['error']
+            ).render(service=service)
+            await ctx.send(embed=embed)
+            return
+        
+        accounts = reservation.accounts
+        try:
+            # Send every account in a single DM, giving up while the reservation still holds
+            dm_embed, attachment = self.build_delivery(service, accounts)
+            if attachment is None:
+                send = self.dispatcher.send_dm(lambda: ctx.author.send(embed=dm_embed))
+            else:
+                send = self.dispatcher.send_dm(lambda: ctx.author.send(
+                    embed=dm_embed,
+                    file=discord.File(io.BytesIO(attachment), filename=f'{service.lower()}_accounts.txt')
+                ))
+            await asyncio.wait_for(send, timeout=engine.delivery_deadline(reservation))
+        except asyncio.TimeoutError:
+            await engine.release(reservation)
+            limiter.refund(ctx)
+            metrics.inc('gens_total', status='dm_timeout')
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Delivery Failed",
+                description="Discord took too long to deliver your DM, nothing was claimed.\nPlease try again in a moment.",
+                color=self.bot.colors['error']
+            ).render()
+            await ctx.send(embed=embed)
+            return
         except discord.Forbidden:
-            embed = create_embed(
-                title=f"{EMOJI['error']} DMs Disabled",
+            # Never delivered, put the account straight back into the pool
+            await engine.release(reservation)
+            limiter.refund(ctx)
+            metrics.inc('gens_total', status='dms_closed')
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} DMs Disabled",
                 description="I couldn't send you the account because your DMs are disabled.\nPlease enable DMs and try again.",
-                color=COLORS['error']
-            )
+                color=self.bot.colors['error']
+            ).render()
             await ctx.send(embed=embed)
+            return
+        except BaseException:
+            await engine.release(reservation)
+            limiter.refund(ctx)
+            raise
+        
+        # Delivered, make the claim permanent (group-committed with other gens)
+        with metrics.timer('gen_commit_seconds'):
+            committed = await engine.commit(reservation)
+        if not committed:
+            # Expired mid-delivery, the lines were released and may be handed out again
+            print(f'Reservation for {service} expired before commit, {len(accounts)} account(s) may be delivered twice')
+            metrics.inc('gens_total', status='late_commit')
+        metrics.inc('gens_total', status='delivered')
+        metrics.inc('accounts_delivered_total', len(accounts))
+        # Only charge for the accounts that were in stock
+        limiter.refund(ctx, amount - len(accounts))
+        await notify_stock_change(self.bot, ctx.guild, service)
+        
+        # Log the whole batch at once
+        log_generation(ctx.author.id, service, accounts)
+        
+        # Send success message in channel
+        delivered = f"`{len(accounts)}` **{service}** accounts" if len(accounts) > 1 else f"**{service}** account"
+        if len(accounts) < amount:
+            delivered += f" (only `{len(accounts)}` of `{amount}` were in stock)"
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Account Delivered",
+            description=f"Check your DMs for the {delivered}!\n\n**Remember to vouch in** #bot-vouch",
+            color=self.bot.colors['success']
+        )
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='queue', description='View gen queue statistics')
+    async def queue(self, ctx):
+        """Show gen queue depth, wait time and delivery latency"""
+        stats = self.dispatcher.stats()
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['info']} Gen Queue",
+            color=self.bot.colors['info'],
+            fields=[
+                ("Queued", f"`{stats['queue_depth']}`", True),
+                ("In Progress", f"`{stats['busy_workers']}`", True),
+                ("Delivered", f"`{stats['completed']}`", True),
+                ("Wait p50 / p99", f"`{stats['wait_p50']:.2f}s` / `{stats['wait_p99']:.2f}s`", True),
+                ("Latency p50 / p99", f"`{stats['latency_p50']:.2f}s` / `{stats['latency_p99']:.2f}s`", True),
+                ("Rate Limited", f"`{stats['rate_limited']}`", True)
+            ]
+        )
+        await ctx.send(embed=embed)
     
     @commands.hybrid_command(name='stock', description='View available stock')
+    @commands.before_invoke(get_rate_limiter().enforce)
     async def stock(self, ctx):
         """Show all available services and their stock counts"""
-        services = []
-        for filename in os.listdir('stock'):
-            if filename.endswith('.txt'):
-                service_name = filename[:-4]
-                count = get_stock_count(service_name)
-                services.append((service_name, count))
+        # Counts come from the in-memory table (or one query for sqlite), not from reading the files
+        counts = await get_claim_engine().run(get_registry().backend(ctx.guild).counts)
+        services = list(counts.items())
         
         if not services:
-            embed = create_embed(
-                title=f"{EMOJI['error']} No Stock Available",
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} No Stock Available",
                 description="There are currently no services with available stock.",
-                color=COLORS['error']
-            )
+                color=self.bot.colors['error']
+            ).render()
             await ctx.send(embed=embed)
             return
         
-        # Split into chunks for pagination if too many services
-        chunks = [services[i:i + 10] for i in range(0, len(services), 10)]
+        # Pages are built only when someone turns to them
+        page_size = 10
+        prefix = ctx.prefix
         
-        embeds = []
-        for i, chunk in enumerate(chunks):
+        def render(page):
             fields = []
-            for service, count in chunk:
+            for service, count in services[page * page_size:(page + 1) * page_size]:
                 fields.append((
-                    f"{EMOJI['stock']} {service.capitalize()}",
-                    f"**Stock:** `{count}` accounts\n`{ctx.prefix}gen {service.lower()}`",
+                    f"{self.bot.emoji['stock']} {service.capitalize()}",
+                    f"**Stock:** `{count}` accounts\n`{prefix}gen {service.lower()}`",
                     True
                 ))
             
-            embed = create_embed(
-                title=f"{EMOJI['stock']} Available Stock",
-                description=f"Use `{ctx.prefix}gen <service>` to claim an account.",
-                color=COLORS['info'],
+            embed = self.bot.create_embed(
+                title=f"{self.bot.emoji['stock']} Available Stock",
+                description=f"Use `{prefix}gen <service>` to claim an account.",
+                color=self.bot.colors['info'],
                 fields=fields,
                 thumbnail="https://i.imgur.com/xyz1234.png"  # Replace with your thumbnail URL
             )
-            embed.set_footer(text=f"Page {i+1}/{len(chunks)} • {WATERMARK}")
-            embeds.append(embed)
+            embed.set_footer(text=f"Page {page + 1}/{page_count} • {self.bot.watermark}")
+            return embed
         
-        if len(embeds) == 1:
-            await ctx.send(embed=embeds[0])
-        else:
-            from discord.ext import menus
-            class StockMenu(menus.Menu):
-                def __init__(self, embeds):
-                    super().__init__(timeout=60.0, delete_message_after=True)
-                    self.embeds = embeds
-                    self.current_page = 0
-                
-                async def send_initial_message(self, ctx, channel):
-                    return await channel.send(embed=self.embeds[0])
-                
-                @menus.button('⬅️')
-                async def on_previous(self, payload):
-                    if self.current_page > 0:
-                        self.current_page -= 1
-                        await self.message.edit(embed=self.embeds[self.current_page])
-                
-                @menus.button('➡️')
-                async def on_next(self, payload):
-                    if self.current_page < len(self.embeds) - 1:
-                        self.current_page += 1
-                        await self.message.edit(embed=self.embeds[self.current_page])
-            
-            await StockMenu(embeds).start(ctx)
+        page_count = (len(services) + page_size - 1) // page_size
+        await Paginator(render, page_count, author_id=ctx.author.id).start(ctx)
     
     @gen.error
     @stock.error
     async def stock_error(self, ctx, error):
         """Error handler for stock commands"""
         if isinstance(error, commands.MissingRequiredArgument):
-            embed = create_embed(
-                title=f"{EMOJI['error']} Missing Service",
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} Missing Service",
                 description=f"Please specify a service.\n\n**Example:**\n`{ctx.prefix}gen minecraft`",
-                color=COLORS['error']
-            )
+                color=self.bot.colors['error']
+            ).render()
             await ctx.send(embed=embed)
 
 async def setup(bot):
@@ -1,42 +1,189 @@
+import asyncio
 import discord
 from discord.ext import commands
-import json
 import os
-from main import create_embed, EMOJI, COLORS
+from utils.leaderboard import Leaderboard
+from utils.maintenance import get_maintenance
+from utils.vouch_store import CompactVouchStore, SqliteVouchStore, VouchStore
 
 # Vouch system storage
 VOUCH_FILE = 'data/vouches.json'
+LEADERBOARD_PAGE_SIZE = 10
+
+# Vouch channel name and trigger keywords
+VOUCH_CHANNEL = os.getenv('VOUCH_CHANNEL', 'bot-vouch')
+VOUCH_KEYWORDS = [k.strip() for k in os.getenv('VOUCH_KEYWORDS', 'legit,vouch,thanks').split(',') if k.strip()]
+
+def compile_keywords(keywords):
+    """Build a matcher for lowercased content from the configured keywords"""
+    # Substring tests via map() beat a regex alternation (with or without
+    # IGNORECASE) on the short messages seen here
+    keywords = tuple(k.lower() for k in keywords)
+    return lambda content: any(map(content.__contains__, keywords))
 
 class Vouches(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.vouches = {}
+        self.handed_off = False
+        self.keyword_matcher = compile_keywords(VOUCH_KEYWORDS)
+        self.leaderboard_pages = {}
+        # Counts that changed while the leaderboard was being built, applied once it is
+        self.leaderboard_changes = {}
+        self.leaderboard_task = None
+        state = bot.handoff.pop('Vouches', None)
+        if state is not None:
+            # Reloaded: keep the loaded counts, leaderboard and channel map instead of rereading them
+            # (a leaderboard still building when the old cog went away is built again)
+            self.store = state['store']
+            self.leaderboard = state['leaderboard']
+            self.vouch_channels = state['vouch_channels']
+            self.vouch_channel_ids = frozenset().union(*self.vouch_channels.values())
+            return
+        backend = os.getenv('VOUCH_BACKEND', 'json').lower()
+        if backend == 'sqlite':
+            # Shared with other bot processes, every update is atomic
+            self.store = SqliteVouchStore(VOUCH_FILE)
+        else:
+            # compact: memory-mapped binary arrays for very large member bases
+            store_class = CompactVouchStore if backend == 'compact' else VouchStore
+            self.store = store_class(
+                VOUCH_FILE,
+                flush_interval=float(os.getenv('VOUCH_FLUSH_SECONDS', '1.0')),
+                durability=os.getenv('VOUCH_DURABILITY', 'journal').lower()
+            )
+        self.vouch_channels = {}
+        self.vouch_channel_ids = frozenset()
         self.load_vouches()
     
+    async def cog_load(self):
+        # Snapshots copy the live counts, whichever store holds them
+        get_maintenance().add_source('vouches.json', self.store.snapshot_source)
+        if self.leaderboard is None:
+            self.start_leaderboard_build()
+        # Guilds are only cached once the bot is ready, on_ready covers a cold start
+        if self.bot.is_ready():
+            self.refresh_all_channels()
+    
+    def refresh_guild_channels(self, guild):
+        """Re-resolve one guild's vouch channels to IDs"""
+        ids = {channel.id for channel in guild.text_channels if channel.name == VOUCH_CHANNEL}
+        if ids:
+            self.vouch_channels[guild.id] = ids
+        else:
+            self.vouch_channels.pop(guild.id, None)
+        self.vouch_channel_ids = frozenset().union(*self.vouch_channels.values())
+    
+    def refresh_all_channels(self):
+        self.vouch_channels = {}
+        for guild in self.bot.guilds:
+            self.refresh_guild_channels(guild)
+    
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.refresh_all_channels()
+    
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.refresh_guild_channels(guild)
+    
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.vouch_channels.pop(guild.id, None)
+        self.vouch_channel_ids = frozenset().union(*self.vouch_channels.values())
+    
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        self.refresh_guild_channels(channel.guild)
+    
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.refresh_guild_channels(channel.guild)
+    
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        if before.name != after.name:
+            self.refresh_guild_channels(after.guild)
+    
     def load_vouches(self):
-        """Load vouch data from file"""
-        os.makedirs('data', exist_ok=True)
-        if os.path.exists(VOUCH_FILE):
-            with open(VOUCH_FILE, 'r', encoding='utf-8') as f:
-                self.vouches = json.load(f)
+        """Load vouch data from file, the leaderboard is built from it in cog_load"""
+        self.store.load()
+        self.leaderboard = None
+        self.leaderboard_pages = {}
+    
+    def start_leaderboard_build(self):
+        """Build the leaderboard in a thread from a copy of the counts taken now"""
+        # Walking millions of users would stall the event loop (and startup) for seconds
+        self.leaderboard_changes = {}
+        self.leaderboard_task = asyncio.create_task(self.build_leaderboard(self.store.items_source()))
+        return self.leaderboard_task
+    
+    async def build_leaderboard(self, source):
+        try:
+            board = await asyncio.to_thread(lambda: Leaderboard.build(source()))
+        except Exception as e:
+            print(f'Vouch leaderboard build failed: {type(e).__name__}: {e}')
+            raise
+        for user_id, count in self.leaderboard_changes.items():
+            board.update(user_id, count)
+        self.leaderboard_changes = {}
+        self.leaderboard = board
+        self.leaderboard_pages = {}
+        return board
+    
+    async def get_leaderboard(self):
+        """The leaderboard, waiting for its build if it is still running"""
+        if self.leaderboard is None:
+            task = self.leaderboard_task
+            # A finished task with no leaderboard failed or was cancelled, try again
+            if task is None or task.done():
+                task = self.start_leaderboard_build()
+            await asyncio.shield(task)
+        return self.leaderboard
+    
+    def record_change(self, user_id, count):
+        """Move a user on the leaderboard and drop the cached pages that changed"""
+        if self.leaderboard is None:
+            self.leaderboard_changes[user_id] = count
+            return
+        changed = self.leaderboard.update(user_id, count)
+        if changed is None or not self.leaderboard_pages:
+            return
+        first, last = changed
+        first_page = first // LEADERBOARD_PAGE_SIZE
+        last_page = None if last is None else last // LEADERBOARD_PAGE_SIZE
+        for page in list(self.leaderboard_pages):
+            if page >= first_page and (last_page is None or page <= last_page):
+                del self.leaderboard_pages[page]
+    
+    async def cog_unload(self):
+        """Write any pending vouch changes before the cog goes away"""
+        get_maintenance().remove_source('vouches.json')
+        if self.leaderboard_task is not None:
+            self.leaderboard_task.cancel()
+        if not self.handed_off:
+            await self.store.close()
     
-    def save_vouches(self):
-        """Save vouch data to file"""
-        with open(VOUCH_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.vouches, f, indent=4)
+    def export_state(self):
+        """State for the instance replacing this one on reload"""
+        self.handed_off = True
+        return {'store': self.store, 'leaderboard': self.leaderboard, 'vouch_channels': self.vouch_channels}
+    
+    async def run_store(self, func, *args):
+        """Call into the vouch store, off the event loop when it does blocking I/O"""
+        if self.store.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
     
     @commands.hybrid_command(name='vouches', description='Check a user\'s vouch count')
     async def vouches(self, ctx, user: discord.Member = None):
         """Check how many vouches a user has"""
         target = user or ctx.author
-        user_id = str(target.id)
-        
-        count = self.vouches.get(user_id, 0)
+        count = await self.run_store(self.store.get, target.id)
         
-        embed = create_embed(
-            title=f"{EMOJI['vouch']} Vouch Count",
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['vouch']} Vouch Count",
             description=f"**{target.display_name}** has `{count}` vouches.",
-            color=COLORS['info']
+            color=self.bot.colors['info']
         )
         await ctx.send(embed=embed)
     
@@ -44,54 +191,104 @@ class Vouches(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def remove(self, ctx, user: discord.Member, count: int = 1):
         """Remove vouches from a user"""
-        user_id = str(user.id)
-        
-        if user_id not in self.vouches or self.vouches[user_id] <= 0:
-            embed = create_embed(
-                title=f"{EMOJI['error']} No Vouches",
-                description=f"**{user.display_name}** has no vouches to remove.",
-                color=COLORS['error']
-            )
+        old_count = await self.run_store(self.store.get, user.id)
+        if old_count <= 0:
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['error']} No Vouches",
+                description=f"**{{name}}** has no vouches to remove.",
+                color=self.bot.colors['error']
+            ).render(name=user.display_name)
             await ctx.send(embed=embed)
             return
         
-        self.vouches[user_id] = max(0, self.vouches[user_id] - count)
-        self.save_vouches()
+        new_count = await self.run_store(self.store.add, user.id, -count)
+        self.record_change(user.id, new_count)
+        
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['success']} Vouches Removed",
+            description=f"Removed `{count}` vouches from **{user.display_name}**.\nNew count: `{new_count}`",
+            color=self.bot.colors['success']
+        )
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='leaderboard', description='Show the users with the most vouches')
+    async def leaderboard_command(self, ctx, page: int = 1):
+        """Show a page of the vouch leaderboard"""
+        leaderboard = await self.get_leaderboard()
+        pages = max(1, -(-len(leaderboard) // LEADERBOARD_PAGE_SIZE))
+        page = min(max(page, 1), pages)
+        
+        # Rendered lines are kept until a vouch moves someone on this page
+        lines = self.leaderboard_pages.get(page - 1)
+        if lines is None:
+            lines = self.leaderboard_pages[page - 1] = [
+                f"**#{position + 1}** <@{user_id}> - `{count}` vouches"
+                for position, user_id, count in leaderboard.page(page - 1, LEADERBOARD_PAGE_SIZE)
+            ]
         
-        embed = create_embed(
-            title=f"{EMOJI['success']} Vouches Removed",
-            description=f"Removed `{count}` vouches from **{user.display_name}**.\nNew count: `{self.vouches[user_id]}`",
-            color=COLORS['success']
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['vouch']} Vouch Leaderboard",
+            description="\n".join(lines) or "No vouches yet.",
+            color=self.bot.colors['info']
         )
+        embed.set_footer(text=f"Page {page}/{pages} • {self.bot.watermark}")
+        await ctx.send(embed=embed)
+    
+    @commands.hybrid_command(name='rank', description='Check a user\'s leaderboard rank')
+    async def rank(self, ctx, user: discord.Member = None):
+        """Show where a user ranks on the vouch leaderboard"""
+        target = user or ctx.author
+        leaderboard = await self.get_leaderboard()
+        count = await self.run_store(self.store.get, target.id)
+        # Another process sharing the database may have changed it since
+        self.record_change(target.id, count)
+        position = leaderboard.position(target.id)
+        
+        if position is None:
+            embed = self.bot.embed_template(
+                title=f"{self.bot.emoji['vouch']} Unranked",
+                description="**{name}** has no vouches yet.",
+                color=self.bot.colors['info']
+            ).render(name=target.display_name)
+        else:
+            embed = self.bot.create_embed(
+                title=f"{self.bot.emoji['vouch']} Vouch Rank",
+                description=f"**{target.display_name}** is ranked `#{position + 1}` of `{len(leaderboard)}` with `{count}` vouches.",
+                color=self.bot.colors['info']
+            )
         await ctx.send(embed=embed)
     
     @commands.Cog.listener()
     async def on_message(self, message):
         """Automatically track vouches in the vouch channel"""
-        if message.channel.name != 'bot-vouch':
+        # Integer checks first, this runs for every message the bot can see
+        if message.channel.id not in self.vouch_channel_ids:
             return
         
         if message.author.bot:
             return
         
+        bot_id = self.bot.user.id
+        for mention in message.mentions:
+            if mention.id == bot_id:
+                break
+        else:
+            return
+        
         # Check if message contains "legit" or similar keywords
-        content = message.content.lower()
-        if 'legit' in content or 'vouch' in content or 'thanks' in content:
-            # Find mentioned users
-            for mention in message.mentions:
-                if mention.bot and mention.id == self.bot.user.id:
-                    # Bot was mentioned, give vouch to author
-                    user_id = str(message.author.id)
-                    self.vouches[user_id] = self.vouches.get(user_id, 0) + 1
-                    self.save_vouches()
-                    
-                    embed = create_embed(
-                        title=f"{EMOJI['vouch']} Vouch Recorded",
-                        description=f"Thanks for your vouch! You now have `{self.vouches[user_id]}` vouches.",
-                        color=COLORS['success']
-                    )
-                    await message.reply(embed=embed)
-                    break
+        if not self.keyword_matcher(message.content.lower()):
+            return
+        
+        # Bot was mentioned, give vouch to author
+        count = await self.run_store(self.store.add, message.author.id)
+        self.record_change(message.author.id, count)
+        
+        embed = self.bot.create_embed(
+            title=f"{self.bot.emoji['vouch']} Vouch Recorded",
+            description=f"Thanks for your vouch! You now have `{count}` vouches.",
+            color=self.bot.colors['success']
+        )
+        await message.reply(embed=embed)
 
 async def setup(bot):
     await bot.add_cog(Vouches(bot))
\ No newline at end of file
@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.stock_store import get_backend, normalize_service
+
+# Async claim engine
+#
+# Stock I/O runs in a thread pool so gens never block the event loop. Claims
+# for one service are serialized by a per-service lock, and every claim that
+# arrives in the same loop tick (or while the previous batch is still on
+# disk) is served by a single reserve() call on the backend.
+#
+# The engine serves every stock namespace: batches, locks and group commits
+# are keyed by (backend, service), and a reservation remembers its backend.
+#
+# Claims are two-phase: reserve() takes lines out of the in-memory pool,
+# the caller delivers them, then commit() makes the removal durable or
+# release() puts them back. Commits arriving within the group commit window
+# share one durable write, and reservations that are neither committed nor
+# released before their timeout go back to the pool. Callers bound delivery
+# by time_left() so a slow send can't outlive its reservation.
+
+
+class Reservation:
+    """Lines taken out of the pool for one delivery, pending commit or release"""
+
+    __slots__ = ('backend', 'service', 'tokens', 'accounts', 'handle', 'settled')
+
+    def __init__(self, backend, service, tokens, accounts):
+        self.backend = backend
+        self.service = service
+        self.tokens = tokens
+        self.accounts = accounts
+        self.handle = None
+        self.settled = False
+
+    @property
+    def account(self):
+        return self.accounts[0] if self.accounts else None
+
+    def time_left(self):
+        """Seconds until the reservation expires and its lines go back to the pool"""
+        if self.settled or self.handle is None:
+            return 0.0
+        return max(0.0, self.handle.when() - asyncio.get_running_loop().time())
+
+
+class ClaimEngine:
+    """Batches concurrent claims per service and runs them off the event loop"""
+
+    def __init__(self, backend, max_workers=4, reservation_timeout=120.0, commit_delay=0.01, delivery_margin=10.0):
+        self.backend = backend
+        self.reservation_timeout = reservation_timeout
+        self.delivery_margin = min(delivery_margin, reservation_timeout / 2)
+        self.commit_delay = commit_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stock-io')
+        self._locks = defaultdict(asyncio.Lock)
+        self._pending = {}
+        self._commits = {}
+        self.reserved = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking storage call in the stock I/O thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def reserve(self, service, count=1, backend=None):
+        """Reserve up to `count` random accounts for a service, or None when out of stock"""
+        key = (backend or self.backend, normalize_service(service))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiters = self._pending.get(key)
+        if waiters is None:
+            waiters = self._pending[key] = []
+            loop.call_soon(lambda: asyncio.ensure_future(self._flush(key)))
+        waiters.append((future, count))
+        return await future
+
+    async def claim(self, service, backend=None):
+        """Reserve and immediately commit one account"""
+        reservation = await self.reserve(service, backend=backend)
+        if reservation is None:
+            return None
+        await self.commit(reservation)
+        return reservation.account
+
+    async def _flush(self, key):
+        backend, name = key
+        async with self._locks[key]:
+            waiters = [(w, count) for w, count in self._pending.pop(key, []) if not w.done()]
+            if not waiters:
+                return
+            try:
+                reserved = await self.run(backend.reserve, name, sum(count for _, count in waiters))
+            except Exception as e:
+                for waiter, _ in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                return
+
+            # Hand out accounts in arrival order, anyone left over is out of stock
+            unclaimed = []
+            position = 0
+            for waiter, count in waiters:
+                share = reserved[position:position + count]
+                position += len(share)
+                if waiter.done():
+                    # Waiter cancelled mid-batch, its accounts must not be lost
+                    unclaimed.extend(token for token, _ in share)
+                    continue
+                if not share:
+                    waiter.set_result(None)
+                    continue
+                reservation = Reservation(backend, name, [token for token, _ in share], [account for _, account in share])
+                waiter.set_result(self._track(reservation))
+
+            if unclaimed:
+                await self.run(backend.release, name, unclaimed)
+
+    def _track(self, reservation):
+        loop = asyncio.get_running_loop()
+        self.reserved += 1
+        reservation.handle = loop.call_later(
+            self.reservation_timeout,
+            lambda: asyncio.ensure_future(self.release(reservation))
+        )
+        return reservation
+
+    def _settle(self, reservation):
+        """Mark a reservation as finished, returning False if it already was"""
+        if reservation.settled:
+            return False
+        reservation.settled = True
+        self.reserved -= 1
+        if reservation.handle is not None:
+            reservation.handle.cancel()
+        return True
+
+    def delivery_deadline(self, reservation):
+        """Seconds a delivery may take while leaving time to commit before expiry"""
+        return max(0.0, reservation.time_left() - self.delivery_margin)
+
+    async def commit(self, reservation):
+        """Make a delivered reservation permanent, grouped with other recent commits"""
+        if not self._settle(reservation):
+            return False
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (reservation.backend, reservation.service)
+        group = self._commits.get(key)
+        if group is None:
+            group = self._commits[key] = ([], [])
+            loop.call_later(self.commit_delay, lambda: asyncio.ensure_future(self._group_commit(key)))
+        group[0].extend(reservation.tokens)
+        group[1].append(future)
+        await future
+        return True
+
+    async def _group_commit(self, key):
+        tokens, futures = self._commits.pop(key)
+        backend, name = key
+        try:
+            await self.run(backend.commit, name, tokens)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
+
+    async def release(self, reservation):
+        """Return an undelivered reservation to the pool"""
+        if not self._settle(reservation):
+            return
+        await self.run(reservation.backend.release, reservation.service, reservation.tokens)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+_engine = None
+
+
+def get_claim_engine():
+    """Return the process-wide claim engine"""
+    global _engine
+    if _engine is None:
+        _engine = ClaimEngine(
+            get_backend(),
+            max_workers=int(os.getenv('STOCK_IO_WORKERS', '4')),
+            reservation_timeout=float(os.getenv('GEN_RESERVATION_SECONDS', '120')),
+            delivery_margin=float(os.getenv('GEN_DELIVERY_MARGIN_SECONDS', '10'))
+        )
+    return _engine
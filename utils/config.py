@@ -0,0 +1,79 @@
+import json
+import os
+import re
+
+from dotenv import load_dotenv
+
+# Reloadable settings
+#
+# ADMIN_ROLE and WATERMARK come from the environment (.env), the EMOJI and
+# COLORS tables from the built-in defaults with data/config.json layered on
+# top. load_config() reads everything, checks every value and returns a
+# complete new set, so a bad edit is rejected whole and the running values
+# stay untouched until the caller swaps the new set in.
+
+CONFIG_FILE = 'data/config.json'
+HEX_COLOR = re.compile(r'^(#|0x)?[0-9a-fA-F]{6}$')
+
+
+class ConfigError(ValueError):
+    """One or more settings failed validation"""
+
+
+def parse_color(value):
+    """Accept 0xRRGGBB ints or '#RRGGBB' / '0xRRGGBB' strings"""
+    if isinstance(value, str) and HEX_COLOR.match(value):
+        return int(value[-6:], 16)
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 0xFFFFFF:
+        return value
+    raise ValueError(f'{value!r} is not a color')
+
+
+def load_config(defaults, path=CONFIG_FILE, env_file='.env'):
+    """Read and validate the reloadable settings, raising ConfigError listing every problem"""
+    # Edits to .env win over values loaded from it at startup
+    load_dotenv(env_file, override=True)
+    overrides = {}
+    problems = []
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                overrides = json.load(f)
+        except ValueError as e:
+            raise ConfigError(f'{path}: {e}')
+        if not isinstance(overrides, dict):
+            raise ConfigError(f'{path} must hold a JSON object')
+        problems += [f'unknown setting {key}' for key in overrides if key not in defaults]
+
+    config = {}
+    for key in ('ADMIN_ROLE', 'WATERMARK'):
+        config[key] = os.getenv(key, overrides.get(key, defaults[key]))
+    if not config['ADMIN_ROLE'] or len(config['ADMIN_ROLE']) > 100:
+        problems.append('ADMIN_ROLE must be a role name of 1 to 100 characters')
+    if len(config['WATERMARK']) > 2048:
+        problems.append('WATERMARK must fit in an embed footer (2048 characters)')
+
+    emoji = dict(defaults['EMOJI'])
+    for key, value in overrides.get('EMOJI', {}).items():
+        if key not in emoji:
+            problems.append(f'unknown emoji {key}')
+        elif not isinstance(value, str) or not value.strip():
+            problems.append(f'emoji {key} must be a non-empty string')
+        else:
+            emoji[key] = value
+    config['EMOJI'] = emoji
+
+    colors = dict(defaults['COLORS'])
+    for key, value in overrides.get('COLORS', {}).items():
+        if key not in colors:
+            problems.append(f'unknown color {key}')
+            continue
+        try:
+            colors[key] = parse_color(value)
+        except ValueError as e:
+            problems.append(f'color {key}: {e}')
+    config['COLORS'] = colors
+
+    if problems:
+        raise ConfigError('; '.join(problems))
+    return config
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+# Gen dispatcher
+#
+# Gens are queued instead of delivered inline. A fixed pool of workers
+# drains a bounded queue, each user may have one gen queued or in flight,
+# and every outbound DM goes through a global semaphore that pauses all
+# workers when Discord answers with a rate limit.
+
+
+class AlreadyQueued(Exception):
+    """The user already has a gen queued or in flight"""
+
+
+class QueueFull(Exception):
+    """The gen queue is at capacity"""
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class GenRequest:
+    __slots__ = ('user_id', 'job', 'on_error', 'enqueued_at')
+
+    def __init__(self, user_id, job, on_error=None):
+        self.user_id = user_id
+        self.job = job
+        self.on_error = on_error
+        self.enqueued_at = time.perf_counter()
+
+
+class GenDispatcher:
+    """Bounded gen queue served by a worker pool with DM rate-limit backoff"""
+
+    def __init__(self, workers=4, queue_size=500, dm_concurrency=5, max_retries=3):
+        self.worker_count = workers
+        self.max_retries = max_retries
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._dm_semaphore = asyncio.Semaphore(dm_concurrency)
+        self._in_flight = set()
+        self._workers = []
+        self._busy = 0
+        self._paused_until = 0.0
+        # Metrics
+        self.wait_times = deque(maxlen=1000)
+        self.latencies = deque(maxlen=1000)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    def start(self):
+        if self._workers:
+            # Already running, e.g. handed over by a reloaded cog
+            return
+        for i in range(self.worker_count):
+            self._workers.append(asyncio.create_task(self._worker(), name=f'gen-worker-{i}'))
+
+    async def stop(self, timeout=10.0):
+        """Let queued gens finish for up to `timeout` seconds, then stop the workers"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f'Stopping gen dispatcher with {self._queue.qsize()} gens still queued')
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, user_id, job, on_error=None):
+        """Queue a gen and return how many gens are ahead of it
+
+        `on_error(exception)` is called if the job raises, so the failure can
+        be reported where the gen was asked for.
+        """
+        if user_id in self._in_flight:
+            self.rejected += 1
+            raise AlreadyQueued()
+        try:
+            self._queue.put_nowait(GenRequest(user_id, job, on_error))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFull() from None
+        self._in_flight.add(user_id)
+        self.submitted += 1
+        idle = self.worker_count - self._busy
+        return max(0, self._queue.qsize() - idle)
+
+    def estimated_wait(self, position):
+        """Rough seconds until a gen at `position` starts, from recent latencies"""
+        if not position:
+            return 0.0
+        average = sum(self.latencies) / len(self.latencies) if self.latencies else 1.0
+        return position * average / self.worker_count
+
+    async def _worker(self):
+        while True:
+            request = await self._queue.get()
+            self._busy += 1
+            started = time.perf_counter()
+            self.wait_times.append(started - request.enqueued_at)
+            try:
+                await request.job()
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f'Gen for user {request.user_id} failed: {e!r}')
+                if request.on_error is not None:
+                    try:
+                        request.on_error(e)
+                    except Exception as report_error:
+                        print(f'Failed to report gen failure for user {request.user_id}: {report_error!r}')
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+                self._in_flight.discard(request.user_id)
+                self._busy -= 1
+                self._queue.task_done()
+
+    async def send_dm(self, send):
+        """Run a DM send coroutine factory under the global DM limit, backing off on 429s"""
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            delay = self._paused_until - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._dm_semaphore:
+                try:
+                    return await send()
+                except discord.RateLimited as e:
+                    retry_after = e.retry_after
+                    if attempt >= self.max_retries:
+                        raise
+                except discord.HTTPException as e:
+                    if e.status != 429 or attempt >= self.max_retries:
+                        raise
+                    retry_after = 2.0 ** attempt
+            self.rate_limited += 1
+            attempt += 1
+            # Pause every worker, not just this one
+            self._paused_until = max(self._paused_until, loop.time() + retry_after)
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'in_flight': len(self._in_flight),
+            'busy_workers': self._busy,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'rate_limited': self.rate_limited,
+            'wait_p50': percentile(self.wait_times, 50),
+            'wait_p99': percentile(self.wait_times, 99),
+            'latency_p50': percentile(self.latencies, 50),
+            'latency_p99': percentile(self.latencies, 99),
+        }
@@ -0,0 +1,45 @@
+import json
+import os
+
+from utils.vouch_store import atomic_write
+
+# Per-role caps on how many accounts one gen may claim. A member gets the
+# highest cap of any of their roles, or the default when none is set.
+
+LIMITS_FILE = 'data/gen_limits.json'
+
+
+class GenLimits:
+    """Admin-configured max amount per gen, keyed by role ID"""
+
+    def __init__(self, path=LIMITS_FILE, default=1):
+        self.path = path
+        self.default = default
+        self.roles = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.roles = json.load(f)
+
+    def cap_for(self, member):
+        caps = [self.roles[str(role.id)] for role in getattr(member, 'roles', []) if str(role.id) in self.roles]
+        return max(caps, default=self.default)
+
+    def set_cap(self, role_id, cap):
+        """Set a role's cap, or remove it when cap is 0 or less"""
+        if cap > 0:
+            self.roles[str(role_id)] = cap
+        else:
+            self.roles.pop(str(role_id), None)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        atomic_write(self.path, json.dumps(self.roles, separators=(',', ':')).encode('utf-8'))
+
+
+_limits = None
+
+
+def get_gen_limits():
+    """Return the process-wide gen limits"""
+    global _limits
+    if _limits is None:
+        _limits = GenLimits(default=int(os.getenv('GEN_MAX_DEFAULT', '1')))
+    return _limits
@@ -0,0 +1,137 @@
+import asyncio
+import datetime
+import os
+
+from utils.metrics import get_metrics
+
+# Background sink for generation logs
+#
+# log_generation() only enqueues a line. A single writer task drains the
+# queue and writes whole batches, flushing when a batch is full or when the
+# flush interval runs out, and rotating the file by size or by date.
+
+LOG_PATH = 'logs/gen_logs.txt'
+
+
+class LogSink:
+    """Asyncio queue drained by one writer task that appends in batches"""
+
+    def __init__(self, path=LOG_PATH, max_batch=500, flush_interval=1.0,
+                 rotate_bytes=10 * 1024 * 1024, rotate_daily=False):
+        self.path = path
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self._queue = None
+        self._task = None
+        self._file = None
+        self._opened_on = None
+        self.closed = False
+
+    def write(self, entry):
+        """Queue a log line, falling back to a direct write outside the event loop"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or self.closed:
+            self._write_batch([entry])
+            self._close_file()
+            return
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        self._queue.put_nowait(entry)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            entry = await self._queue.get()
+            if entry is None:
+                break
+            batch = [entry]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                # Take whatever is already queued before waiting on the clock
+                try:
+                    entry = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        entry = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except OSError as e:
+                print(f'Failed to write {len(batch)} generation log entries: {e}')
+        await asyncio.to_thread(self._close_file)
+
+    def _rotated_path(self, stamp):
+        path = f'{self.path}.{stamp}'
+        suffix = 1
+        while os.path.exists(path):
+            path = f'{self.path}.{stamp}.{suffix}'
+            suffix += 1
+        return path
+
+    def _maybe_rotate(self, incoming):
+        today = datetime.date.today()
+        size = self._file.tell() if self._file else (os.path.getsize(self.path) if os.path.exists(self.path) else 0)
+        if self.rotate_daily and self._opened_on and self._opened_on != today:
+            stamp = self._opened_on.strftime('%Y-%m-%d')
+        elif self.rotate_bytes and size and size + incoming > self.rotate_bytes:
+            stamp = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
+        else:
+            return
+        self._close_file()
+        os.replace(self.path, self._rotated_path(stamp))
+
+    def _write_batch(self, batch):
+        data = ''.join(batch).encode('utf-8')
+        self._maybe_rotate(len(data))
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'ab')
+            self._opened_on = datetime.date.today()
+        self._file.write(data)
+        self._file.flush()
+        get_metrics().inc('storage_bytes_written_total', len(data), store='gen_log')
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def close(self):
+        """Flush everything still queued and stop the writer task"""
+        self.closed = True
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+
+_sink = None
+
+
+def get_log_sink():
+    """Return the process-wide generation log sink"""
+    global _sink
+    if _sink is None:
+        _sink = LogSink(
+            path=os.getenv('GEN_LOG_PATH', LOG_PATH),
+            max_batch=int(os.getenv('GEN_LOG_BATCH', '500')),
+            flush_interval=float(os.getenv('GEN_LOG_FLUSH_SECONDS', '1.0')),
+            rotate_bytes=int(os.getenv('GEN_LOG_ROTATE_BYTES', str(10 * 1024 * 1024))),
+            rotate_daily=os.getenv('GEN_LOG_ROTATE_DAILY', 'false').lower() == 'true'
+        )
+    return _sink
@@ -0,0 +1,190 @@
+import asyncio
+import datetime
+import glob
+import os
+import re
+import time
+
+from utils.db import Database
+from utils.metrics import get_metrics
+
+# Structured generation history
+#
+# Every gen is recorded in a SQLite table indexed by user and by service,
+# alongside an hourly per-service rollup, so "what did user X get" is an
+# index range scan and "how many gens in the last N days" sums at most one
+# row per hour instead of counting individual gens. Records are buffered
+# and written in batches off the event loop.
+
+HISTORY_DB = 'logs/history.db'
+TEXT_LOG_PATTERN = 'logs/gen_logs.txt*'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS gens (id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, '
+    'user_id INTEGER NOT NULL, service TEXT NOT NULL, account TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS gens_by_user ON gens (user_id, ts)',
+    'CREATE INDEX IF NOT EXISTS gens_by_service ON gens (service, ts)',
+    'CREATE TABLE IF NOT EXISTS gens_hourly (service TEXT NOT NULL, hour INTEGER NOT NULL, '
+    'count INTEGER NOT NULL, PRIMARY KEY (service, hour))',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+)
+
+LOG_LINE = re.compile(r'^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] User: (\d+) \| Service: (.*?) \| Account: (.*)$')
+WINDOW = re.compile(r'^(\d+)\s*([smhdw])$')
+WINDOW_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_window(text):
+    """Parse a window like `30m`, `24h` or `7d` into seconds, None if invalid"""
+    match = WINDOW.match(text.strip().lower())
+    if not match:
+        return None
+    return int(match.group(1)) * WINDOW_UNITS[match.group(2)]
+
+
+class HistoryStore:
+    """Batched writer and indexed queries over generation history"""
+
+    def __init__(self, path=HISTORY_DB, flush_interval=1.0, max_batch=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = Database(path)
+        with self.db.transaction() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+        self._pending = []
+        self._flush_handle = None
+        self._flush_task = None
+
+    def record(self, user_id, service, accounts, ts=None):
+        """Buffer one gen (one or more accounts) for the next batch write"""
+        ts = int(time.time() if ts is None else ts)
+        service = service.lower()
+        self._pending.extend((ts, user_id, service, account) for account in accounts)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_now()
+            return
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._flush_handle is None and self._flush_task is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _write(self, rows):
+        metrics = get_metrics()
+        metrics.inc('storage_ops_total', store='history', op='write')
+        metrics.inc('history_rows_written_total', len(rows))
+        hourly = {}
+        for ts, _, service, _ in rows:
+            key = (service, ts - ts % 3600)
+            hourly[key] = hourly.get(key, 0) + 1
+        with self.db.transaction() as conn:
+            conn.executemany('INSERT INTO gens (ts, user_id, service, account) VALUES (?, ?, ?, ?)', rows)
+            conn.executemany(
+                'INSERT INTO gens_hourly (service, hour, count) VALUES (?, ?, ?) '
+                'ON CONFLICT (service, hour) DO UPDATE SET count = count + excluded.count',
+                ((service, hour, count) for (service, hour), count in hourly.items())
+            )
+
+    async def flush(self):
+        """Write everything buffered so far in one transaction, off the event loop"""
+        try:
+            while self._pending:
+                rows, self._pending = self._pending, []
+                try:
+                    await asyncio.to_thread(self._write, rows)
+                except Exception as e:
+                    print(f'Failed to write {len(rows)} history rows: {e}')
+                    self._pending[:0] = rows
+                    break
+        finally:
+            self._flush_task = None
+
+    def flush_now(self):
+        rows, self._pending = self._pending, []
+        if rows:
+            self._write(rows)
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        self.flush_now()
+
+    def user_history(self, user_id, limit=10):
+        """Most recent gens for a user as (ts, service, account) rows"""
+        return self.db.execute(
+            'SELECT ts, service, account FROM gens WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT ?',
+            (user_id, limit)
+        ).fetchall()
+
+    def user_total(self, user_id):
+        return self.db.execute('SELECT count(*) FROM gens WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    def service_count(self, service, window=None, now=None):
+        """Gens for a service in the last `window` seconds, or all time"""
+        service = service.lower()
+        if window is None:
+            row = self.db.execute('SELECT sum(count) FROM gens_hourly WHERE service = ?', (service,)).fetchone()
+            return row[0] or 0
+        start = int((time.time() if now is None else now) - window)
+        first_full_hour = start + (-start) % 3600
+        # Exact count for the partial first hour, rollup rows for the rest
+        partial = self.db.execute(
+            'SELECT count(*) FROM gens WHERE service = ? AND ts >= ? AND ts < ?',
+            (service, start, first_full_hour)
+        ).fetchone()[0]
+        full = self.db.execute(
+            'SELECT sum(count) FROM gens_hourly WHERE service = ? AND hour >= ?',
+            (service, first_full_hour)
+        ).fetchone()[0]
+        return partial + (full or 0)
+
+    def import_text_logs(self, pattern=TEXT_LOG_PATTERN):
+        """One-time import of the free-text gen logs, skipped once it has run"""
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'text_log_imported'").fetchone():
+            return 0
+        imported = 0
+        rows = []
+        for path in sorted(glob.glob(pattern)):
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    match = LOG_LINE.match(line.rstrip('\n'))
+                    if not match:
+                        continue
+                    stamp, user_id, service, account = match.groups()
+                    ts = datetime.datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S').timestamp()
+                    rows.append((int(ts), int(user_id), service.lower(), account))
+                    if len(rows) >= 50000:
+                        self._write(rows)
+                        imported += len(rows)
+                        rows = []
+        if rows:
+            self._write(rows)
+            imported += len(rows)
+        with self.db.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('text_log_imported', ?)", (str(imported),))
+        return imported
+
+
+_history = None
+
+
+def get_history():
+    """Return the process-wide generation history store"""
+    global _history
+    if _history is None:
+        _history = HistoryStore(os.getenv('HISTORY_DB', HISTORY_DB))
+    return _history
@@ -0,0 +1,298 @@
+import bisect
+from array import array
+
+# Vouch leaderboard order statistics
+#
+# Users are ordered by vouch count, highest first, ties broken by user ID.
+# A Fenwick tree indexed by count holds how many users have each count, so
+# "how many users rank above count c" and "which count holds position p"
+# are O(log C) for the largest count C. Users sharing a count sit in a
+# SortedIds bucket, sorted array('Q') chunks with their own Fenwick tree
+# over chunk sizes, so a rank or a move within a bucket is O(log n) even
+# when most users share a count. Counts come from the vouch store; callers
+# pass the new count on every change and the board looks up the count it
+# holds, so a caller that can't know the previous count (another process
+# changed it in the shared database) can't leave a user in two buckets.
+
+CHUNK_SIZE = 512
+
+
+class SortedIds:
+    """Sorted user IDs with O(log n) rank, select, insert and remove
+
+    IDs live in array('Q') chunks of CHUNK_SIZE to 2 * CHUNK_SIZE entries, so
+    an insert or delete moves at most one chunk, and a Fenwick tree over the
+    chunk lengths turns a position into (chunk, offset) and back.
+    """
+
+    def __init__(self, ids=()):
+        ids = array('Q', ids)
+        self._chunks = [ids[i:i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE)]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+        self._len = len(ids)
+        self._rebuild()
+
+    def _rebuild(self):
+        """Linear-time Fenwick construction, after chunks were split or dropped"""
+        size = len(self._chunks)
+        tree = [0] + [len(chunk) for chunk in self._chunks]
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, chunk, delta):
+        tree = self._tree
+        i = chunk + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _before(self, chunk):
+        """IDs in the chunks before `chunk`"""
+        tree = self._tree
+        total = 0
+        while chunk > 0:
+            total += tree[chunk]
+            chunk -= chunk & -chunk
+        return total
+
+    def _locate(self, index):
+        """(chunk, offset) of a 0-based position"""
+        tree = self._tree
+        chunk = 0
+        step = 1 << ((len(tree) - 1).bit_length() - 1)
+        while step:
+            following = chunk + step
+            if following < len(tree) and tree[following] <= index:
+                chunk = following
+                index -= tree[following]
+            step >>= 1
+        return chunk, index
+
+    def index(self, user_id):
+        """0-based position of a user ID, -1 if absent"""
+        chunk = bisect.bisect_left(self._maxes, user_id)
+        if chunk == len(self._maxes):
+            return -1
+        ids = self._chunks[chunk]
+        offset = bisect.bisect_left(ids, user_id)
+        if ids[offset] != user_id:
+            return -1
+        return self._before(chunk) + offset
+
+    def add(self, user_id):
+        if not self._chunks:
+            self._chunks.append(array('Q', [user_id]))
+            self._maxes.append(user_id)
+            self._len = 1
+            self._rebuild()
+            return
+        chunk = min(bisect.bisect_left(self._maxes, user_id), len(self._chunks) - 1)
+        ids = self._chunks[chunk]
+        bisect.insort(ids, user_id)
+        self._maxes[chunk] = ids[-1]
+        self._len += 1
+        if len(ids) > 2 * CHUNK_SIZE:
+            self._chunks[chunk:chunk + 1] = [ids[:CHUNK_SIZE], ids[CHUNK_SIZE:]]
+            self._maxes[chunk:chunk + 1] = [ids[CHUNK_SIZE - 1], ids[-1]]
+            self._rebuild()
+        else:
+            self._add(chunk, 1)
+
+    def remove(self, user_id):
+        """Remove a user ID, returning False if it wasn't there"""
+        chunk = bisect.bisect_left(self._maxes, user_id)
+        if chunk == len(self._maxes):
+            return False
+        ids = self._chunks[chunk]
+        offset = bisect.bisect_left(ids, user_id)
+        if ids[offset] != user_id:
+            return False
+        del ids[offset]
+        self._len -= 1
+        if ids:
+            self._maxes[chunk] = ids[-1]
+            self._add(chunk, -1)
+        else:
+            del self._chunks[chunk]
+            del self._maxes[chunk]
+            self._rebuild()
+        return True
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._len:
+            raise IndexError(index)
+        chunk, offset = self._locate(index)
+        return self._chunks[chunk][offset]
+
+    def slice(self, start, stop):
+        """Yield the IDs at positions start to stop - 1"""
+        if start >= min(stop, self._len):
+            return
+        chunk, offset = self._locate(start)
+        remaining = min(stop, self._len) - start
+        while remaining > 0:
+            ids = self._chunks[chunk][offset:offset + remaining]
+            yield from ids
+            remaining -= len(ids)
+            chunk += 1
+            offset = 0
+
+    def __iter__(self):
+        for ids in self._chunks:
+            yield from ids
+
+    def __len__(self):
+        return self._len
+
+
+class Leaderboard:
+    """Rank and page queries over user vouch counts"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._tree = [0] * (size + 1)
+        self._buckets = {}
+        self._held = {}
+        self.total = 0
+
+    @classmethod
+    def build(cls, items):
+        """Build from (user_id, count) pairs in O(n log n) for the bucket sorts"""
+        grouped = {}
+        for user_id, count in items:
+            if count > 0:
+                grouped.setdefault(count, []).append(int(user_id))
+        size = 1024
+        while grouped and size < max(grouped):
+            size *= 2
+        board = cls(size)
+        tree = board._tree
+        for count, users in grouped.items():
+            board._held.update(dict.fromkeys(users, count))
+            board._buckets[count] = SortedIds(sorted(users))
+            tree[count] += len(users)
+            board.total += len(users)
+        # Linear-time Fenwick construction from the per-count totals
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        return board
+
+    def _grow(self, count):
+        size = self.size
+        while size < count:
+            size *= 2
+        if size == self.size:
+            return
+        totals = {c: len(users) for c, users in self._buckets.items()}
+        self.size = size
+        self._tree = [0] * (size + 1)
+        for c, n in totals.items():
+            self._add(c, n)
+
+    def _add(self, count, delta):
+        tree = self._tree
+        while count <= self.size:
+            tree[count] += delta
+            count += count & -count
+
+    def _prefix(self, count):
+        """Users with a count of at most `count`"""
+        tree = self._tree
+        total = 0
+        count = min(count, self.size)
+        while count > 0:
+            total += tree[count]
+            count -= count & -count
+        return total
+
+    def _count_at(self, ascending):
+        """Smallest count c with more than `ascending` users at or below it"""
+        tree = self._tree
+        position = 0
+        step = 1 << (self.size.bit_length() - 1)
+        while step:
+            following = position + step
+            if following <= self.size and tree[following] <= ascending:
+                position = following
+                ascending -= tree[following]
+            step >>= 1
+        return position + 1
+
+    def count(self, user_id):
+        """Vouch count the board holds for a user, 0 if unranked"""
+        return self._held.get(int(user_id), 0)
+
+    def position(self, user_id):
+        """0-based leaderboard position of a user, None if unranked"""
+        user_id = int(user_id)
+        count = self._held.get(user_id)
+        if count is None:
+            return None
+        return self.total - self._prefix(count) + self._buckets[count].index(user_id)
+
+    def update(self, user_id, new):
+        """Move a user to `new` vouches, returning the (first, last) positions that changed
+
+        `last` is None when every position from `first` on shifted, i.e. the
+        user joined or left the board.
+        """
+        user_id = int(user_id)
+        old = self._held.get(user_id, 0)
+        if old == new:
+            return None
+        before = self.position(user_id)
+        if before is not None:
+            del self._held[user_id]
+            bucket = self._buckets[old]
+            bucket.remove(user_id)
+            if not bucket:
+                del self._buckets[old]
+            self._add(old, -1)
+            self.total -= 1
+        after = None
+        if new > 0:
+            if new > self.size:
+                self._grow(new)
+            bucket = self._buckets.get(new)
+            if bucket is None:
+                bucket = self._buckets[new] = SortedIds()
+            bucket.add(user_id)
+            self._held[user_id] = new
+            self._add(new, 1)
+            self.total += 1
+            after = self.position(user_id)
+        if before is None or after is None:
+            first = before if after is None else after
+            return (first, None) if first is not None else None
+        return min(before, after), max(before, after)
+
+    def select(self, position):
+        """(user_id, count) at a 0-based position"""
+        if not 0 <= position < self.total:
+            raise IndexError(position)
+        count = self._count_at(self.total - 1 - position)
+        above = self.total - self._prefix(count)
+        return self._buckets[count][position - above], count
+
+    def page(self, number, size=10):
+        """(position, user_id, count) rows for a 0-based page"""
+        rows = []
+        position = number * size
+        end = min(position + size, self.total)
+        while position < end:
+            count = self._count_at(self.total - 1 - position)
+            bucket = self._buckets[count]
+            index = position - (self.total - self._prefix(count))
+            # Take the rest of this count's bucket before looking up the next count
+            for user_id in bucket.slice(index, index + end - position):
+                rows.append((position, user_id, count))
+                position += 1
+        return rows
+
+    def __len__(self):
+        return self.total
@@ -0,0 +1,177 @@
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import time
+
+from utils.metrics import get_metrics
+from utils.stock_store import get_registry
+
+# Background stock maintenance
+#
+# Claims only tombstone lines, so stock files keep growing until a service
+# is compacted. The compaction pass checks every service on an interval and
+# rewrites the ones whose dead share passed the threshold, in a worker
+# thread so the event loop and the stock I/O pool stay free.
+#
+# Snapshots write the live stock of every namespace plus registered state
+# (vouch counts) as gzip files under backups/<timestamp>/, built in a temp
+# directory and renamed into place, keeping only the newest few. Stock is
+# stored as plain `<service>.txt.gz` lines, so restoring one is gunzipping
+# it into a stock directory, where it gets imported like any dropped file.
+
+SNAPSHOT_DIR = 'backups'
+STAMP_FORMAT = '%Y%m%d-%H%M%S'
+
+
+class Maintenance:
+    """Runs compaction and snapshots on their intervals, never both at once"""
+
+    def __init__(self, directory=SNAPSHOT_DIR, compact_interval=300.0, min_ratio=0.5, min_dead=10000,
+                 snapshot_interval=21600.0, keep=24, level=6):
+        self.directory = directory
+        self.compact_interval = compact_interval
+        self.min_ratio = min_ratio
+        self.min_dead = min_dead
+        self.snapshot_interval = snapshot_interval
+        self.keep = keep
+        self.level = level
+        self.sources = {}
+        self._tasks = []
+        self._lock = None
+        self._current = None
+
+    def add_source(self, name, source):
+        """Include registered state as JSON in every snapshot
+
+        `source()` is called on the event loop and should only take a cheap
+        copy, returning a callable that builds the payload in the snapshot
+        thread.
+        """
+        self.sources[name] = source
+
+    def remove_source(self, name):
+        self.sources.pop(name, None)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._lock = asyncio.Lock()
+        if self.compact_interval > 0:
+            self._tasks.append(asyncio.create_task(self._every(self.compact_interval, self.compact)))
+        if self.snapshot_interval > 0:
+            self._tasks.append(asyncio.create_task(self._every(self.snapshot_interval, self.snapshot)))
+
+    async def _every(self, interval, job):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job()
+            except Exception as e:
+                # Keep the schedule going, a failed pass is retried on the next interval
+                print(f'Stock maintenance failed: {type(e).__name__}: {e}')
+
+    async def _run(self, func, *args):
+        """Run a blocking step in a thread that stop() waits for instead of abandoning mid-swap"""
+        self._current = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        return await asyncio.shield(self._current)
+
+    async def compact(self):
+        """Compact every service past the dead-space threshold, returning bytes reclaimed"""
+        registry = get_registry()
+        total = 0
+        async with self._lock:
+            for namespace in sorted(registry.namespaces(), key=str):
+                backend = registry.backend(namespace)
+                for service in backend.services():
+                    started = time.perf_counter()
+                    reclaimed = await self._run(backend.compact, service, self.min_ratio, self.min_dead)
+                    if reclaimed is None:
+                        continue
+                    elapsed = time.perf_counter() - started
+                    get_metrics().observe('stock_compaction_seconds', elapsed)
+                    get_metrics().inc('stock_compacted_bytes_total', reclaimed)
+                    print(f'Compacted {service} in {elapsed:.2f}s, reclaimed {reclaimed / 1e6:.1f} MB')
+                    total += reclaimed
+        return total
+
+    async def snapshot(self):
+        """Write a compressed snapshot of all stock and registered state, returning its path"""
+        # Registered state is copied on the loop so it can't change mid-copy
+        builders = {name: source() for name, source in self.sources.items()}
+        async with self._lock:
+            started = time.perf_counter()
+            path = await self._run(self._write_snapshot, builders)
+        get_metrics().observe('stock_snapshot_seconds', time.perf_counter() - started)
+        print(f'Wrote snapshot {path} in {time.perf_counter() - started:.2f}s')
+        return path
+
+    def _write_snapshot(self, builders):
+        registry = get_registry()
+        stamp = time.strftime(STAMP_FORMAT, time.gmtime())
+        final = os.path.join(self.directory, stamp)
+        tmp = os.path.join(self.directory, f'.{stamp}.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            for namespace in registry.namespaces():
+                backend = registry.backend(namespace)
+                directory = os.path.join(tmp, 'stock', os.path.relpath(registry.directory(namespace), registry.root))
+                os.makedirs(directory, exist_ok=True)
+                for service in backend.services():
+                    with gzip.open(os.path.join(directory, f'{service}.txt.gz'), 'wt', encoding='utf-8',
+                                   compresslevel=self.level) as f:
+                        for line in backend.iter_live(service):
+                            f.write(line + '\n')
+            for name, build in builders.items():
+                payload = build()
+                with gzip.open(os.path.join(tmp, f'{name}.gz'), 'wt', encoding='utf-8', compresslevel=self.level) as f:
+                    json.dump(payload, f, separators=(',', ':'))
+            os.replace(tmp, final)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self._prune()
+        return final
+
+    def snapshots(self):
+        """Completed snapshot directories, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if not name.startswith('.'))
+
+    def _prune(self):
+        # keep=0 keeps every snapshot
+        if self.keep <= 0:
+            return
+        for name in self.snapshots()[:-self.keep]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        # Let a compaction or snapshot in flight finish rather than leave temp files behind
+        if self._current is not None and not self._current.done():
+            try:
+                await self._current
+            except Exception as e:
+                print(f'Stock maintenance failed: {e}')
+
+
+_maintenance = None
+
+
+def get_maintenance():
+    """Return the process-wide maintenance runner"""
+    global _maintenance
+    if _maintenance is None:
+        _maintenance = Maintenance(
+            os.getenv('SNAPSHOT_DIR', SNAPSHOT_DIR),
+            compact_interval=float(os.getenv('STOCK_COMPACT_INTERVAL', '300')),
+            min_ratio=float(os.getenv('STOCK_COMPACT_RATIO', '0.5')),
+            min_dead=int(os.getenv('STOCK_COMPACT_MIN_DEAD', '10000')),
+            snapshot_interval=float(os.getenv('SNAPSHOT_INTERVAL', '21600')),
+            keep=int(os.getenv('SNAPSHOT_KEEP', '24'))
+        )
+    return _maintenance
@@ -0,0 +1,319 @@
+import asyncio
+import bisect
+import os
+import threading
+import time
+
+# In-process metrics
+#
+# Counters and latency histograms keyed by metric name and a sorted tuple of
+# label pairs. Recording is a dict lookup, a bisect and an add under one
+# lock (storage calls record from the I/O threads), cheap enough to leave on.
+# The registry renders the Prometheus text format, written periodically to a
+# file for node_exporter's textfile collector and optionally served over
+# HTTP for a direct scrape.
+
+METRICS_FILE = 'data/metrics.prom'
+
+# Seconds, from sub-millisecond storage calls up to slow DMs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms"""
+
+    def __init__(self, prefix='genbot'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._server = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def counter_totals(self, name, by=None):
+        """Counter values for `name` summed across labels, or grouped by the `by` label"""
+        totals = {}
+        with self._lock:
+            for (n, labels), value in self.counters.items():
+                if n == name:
+                    group = dict(labels).get(by) if by else None
+                    totals[group] = totals.get(group, 0) + value
+        return totals
+
+    def merged(self, name, by=None):
+        """Histograms for `name` merged across labels, or grouped by the `by` label"""
+        groups = {}
+        with self._lock:
+            for (n, labels), histogram in self.histograms.items():
+                if n != name:
+                    continue
+                group = dict(labels).get(by) if by else None
+                merged = groups.get(group)
+                if merged is None:
+                    merged = groups[group] = Histogram(histogram.buckets)
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+        return groups
+
+    def render(self):
+        """Prometheus text exposition of every metric"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(
+                ((key, list(h.counts), h.sum, h.count, h.buckets) for key, h in self.histograms.items()),
+                key=lambda item: item[0]
+            )
+        declared = set()
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in items:
+                full = f'{self.prefix}_{name}'
+                if full not in declared:
+                    declared.add(full)
+                    lines.append(f'# TYPE {full} {kind}')
+                lines.append(f'{full}{_format_labels(labels)} {value}')
+        for (name, labels), counts, total, count, buckets in histograms:
+            full = f'{self.prefix}_{name}'
+            if full not in declared:
+                declared.add(full)
+                lines.append(f'# TYPE {full} histogram')
+            cumulative = 0
+            for bound, n in zip(buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f'{full}_bucket{_format_labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{full}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{full}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    async def _watch_loop(self, interval):
+        """Record how late the loop wakes up from a sleep, i.e. how long callbacks block it"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - expected, 0.0)
+            self.observe('event_loop_lag_seconds', lag)
+            self.gauge('event_loop_lag_last_seconds', lag)
+
+    async def _export(self, path, interval):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.write_file, path)
+            except OSError as e:
+                print(f'Failed to write metrics to {path}: {e}')
+
+    async def _serve(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.render().encode('utf-8')
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                + f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('ascii')
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, path=None, export_interval=15.0, port=None, lag_interval=0.5):
+        """Start the loop lag probe, the exposition file writer and the optional endpoint"""
+        if self._tasks:
+            return
+        self.gauge('start_time_seconds', time.time())
+        self._tasks.append(asyncio.create_task(self._watch_loop(lag_interval)))
+        if path:
+            self._tasks.append(asyncio.create_task(self._export(path, export_interval)))
+        if port:
+            self._server = await asyncio.start_server(self._serve, os.getenv('METRICS_HOST', '127.0.0.1'), port)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+def _payload_bytes(result):
+    """Size of the account text a storage call returned"""
+    if result is None:
+        return 0
+    if isinstance(result, str):
+        return len(result)
+    if isinstance(result, (list, tuple)):
+        total = 0
+        for item in result:
+            total += len(item[1] if isinstance(item, tuple) else item)
+        return total
+    return 0
+
+
+class InstrumentedBackend:
+    """Stock backend proxy that counts and times each storage call"""
+
+    # Methods whose return value is account text read from storage
+    READS = frozenset(('claim', 'claim_many', 'reserve', 'peek'))
+    TIMED = frozenset((
+        'services', 'exists', 'create', 'clear', 'count', 'claim', 'claim_many', 'reserve',
+        'commit', 'release', 'add', 'peek', 'counts', 'warm', 'export_text', 'compact'
+    ))
+
+    def __init__(self, backend, metrics, store):
+        self.backend = backend
+        self.metrics = metrics
+        self.store = store
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name not in self.TIMED:
+            return attr
+        metrics = self.metrics
+        store = self.store
+        reads = name in self.READS
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            result = attr(*args, **kwargs)
+            metrics.observe('storage_op_seconds', time.perf_counter() - started, store=store, op=name)
+            metrics.inc('storage_ops_total', store=store, op=name)
+            if reads:
+                metrics.inc('storage_bytes_read_total', _payload_bytes(result), store=store)
+            elif name == 'add':
+                lines = args[1] if len(args) > 1 else kwargs.get('lines', ())
+                metrics.inc('storage_bytes_written_total', sum(len(line) + 1 for line in lines), store=store)
+            return result
+
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+def instrument_http(http, metrics):
+    """Time every Discord REST call by route template and outcome"""
+    request = http.request
+    if getattr(request, 'instrumented', False):
+        return
+
+    async def timed_request(route, **kwargs):
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, 'status', type(e).__name__))
+            raise
+        finally:
+            labels = {'method': route.method, 'route': route.path}
+            metrics.observe('api_request_seconds', time.perf_counter() - started, **labels)
+            metrics.inc('api_requests_total', status=status, **labels)
+
+    timed_request.instrumented = True
+    http.request = timed_request
+
+
+_metrics = None
+
+
+def get_metrics():
+    """Return the process-wide metrics registry"""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
@@ -0,0 +1,61 @@
+import discord
+
+# Shared button paginator
+#
+# Pages are rendered on demand by a callback, so a listing with hundreds of
+# pages only ever builds the embeds someone actually looks at. Button presses
+# edit the message in the interaction response, one API call per page turn.
+
+
+class Paginator(discord.ui.View):
+    """Previous/next buttons over pages produced by `render(page)`"""
+
+    def __init__(self, render, page_count, author_id=None, timeout=60.0):
+        super().__init__(timeout=timeout)
+        self.render = render
+        self.page_count = page_count
+        self.author_id = author_id
+        self.current_page = 0
+        self.message = None
+        self._update_buttons()
+
+    async def start(self, ctx):
+        """Send the first page, with buttons only when there is more than one"""
+        if self.page_count <= 1:
+            self.stop()
+            return await ctx.send(embed=self.render(0))
+        self.message = await ctx.send(embed=self.render(0), view=self)
+        return self.message
+
+    def _update_buttons(self):
+        self.on_previous.disabled = self.current_page == 0
+        self.on_next.disabled = self.current_page >= self.page_count - 1
+        self.page_label.label = f'{self.current_page + 1}/{self.page_count}'
+
+    async def _show(self, interaction, page):
+        self.current_page = page
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.render(page), view=self)
+
+    async def interaction_check(self, interaction):
+        # Only whoever ran the command turns its pages
+        return self.author_id is None or interaction.user.id == self.author_id
+
+    @discord.ui.button(emoji='⬅️', style=discord.ButtonStyle.secondary)
+    async def on_previous(self, interaction, button):
+        await self._show(interaction, max(self.current_page - 1, 0))
+
+    @discord.ui.button(label='1/1', style=discord.ButtonStyle.secondary, disabled=True)
+    async def page_label(self, interaction, button):
+        pass
+
+    @discord.ui.button(emoji='➡️', style=discord.ButtonStyle.secondary)
+    async def on_next(self, interaction, button):
+        await self._show(interaction, min(self.current_page + 1, self.page_count - 1))
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except discord.HTTPException:
+                pass
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import math
+import os
+import time
+
+from discord.ext import commands
+
+from utils.vouch_store import atomic_write
+
+# Token-bucket cooldowns and quotas
+#
+# Each command can have a per-user bucket, role overrides for that bucket
+# (the member's most generous role wins) and extra per-service buckets that
+# apply on top. Buckets live in a dict keyed by tuple and refill lazily, so
+# a check is a few dict lookups and float operations. Non-full buckets are
+# snapshotted periodically with wall-clock stamps so quotas survive restarts.
+#
+# A command costs one token per account it asks for (its `amount` argument,
+# 1 without one). The charge is remembered on the context so a command that
+# ends up delivering less, or nothing, can refund the difference.
+#
+# Limits file format (data/ratelimits.json), rates are [tokens, seconds]:
+#   {"gen": {"user": [10, 3600], "roles": {"<role id>": [5, 3600]},
+#            "services": {"netflix": [1, 86400]}}}
+
+LIMITS_FILE = 'data/ratelimits.json'
+SNAPSHOT_FILE = 'data/ratelimit_state.json'
+
+DEFAULT_LIMITS = {
+    'gen': {'user': [10, 3600]},
+    'stock': {'user': [5, 30]},
+}
+
+
+class QuotaExceeded(commands.CommandError):
+    """Raised before a command runs when one of its buckets is empty
+
+    `retry_after` is infinite when the request is bigger than the bucket.
+    """
+
+    def __init__(self, retry_after, scope):
+        self.retry_after = retry_after
+        self.scope = scope
+        if math.isinf(retry_after):
+            super().__init__(f'Rate limited ({scope}), request exceeds the limit')
+        else:
+            super().__init__(f'Rate limited ({scope}), retry in {retry_after:.0f}s')
+
+
+class RateLimiter:
+    """In-memory token buckets with periodic snapshots"""
+
+    def __init__(self, limits=None, path=SNAPSHOT_FILE, snapshot_interval=60.0):
+        self.limits = limits if limits is not None else DEFAULT_LIMITS
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self._buckets = {}
+        self._task = None
+        self.load()
+
+    def _rules(self, command, role_ids, service):
+        """Yield (bucket key suffix, rate, per, scope) for every bucket that applies"""
+        config = self.limits.get(command)
+        if not config:
+            return
+        user_rule = config.get('user')
+        roles = config.get('roles')
+        if roles:
+            for role_id in role_ids:
+                rule = roles.get(str(role_id))
+                if rule and (user_rule is None or rule[0] / rule[1] > user_rule[0] / user_rule[1]):
+                    user_rule = rule
+        if user_rule:
+            yield 'user', user_rule[0], user_rule[1], 'user'
+        services = config.get('services')
+        if services and service:
+            rule = services.get(service.lower())
+            if rule:
+                yield service.lower(), rule[0], rule[1], f'service {service.lower()}'
+
+    def hit(self, command, user_id, role_ids=(), service=None, now=None, cost=1):
+        """Consume `cost` tokens from every applicable bucket, or return seconds to wait"""
+        now = time.time() if now is None else now
+        pending = []
+        wait = 0.0
+        scope = None
+        for suffix, rate, per, rule_scope in self._rules(command, role_ids, service):
+            key = (command, suffix, user_id)
+            state = self._buckets.get(key)
+            tokens = rate if state is None else min(rate, state[0] + (now - state[1]) * rate / per)
+            if tokens < cost:
+                # A bucket never holds more than `rate`, a bigger request can't ever pass
+                needed = (cost - tokens) * per / rate if cost <= rate else math.inf
+                if needed > wait:
+                    wait, scope = needed, rule_scope
+            pending.append((key, tokens, rate, per))
+        if wait:
+            return wait, scope
+        # Only consume once every bucket has enough, remembering the rule that filled it
+        for key, tokens, rate, per in pending:
+            self._buckets[key] = (tokens - cost, now, rate, per)
+        return 0.0, None
+
+    def give_back(self, command, user_id, role_ids=(), service=None, cost=1, now=None):
+        """Return tokens taken by hit() to every applicable bucket"""
+        now = time.time() if now is None else now
+        for suffix, rate, per, _ in self._rules(command, role_ids, service):
+            key = (command, suffix, user_id)
+            state = self._buckets.get(key)
+            if state is not None:
+                tokens = min(rate, state[0] + (now - state[1]) * rate / per + cost)
+                self._buckets[key] = (tokens, now, rate, per)
+
+    async def enforce(self, ctx):
+        """before_invoke hook, runs once the arguments (and so the service and amount) are parsed"""
+        role_ids = [role.id for role in getattr(ctx.author, 'roles', ())]
+        arguments = command_arguments(ctx)
+        service = arguments.get('service')
+        amount = arguments.get('amount', 1)
+        cost = amount if isinstance(amount, int) and amount > 1 else 1
+        wait, scope = self.hit(ctx.command.qualified_name, ctx.author.id, role_ids, service, cost=cost)
+        if wait:
+            raise QuotaExceeded(wait, scope)
+        ctx.quota_charge = (ctx.command.qualified_name, ctx.author.id, role_ids, service, cost)
+
+    def refund(self, ctx, count=None):
+        """Give back `count` of the tokens enforce() charged a context (all by default)"""
+        charge = getattr(ctx, 'quota_charge', None)
+        if charge is None:
+            return
+        command, user_id, role_ids, service, cost = charge
+        count = cost if count is None else min(count, cost)
+        if count <= 0:
+            return
+        ctx.quota_charge = (command, user_id, role_ids, service, cost - count)
+        self.give_back(command, user_id, role_ids, service, count)
+
+    def prune(self, now=None):
+        """Forget buckets that have refilled completely under the rule that filled them"""
+        now = time.time() if now is None else now
+        full = [
+            key for key, (tokens, stamp, rate, per) in self._buckets.items()
+            if tokens + (now - stamp) * rate / per >= rate
+        ]
+        for key in full:
+            del self._buckets[key]
+
+    def _slowest_rule(self, command, suffix):
+        """Rule refilling slowest, for snapshots written before buckets kept their rule"""
+        config = self.limits.get(command) or {}
+        if suffix == 'user':
+            rules = [config['user']] if config.get('user') else []
+            rules += list((config.get('roles') or {}).values())
+            return min(rules, key=lambda r: r[0] / r[1], default=None)
+        return (config.get('services') or {}).get(suffix)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for entry in json.load(f):
+                    command, suffix, user_id, tokens, stamp = entry[:5]
+                    rule = entry[5:] or self._slowest_rule(command, suffix)
+                    if rule:
+                        self._buckets[(command, suffix, user_id)] = (tokens, stamp, rule[0], rule[1])
+        except (OSError, ValueError) as e:
+            print(f'Ignoring unreadable rate limit snapshot: {e}')
+
+    def _serialize(self):
+        self.prune()
+        data = [[*key, *state] for key, state in self._buckets.items()]
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def _write(self, data):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        atomic_write(self.path, data)
+
+    def snapshot(self):
+        self._write(self._serialize())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._snapshot_loop())
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            # Serialize on the loop so the dict can't change underneath us
+            data = self._serialize()
+            try:
+                await asyncio.to_thread(self._write, data)
+            except OSError as e:
+                print(f'Failed to snapshot rate limits: {e}')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await asyncio.to_thread(self._write, self._serialize())
+
+
+def command_arguments(ctx):
+    """Parsed arguments by name, prefix invocations pass them positionally in ctx.args"""
+    skip = 1 if ctx.cog is None else 2
+    arguments = dict(zip(ctx.command.clean_params, ctx.args[skip:]))
+    arguments.update(ctx.kwargs)
+    return arguments
+
+
+def load_limits(path=LIMITS_FILE):
+    """Read the limits file, falling back to the built-in defaults"""
+    if not os.path.exists(path):
+        return DEFAULT_LIMITS
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter"""
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(
+            load_limits(os.getenv('RATE_LIMITS_FILE', LIMITS_FILE)),
+            snapshot_interval=float(os.getenv('RATE_LIMIT_SNAPSHOT_SECONDS', '60'))
+        )
+    return _limiter
@@ -0,0 +1,83 @@
+import json
+import os
+
+from utils.claims import get_claim_engine
+from utils.stock_store import get_registry, normalize_service
+from utils.vouch_store import atomic_write
+
+# Low-stock alerts with hysteresis. Every code path that changes a count
+# reports the new value; a service alerts once when it falls to its
+# threshold and stays quiet until it has been restocked past the re-arm
+# level (threshold plus half of it, at least one more account).
+
+ALERTS_FILE = 'data/stock_alerts.json'
+
+
+class StockAlerts:
+    """Per-service low-stock thresholds and alert state, keyed by stock namespace"""
+
+    def __init__(self, path=ALERTS_FILE, default=0):
+        self.path = path
+        self.default = default
+        self.thresholds = {}
+        self._low = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.thresholds = json.load(f)
+
+    def threshold_for(self, service):
+        return self.thresholds.get(normalize_service(service), self.default)
+
+    def set_threshold(self, service, threshold):
+        """Set a service's threshold (0 disables alerts), a negative value goes back to the default"""
+        name = normalize_service(service)
+        if threshold >= 0:
+            self.thresholds[name] = threshold
+        else:
+            self.thresholds.pop(name, None)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        atomic_write(self.path, json.dumps(self.thresholds, separators=(',', ':')).encode('utf-8'))
+
+    @staticmethod
+    def rearm_level(threshold):
+        return threshold + max(1, threshold // 2)
+
+    def observe(self, namespace, service, count):
+        """Record a new count, returning 'low' or 'restocked' when the alert state flips"""
+        name = normalize_service(service)
+        threshold = self.threshold_for(name)
+        key = (namespace, name)
+        if key in self._low:
+            if count >= self.rearm_level(threshold):
+                self._low.discard(key)
+                return 'restocked'
+            return None
+        if threshold > 0 and count <= threshold:
+            self._low.add(key)
+            return 'low'
+        return None
+
+
+_alerts = None
+
+
+def _live_count(backend, service):
+    return backend.count(service) if backend.exists(service) else None
+
+
+async def notify_stock_change(bot, guild, service):
+    """Dispatch `stock_change` with a service's current count, after anything changed it"""
+    registry = get_registry()
+    backend = registry.backend(guild)
+    count = await get_claim_engine().run(_live_count, backend, service)
+    if count is None:
+        return
+    bot.dispatch('stock_change', registry.namespace(guild), normalize_service(service), count)
+
+
+def get_stock_alerts():
+    """Return the process-wide stock alert state"""
+    global _alerts
+    if _alerts is None:
+        _alerts = StockAlerts(default=int(os.getenv('STOCK_ALERT_DEFAULT', '10')))
+    return _alerts
@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from collections import defaultdict
+
+from utils.claims import get_claim_engine
+from utils.stock_store import get_backend, normalize_service
+
+# Streaming stock import
+#
+# Uploads are fed in chunks, split into lines, normalized and checked
+# against a persistent per-service hash index before being appended, so a
+# restock never holds the whole upload in memory and never rescans stock.
+#
+# The hash index (<service>.hashes) is an open-addressing table of 64-bit
+# line hashes, memory-mapped so a lookup touches one or two pages. It
+# covers every line stocked since the service was last cleared, including
+# lines that were already claimed, so handed-out accounts cannot be
+# restocked by accident.
+
+MAX_LINE_LENGTH = 1000
+BATCH_LINES = 10000
+
+HEADER = struct.Struct('<8sQQ')
+MAGIC = b'STKHASH1'
+SLOT = struct.Struct('<Q')
+
+
+def line_hash(line):
+    """64-bit hash of a normalized line, never 0 (0 marks an empty slot)"""
+    value = int.from_bytes(hashlib.blake2b(line, digest_size=8).digest(), 'little')
+    return value or 1
+
+
+class HashIndex:
+    """Persistent open-addressing set of 64-bit hashes backed by mmap"""
+
+    def __init__(self, path, capacity=1 << 16):
+        self.path = path
+        if not os.path.exists(path):
+            self._create(path, capacity)
+        self._open()
+
+    @staticmethod
+    def _create(path, capacity):
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, capacity, 0))
+            f.truncate(HEADER.size + capacity * SLOT.size)
+
+    def _open(self):
+        self._file = open(self.path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.capacity, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a stock hash index')
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    def _probe(self, value):
+        """Return (slot offset, found) for a hash"""
+        mask = self.capacity - 1
+        slot = value & mask
+        while True:
+            offset = HEADER.size + slot * SLOT.size
+            current = SLOT.unpack_from(self._map, offset)[0]
+            if current == 0 or current == value:
+                return offset, current == value
+            slot = (slot + 1) & mask
+
+    def __contains__(self, value):
+        return self._probe(value)[1]
+
+    def add(self, value):
+        """Insert a hash, returning False if it was already present"""
+        offset, found = self._probe(value)
+        if found:
+            return False
+        SLOT.pack_into(self._map, offset, value)
+        self.count += 1
+        if self.count * 2 > self.capacity:
+            self._grow()
+        return True
+
+    def _grow(self):
+        tmp_path = f'{self.path}.tmp'
+        self._create(tmp_path, self.capacity * 2)
+        bigger = HashIndex(tmp_path)
+        end = HEADER.size + self.capacity * SLOT.size
+        step = SLOT.size * 65536
+        for start in range(HEADER.size, end, step):
+            for (value,) in SLOT.iter_unpack(self._map[start:min(start + step, end)]):
+                if value:
+                    bigger.add(value)
+        bigger.flush()
+        bigger.close()
+        self.close()
+        os.replace(tmp_path, self.path)
+        self._open()
+
+    def flush(self):
+        HEADER.pack_into(self._map, 0, MAGIC, self.capacity, self.count)
+        self._map.flush()
+
+
+class ImportResult:
+    """Counters reported back to the admin who ran stock_add"""
+
+    def __init__(self):
+        self.added = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+
+class ImportJob:
+    """Feeds raw upload chunks through normalize, dedupe and append"""
+
+    def __init__(self, backend, service, index):
+        self.backend = backend
+        self.service = service
+        self.index = index
+        self.result = ImportResult()
+        self._remainder = b''
+        self._skipping = False
+        self._batch = []
+        self._hashes = set()
+        # Held by every step, a cancelled import may still have one running in the pool
+        self._lock = threading.Lock()
+
+    def feed(self, chunk):
+        with self._lock:
+            self._feed(chunk)
+
+    def _feed(self, chunk):
+        if self._skipping:
+            # Still inside an overlong line, drop everything up to its newline
+            end = chunk.find(b'\n')
+            if end < 0:
+                return
+            chunk = chunk[end + 1:]
+            self._skipping = False
+        lines = (self._remainder + chunk).split(b'\n')
+        self._remainder = lines.pop()
+        # A single unterminated line can't grow without bound
+        if len(self._remainder) > MAX_LINE_LENGTH * 4:
+            self.result.rejected += 1
+            self._remainder = b''
+            self._skipping = True
+        for line in lines:
+            self._line(line)
+
+    def _line(self, raw):
+        raw = raw.strip()
+        if not raw:
+            return
+        try:
+            line = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            self.result.rejected += 1
+            return
+        if len(line) > MAX_LINE_LENGTH or not line.replace('\t', ' ').isprintable():
+            self.result.rejected += 1
+            return
+        value = line_hash(raw)
+        if value in self._hashes or value in self.index:
+            self.result.duplicates += 1
+            return
+        self._hashes.add(value)
+        self._batch.append(line)
+        if len(self._batch) >= BATCH_LINES:
+            self._commit()
+
+    def _commit(self):
+        if self._batch:
+            self.result.added += self.backend.add(self.service, self._batch)
+            # Only index lines that made it into stock, a failed write leaves them importable
+            for value in self._hashes:
+                self.index.add(value)
+            self._batch = []
+            self._hashes = set()
+        self.index.flush()
+
+    def finish(self):
+        with self._lock:
+            if not self._skipping:
+                self._line(self._remainder)
+            self._remainder = b''
+            self._skipping = False
+            self._commit()
+            return self.result
+
+    def close(self):
+        """Close the index once no step is using it"""
+        with self._lock:
+            self.index.close()
+
+
+class StockImporter:
+    """Serializes imports per service and opens their hash indexes
+
+    Indexes live next to the stock they cover, so every stock namespace has
+    its own; imports are locked per (backend directory, service). An index
+    is only open for the length of one import job, so idle services and
+    namespaces hold no descriptors or mappings outside the stock fd budget.
+    """
+
+    def __init__(self, backend, engine):
+        self.backend = backend
+        self.engine = engine
+        self._locks = defaultdict(asyncio.Lock)
+
+    def _index_path(self, backend, name):
+        return os.path.join(backend.directory, f'{name}.hashes')
+
+    def _index(self, backend, name):
+        """Open a service's hash index, building it from existing stock once
+
+        The caller owns the returned index and must close it.
+        """
+        path = self._index_path(backend, name)
+        missing = not os.path.exists(path)
+        index = HashIndex(path)
+        if missing:
+            try:
+                for line in backend.iter_lines(name):
+                    line = line.strip().encode('utf-8')
+                    if line:
+                        index.add(line_hash(line))
+                index.flush()
+            except BaseException:
+                # A half-built index would let existing stock be imported again
+                index.close()
+                os.remove(path)
+                raise
+        return index
+
+    async def import_chunks(self, service, chunks, backend=None):
+        """Import an async iterator of byte chunks into a service"""
+        backend = backend or self.backend
+        name = normalize_service(service)
+        async with self._locks[backend.directory, name]:
+            job = ImportJob(backend, name, await self.engine.run(self._index, backend, name))
+            try:
+                async for chunk in chunks:
+                    await self.engine.run(job.feed, chunk)
+                return await self.engine.run(job.finish)
+            finally:
+                await self.engine.run(job.close)
+
+    def _import_file(self, backend, name, path):
+        # Whichever process renames the file first owns the import
+        claimed_path = f'{path}.importing.{os.getpid()}'
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            return None
+        job = ImportJob(backend, name, self._index(backend, name))
+        try:
+            with open(claimed_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    job.feed(chunk)
+            result = job.finish()
+        finally:
+            job.close()
+        os.replace(claimed_path, path + '.imported')
+        print(f'Imported {result.added} accounts into {name} from {path} '
+              f'({result.duplicates} duplicates, {result.rejected} rejected)')
+        return result
+
+    async def import_file(self, service, path, backend=None):
+        """Import a text file dropped into a stock directory, None if it was already taken"""
+        backend = backend or self.backend
+        name = normalize_service(service)
+        async with self._locks[backend.directory, name]:
+            return await self.engine.run(self._import_file, backend, name, path)
+
+    def _reset(self, backend, name):
+        path = self._index_path(backend, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    async def reset(self, service, backend=None):
+        """Forget the hash index of a cleared service"""
+        backend = backend or self.backend
+        name = normalize_service(service)
+        async with self._locks[backend.directory, name]:
+            await self.engine.run(self._reset, backend, name)
+
+
+_importer = None
+
+
+def get_importer():
+    """Return the process-wide stock importer"""
+    global _importer
+    if _importer is None:
+        _importer = StockImporter(get_backend(), get_claim_engine())
+    return _importer
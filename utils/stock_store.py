@@ -0,0 +1,1190 @@
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from utils.db import Database
+from utils.metrics import InstrumentedBackend, get_metrics
+
+# Stock storage backends
+#
+# Use the sqlite backend whenever more than one bot process shares a stock
+# directory: the indexed and text backends keep state in process memory.
+#
+# The indexed backend keeps every service in two files:
+#   <service>.dat - append-only account lines, newline terminated
+#   <service>.idx - one fixed-size record per line (offset, length, state)
+# Claims flip a single state byte in the index (a tombstone) instead of
+# rewriting the whole file, and the set of live slots is kept in memory so a
+# random claim, a count and an append only touch a few bytes on disk.
+# Tombstoned lines are dropped later by compact(), run in the background by
+# utils/maintenance.py once they make up enough of a service.
+
+STOCK_DIR = 'stock'
+
+RECORD = struct.Struct('<QIB3x')
+STATE_OFFSET = 12
+LIVE = 0
+CLAIMED = 1
+
+READ_CHUNK = 1 << 20
+
+# Reservation tokens carry the compaction epoch above the slot number, so a
+# token handed out before slots were renumbered is never mistaken for a new one
+TOKEN_SHIFT = 40
+SLOT_MASK = (1 << TOKEN_SHIFT) - 1
+
+
+def normalize_service(service):
+    """Normalize a service name to its on-disk key"""
+    return service.strip().lower()
+
+
+def count_lines(path):
+    """Count lines with a chunked byte scan instead of building line objects"""
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                break
+            count += chunk.count(b'\n')
+            last = chunk[-1:]
+    # A final line without a trailing newline still counts
+    return count + (last != b'\n')
+
+
+def stat_key(path):
+    """Cheap change detector for files edited outside the bot"""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class StockBackend:
+    """Interface shared by all stock backends"""
+
+    def services(self):
+        raise NotImplementedError
+
+    def exists(self, service):
+        raise NotImplementedError
+
+    def create(self, service):
+        raise NotImplementedError
+
+    def clear(self, service):
+        raise NotImplementedError
+
+    def count(self, service):
+        raise NotImplementedError
+
+    def claim(self, service):
+        raise NotImplementedError
+
+    def claim_many(self, service, count):
+        """Claim up to `count` random lines in one storage operation"""
+        accounts = []
+        for _ in range(count):
+            account = self.claim(service)
+            if account is None:
+                break
+            accounts.append(account)
+        return accounts
+
+    def reserve(self, service, count):
+        """Take up to `count` lines out of the pool as (token, line) pairs pending commit"""
+        return [(account, account) for account in self.claim_many(service, count)]
+
+    def commit(self, service, tokens):
+        """Make reservations permanent"""
+
+    def release(self, service, tokens):
+        """Return reserved lines to the pool"""
+        # Plain text has no reservation state, the lines were already removed
+        self.add(service, tokens)
+
+    def add(self, service, lines):
+        raise NotImplementedError
+
+    def peek(self, service, limit):
+        raise NotImplementedError
+
+    def iter_lines(self, service):
+        """Stream every line stored for a service, including claimed ones where kept"""
+        yield from self.peek(service, None)
+
+    def counts(self):
+        """Return a {service: count} table covering every service"""
+        return {service: self.count(service) for service in self.services()}
+
+    def warm(self):
+        """Fill any in-memory state up front so the first command does not pay for it"""
+        return self.counts()
+
+    def compact(self, service, min_ratio=0.5, min_dead=10000):
+        """Drop claimed lines from storage, returning bytes reclaimed or None if not needed"""
+        return None
+
+    def iter_live(self, service):
+        """Stream the live lines of a service for a snapshot"""
+        yield from self.peek(service, None)
+
+    def import_text(self, service, path):
+        """Take in a plain text file dropped into the stock directory
+
+        Returns how many accounts were added, or None when the backend reads
+        `.txt` files in place and there is nothing to import.
+        """
+        return None
+
+    def export_text(self, service, path):
+        """Write the live stock of a service to a plain text file"""
+        lines = self.peek(service, None)
+        with open(path, 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line + '\n')
+        return len(lines)
+
+
+class TextStockBackend(StockBackend):
+    """Legacy backend: one plain `<service>.txt` file per service"""
+
+    def __init__(self, directory=STOCK_DIR):
+        self.directory = directory
+        self._counts = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, service):
+        return os.path.join(self.directory, f'{normalize_service(service)}.txt')
+
+    def _lock(self, service):
+        """Per-service lock around every read-modify-write, claims run on several I/O threads"""
+        name = normalize_service(service)
+        with self._locks_lock:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = threading.Lock()
+        return lock
+
+    def _rewrite(self, service, lines):
+        """Replace a service's file via a temp file, readers see the old or the new file, never half of one"""
+        path = self._path(service)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(line + '\n' for line in lines)
+        os.replace(tmp_path, path)
+
+    def _read(self, service):
+        path = self._path(service)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line.rstrip('\r\n') for line in f if line.strip()]
+
+    def services(self):
+        return sorted(f[:-4] for f in os.listdir(self.directory) if f.endswith('.txt'))
+
+    def exists(self, service):
+        return os.path.exists(self._path(service))
+
+    def _remember(self, service, count):
+        """Record a count we just produced ourselves, keyed by the file's new stat"""
+        self._counts[normalize_service(service)] = (count, stat_key(self._path(service)))
+
+    def create(self, service):
+        with self._lock(service):
+            if self.exists(service):
+                return False
+            self._rewrite(service, [])
+            self._remember(service, 0)
+            return True
+
+    def clear(self, service):
+        with self._lock(service):
+            count = self.count(service)
+            self._rewrite(service, [])
+            self._remember(service, 0)
+            return count
+
+    def count(self, service):
+        name = normalize_service(service)
+        path = self._path(name)
+        try:
+            key = stat_key(path)
+        except FileNotFoundError:
+            self._counts.pop(name, None)
+            return 0
+        cached = self._counts.get(name)
+        if cached and cached[1] == key:
+            return cached[0]
+        # Unknown or edited outside the bot, recount once
+        count = count_lines(path)
+        self._counts[name] = (count, key)
+        return count
+
+    def claim(self, service):
+        accounts = self.claim_many(service, 1)
+        return accounts[0] if accounts else None
+
+    def claim_many(self, service, count):
+        with self._lock(service):
+            accounts = self._read(service)
+            if not accounts:
+                return []
+            claimed = [accounts.pop(random.randrange(len(accounts))) for _ in range(min(count, len(accounts)))]
+            self._rewrite(service, accounts)
+            self._remember(service, len(accounts))
+        return [account.strip() for account in claimed]
+
+    def add(self, service, lines):
+        lines = [line.strip() for line in lines if line.strip()]
+        path = self._path(service)
+        with self._lock(service):
+            before = self.count(service)
+            # Never glue the first new line onto an unterminated last line
+            prefix = ''
+            if before and os.path.getsize(path):
+                with open(path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    prefix = '' if f.read(1) == b'\n' else '\n'
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(prefix)
+                f.writelines(line + '\n' for line in lines)
+            self._remember(service, before + len(lines))
+        return len(lines)
+
+    def peek(self, service, limit):
+        if limit is None:
+            return self._read(service)
+        # Stop reading as soon as we have enough lines
+        accounts = []
+        for line in self.iter_lines(service):
+            if len(accounts) >= limit:
+                break
+            accounts.append(line)
+        return accounts
+
+    def iter_lines(self, service):
+        path = self._path(service)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+class HandlePool:
+    """LRU of stores with open files, closing the least recently used past a descriptor budget"""
+
+    def __init__(self, budget=512):
+        self.budget = budget
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self, store):
+        """Mark a store as just used, closing idle ones if it pushed us over budget"""
+        with self._lock:
+            self._open[store] = None
+            self._open.move_to_end(store)
+            # Two descriptors per store, the data file and the index
+            excess = len(self._open) - max(self.budget // 2, 1)
+            if excess <= 0:
+                return
+            for victim in list(self._open):
+                if excess <= 0:
+                    break
+                # Never wait on a busy store, it may be the one waiting on us
+                if victim is not store and victim.close_files(blocking=False):
+                    del self._open[victim]
+                    excess -= 1
+
+    def forget(self, store):
+        with self._lock:
+            self._open.pop(store, None)
+
+    def __len__(self):
+        return len(self._open)
+
+
+class ServiceStore:
+    """Append-only data file plus offset index for a single service"""
+
+    def __init__(self, directory, name, fsync=False, pool=None):
+        self.name = name
+        self.fsync = fsync
+        self.pool = pool
+        self.data_path = os.path.join(directory, f'{name}.dat')
+        self.index_path = os.path.join(directory, f'{name}.idx')
+        self.lock = threading.Lock()
+        self._recover()
+        for path in (self.data_path, self.index_path):
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+        self._data = None
+        self._index = None
+        self._files()
+        self._live = array('Q')
+        self._reserved = set()
+        self.dead = 0
+        self.epoch = 0
+        self._forward = {}
+        self._compacting = None
+        self._load()
+
+    def _recover(self):
+        """Finish or roll back a compaction interrupted by a crash"""
+        data_tmp = self.data_path + '.compact'
+        index_tmp = self.index_path + '.compact'
+        if os.path.exists(index_tmp):
+            # Never reached the commit point, the originals are intact
+            for path in (index_tmp, data_tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+        elif os.path.exists(data_tmp):
+            # The compacted index is already in place, its data file must follow
+            os.replace(data_tmp, self.data_path)
+
+    def _load(self):
+        """Build the in-memory list of live slots from the index file"""
+        self._index.seek(0)
+        slot = 0
+        chunk_size = RECORD.size * (READ_CHUNK // RECORD.size)
+        while True:
+            chunk = self._index.read(chunk_size)
+            if not chunk:
+                break
+            usable = len(chunk) - len(chunk) % RECORD.size
+            for _, _, state in RECORD.iter_unpack(chunk[:usable]):
+                if state == LIVE:
+                    self._live.append(slot)
+                else:
+                    self.dead += 1
+                slot += 1
+            if usable != len(chunk):
+                # Torn record from an interrupted append, drop it
+                self._index.truncate(slot * RECORD.size)
+                break
+
+    def _files(self):
+        """Reopen the data and index files if the pool closed them, caller holds the lock"""
+        if self._data is None:
+            self._data = open(self.data_path, 'r+b')
+            self._index = open(self.index_path, 'r+b')
+        if self.pool is not None:
+            self.pool.touch(self)
+
+    def close_files(self, blocking=True):
+        """Close the file handles but keep the in-memory state, reservations included"""
+        if not self.lock.acquire(blocking):
+            return False
+        try:
+            if self._data is not None:
+                self._data.close()
+                self._index.close()
+                self._data = None
+                self._index = None
+        finally:
+            self.lock.release()
+        return True
+
+    def close(self):
+        self.close_files()
+        if self.pool is not None:
+            self.pool.forget(self)
+
+    def count(self):
+        return len(self._live)
+
+    def dead_ratio(self):
+        total = self.dead + len(self._live) + len(self._reserved)
+        return self.dead / total if total else 0.0
+
+    def _slot(self, token):
+        """Current slot of a reservation token, None once it no longer applies"""
+        if token >> TOKEN_SHIFT == self.epoch:
+            return token & SLOT_MASK
+        return self._forward.pop(token, None)
+
+    def _read_record(self, slot):
+        self._index.seek(slot * RECORD.size)
+        return RECORD.unpack(self._index.read(RECORD.size))
+
+    def _read_line(self, offset, length):
+        self._data.seek(offset)
+        return self._data.read(length).decode('utf-8')
+
+    def append(self, lines):
+        """Append lines, returning how many were stored"""
+        encoded = [line.strip().encode('utf-8') for line in lines]
+        encoded = [line for line in encoded if line]
+        if not encoded:
+            return 0
+        with self.lock:
+            self._files()
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            self._index.seek(0, os.SEEK_END)
+            first_slot = self._index.tell() // RECORD.size
+            records = bytearray()
+            for line in encoded:
+                records += RECORD.pack(offset, len(line), LIVE)
+                offset += len(line) + 1
+            self._data.write(b'\n'.join(encoded) + b'\n')
+            self._data.flush()
+            self._index.write(records)
+            self._index.flush()
+            self._live.extend(range(first_slot, first_slot + len(encoded)))
+        return len(encoded)
+
+    def claim(self):
+        """Remove and return a random live line, or None when empty"""
+        accounts = self.claim_many(1)
+        return accounts[0] if accounts else None
+
+    def claim_many(self, count):
+        """Remove and return up to `count` random live lines"""
+        reserved = self.reserve_many(count)
+        self.commit_many([slot for slot, _ in reserved])
+        return [line for _, line in reserved]
+
+    def reserve_many(self, count):
+        """Pull up to `count` random slots out of the live list without touching disk"""
+        reserved = []
+        with self.lock:
+            self._files()
+            for _ in range(min(count, len(self._live))):
+                pos = random.randrange(len(self._live))
+                slot = self._live[pos]
+                self._live[pos] = self._live[-1]
+                self._live.pop()
+                offset, length, _ = self._read_record(slot)
+                self._reserved.add(slot)
+                reserved.append(((self.epoch << TOKEN_SHIFT) | slot, self._read_line(offset, length)))
+        return reserved
+
+    def commit_many(self, tokens):
+        """Tombstone reserved slots with a single flush"""
+        with self.lock:
+            self._files()
+            committed = 0
+            for token in tokens:
+                slot = self._slot(token)
+                if slot not in self._reserved:
+                    # Released, or the service was cleared since
+                    continue
+                self._reserved.discard(slot)
+                self._index.seek(slot * RECORD.size + STATE_OFFSET)
+                self._index.write(bytes((CLAIMED,)))
+                if self._compacting is not None:
+                    # The copy may have read this slot as live
+                    self._compacting.append(slot)
+                committed += 1
+            self.dead += committed
+            self._index.flush()
+            if self.fsync:
+                os.fsync(self._index.fileno())
+        return committed
+
+    def release_many(self, tokens):
+        """Put reserved slots back into the live list, O(1) each and no disk write"""
+        with self.lock:
+            for token in tokens:
+                slot = self._slot(token)
+                if slot in self._reserved:
+                    self._reserved.discard(slot)
+                    self._live.append(slot)
+
+    def _scan(self, limit=None):
+        """Yield live (offset, length) spans in file order, caller holds the lock"""
+        found = 0
+        position = 0
+        while limit is None or found < limit:
+            self._index.seek(position)
+            chunk = self._index.read(RECORD.size * 4096)
+            if len(chunk) < RECORD.size:
+                return
+            chunk = chunk[:len(chunk) - len(chunk) % RECORD.size]
+            position += len(chunk)
+            for offset, length, state in RECORD.iter_unpack(chunk):
+                if state != LIVE:
+                    continue
+                yield offset, length
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def peek(self, limit):
+        """Return up to `limit` live lines in file order without claiming them"""
+        with self.lock:
+            self._files()
+            spans = list(self._scan(limit))
+            return [self._read_line(offset, length) for offset, length in spans]
+
+    def iter_data(self):
+        """Stream every line in the data file, claimed or not"""
+        position = 0
+        remainder = b''
+        epoch = self.epoch
+        while True:
+            with self.lock:
+                self._files()
+                if self.epoch != epoch:
+                    # Compacted or cleared underneath us, start over (callers only collect)
+                    epoch = self.epoch
+                    position = 0
+                    remainder = b''
+                self._data.seek(position)
+                chunk = self._data.read(READ_CHUNK)
+            if not chunk:
+                break
+            position += len(chunk)
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', errors='replace')
+
+    def export_text(self, path):
+        """Stream every live line to a plain text file"""
+        written = 0
+        with self.lock, open(path, 'w', encoding='utf-8') as out:
+            self._files()
+            for offset, length in self._scan():
+                out.write(self._read_line(offset, length) + '\n')
+                written += 1
+        return written
+
+    def clear(self):
+        """Drop every line, returning how many live lines were removed"""
+        with self.lock:
+            self._files()
+            count = len(self._live)
+            self._data.truncate(0)
+            self._index.truncate(0)
+            self._data.flush()
+            self._index.flush()
+            self._live = array('Q')
+            self._reserved = set()
+            self.dead = 0
+            # Outstanding tokens and any compaction in flight no longer apply
+            self.epoch += 1
+            self._forward = {}
+            self._compacting = None
+            return count
+
+    def iter_live(self):
+        """Stream live lines from separate handles, never holding the lock"""
+        with self.lock:
+            self._files()
+            end = os.fstat(self._index.fileno()).st_size
+        with open(self.index_path, 'rb') as index, open(self.data_path, 'rb') as data:
+            for records in self._record_chunks(index, end):
+                live = [(offset, length) for offset, length, state in records if state == LIVE]
+                if live:
+                    blob, start = self._read_span(data, live)
+                    for offset, length in live:
+                        yield blob[offset - start:offset - start + length].decode('utf-8', errors='replace')
+
+    @staticmethod
+    def _record_chunks(index, end):
+        """Yield lists of index records up to byte `end`, a chunk at a time"""
+        chunk_size = RECORD.size * (READ_CHUNK // RECORD.size // 16)
+        position = 0
+        while position < end:
+            chunk = index.read(min(chunk_size, end - position))
+            if len(chunk) < RECORD.size:
+                return
+            chunk = chunk[:len(chunk) - len(chunk) % RECORD.size]
+            position += len(chunk)
+            yield list(RECORD.iter_unpack(chunk))
+
+    @staticmethod
+    def _read_span(data, spans):
+        """Read the data covering ascending (offset, length) spans in one sequential read"""
+        start = spans[0][0]
+        data.seek(start)
+        return data.read(spans[-1][0] + spans[-1][1] - start), start
+
+    def compact(self):
+        """Rewrite the files without claimed lines, returning the bytes reclaimed
+
+        The copy runs on separate handles without the lock, so claims carry on
+        meanwhile. Only the swap holds it: it copies lines appended during the
+        copy, applies claims committed during it and renumbers the live and
+        reserved slots. Outstanding reservation tokens are forwarded to their
+        new slots.
+        """
+        with self.lock:
+            if self._compacting is not None or not self.dead:
+                return 0
+            self._files()
+            end_slot = os.fstat(self._index.fileno()).st_size // RECORD.size
+            reserved_before = set(self._reserved)
+            committed = self._compacting = []
+            before = os.fstat(self._data.fileno()).st_size + end_slot * RECORD.size
+        data_tmp = self.data_path + '.compact'
+        index_tmp = self.index_path + '.compact'
+        try:
+            with open(data_tmp, 'wb') as data_out, open(index_tmp, 'wb') as index_out:
+                kept, live = self._copy_live(end_slot, reserved_before, data_out, index_out)
+                data_out.flush()
+                index_out.flush()
+                os.fsync(data_out.fileno())
+                os.fsync(index_out.fileno())
+                with self.lock:
+                    if self._compacting is not committed:
+                        # Cleared while copying
+                        return 0
+                    replaced = self._swap(end_slot, kept, live, reserved_before, committed, data_out, index_out)
+                    after = os.fstat(self._data.fileno()).st_size + os.fstat(self._index.fileno()).st_size
+            # Freeing the old files' blocks can take a while, do it without the lock
+            for f in replaced:
+                f.close()
+            return before - after
+        finally:
+            with self.lock:
+                if self._compacting is committed:
+                    self._compacting = None
+            for path in (index_tmp, data_tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _copy_live(self, end_slot, reserved_before, data_out, index_out):
+        """Copy the slots below end_slot that are live on disk into the new files"""
+        kept = array('Q')
+        live = array('Q')
+        offset = 0
+        slot = 0
+        with open(self.index_path, 'rb') as index, open(self.data_path, 'rb') as data:
+            for records in self._record_chunks(index, end_slot * RECORD.size):
+                spans = []
+                for record_offset, length, state in records:
+                    if state == LIVE:
+                        spans.append((record_offset, length))
+                        if slot not in reserved_before:
+                            live.append(len(kept))
+                        kept.append(slot)
+                    slot += 1
+                if not spans:
+                    continue
+                blob, start = self._read_span(data, spans)
+                lines = []
+                packed = bytearray()
+                for record_offset, length in spans:
+                    lines.append(blob[record_offset - start:record_offset - start + length])
+                    packed += RECORD.pack(offset, length, LIVE)
+                    offset += length + 1
+                data_out.write(b'\n'.join(lines) + b'\n')
+                index_out.write(packed)
+        return kept, live
+
+    def _swap(self, end_slot, kept, live, reserved_before, committed, data_out, index_out):
+        """Fold changes made during the copy into the new files and switch to them, caller holds the lock"""
+        self._files()
+        base = len(kept)
+
+        def remap(slot):
+            if slot >= end_slot:
+                return base + slot - end_slot
+            i = bisect_left(kept, slot)
+            return i if i < base and kept[i] == slot else None
+
+        # Lines appended while copying, carried over whole with their states
+        self._index.seek(end_slot * RECORD.size)
+        tail = list(RECORD.iter_unpack(self._index.read()))
+        if tail:
+            first = tail[0][0]
+            shift = data_out.tell() - first
+            self._data.seek(first)
+            data_out.write(self._data.read())
+            packed = bytearray()
+            for i, (offset, length, state) in enumerate(tail):
+                packed += RECORD.pack(offset + shift, length, state)
+                if state == LIVE and end_slot + i not in self._reserved:
+                    live.append(base + i)
+            index_out.write(packed)
+
+        # Claims committed while copying, the copy may have taken them as live
+        committed_set = set(committed)
+        for slot in committed_set:
+            new = remap(slot)
+            if new is not None and slot < end_slot:
+                index_out.seek(new * RECORD.size + STATE_OFFSET)
+                index_out.write(bytes((CLAIMED,)))
+
+        # `live` is ascending, so slots reserved or claimed since the copy started
+        # are found by bisection and swapped out from the end
+        taken = [remap(slot) for slot in (self._reserved | committed_set)
+                 if slot < end_slot and slot not in reserved_before]
+        positions = []
+        for new in taken:
+            if new is None:
+                continue
+            i = bisect_left(live, new)
+            if i < len(live) and live[i] == new:
+                positions.append(i)
+        for i in sorted(positions, reverse=True):
+            live[i] = live[-1]
+            live.pop()
+        # Reserved when the copy started and released since
+        for slot in reserved_before:
+            if slot not in self._reserved and slot not in committed_set:
+                new = remap(slot)
+                if new is not None:
+                    live.append(new)
+
+        # Only tokens still outstanding carry over: a reserved slot keeps the token
+        # it was forwarded under, slots reserved this epoch get their epoch token
+        forward = {token: remap(slot) for token, slot in self._forward.items() if slot in self._reserved}
+        forwarded = set(self._forward.values())
+        for slot in self._reserved:
+            if slot not in forwarded:
+                forward[(self.epoch << TOKEN_SHIFT) | slot] = remap(slot)
+        reserved = {remap(slot) for slot in self._reserved}
+
+        data_out.flush()
+        index_out.flush()
+        os.fsync(data_out.fileno())
+        os.fsync(index_out.fileno())
+        # The index rename is the commit point, see _recover()
+        os.replace(self.index_path + '.compact', self.index_path)
+        os.replace(self.data_path + '.compact', self.data_path)
+        replaced = (self._data, self._index)
+        self._data = None
+        self._index = None
+        self._files()
+
+        self._live = live
+        self._reserved = reserved
+        self._forward = forward
+        self.epoch += 1
+        self.dead = base + len(tail) - len(live) - len(reserved)
+        return replaced
+
+
+class IndexedStockBackend(StockBackend):
+    """Backend storing each service as an append-only data file plus index"""
+
+    def __init__(self, directory=STOCK_DIR, fsync=False, pool=None):
+        self.directory = directory
+        self.fsync = fsync
+        self.pool = pool
+        self._stores = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Service names are listed once, lookups never touch the filesystem
+        self._names = {f[:-4] for f in os.listdir(directory) if f.endswith('.idx')}
+        self.import_legacy()
+
+    def import_legacy(self):
+        """Import any plain `<service>.txt` files that have no index yet"""
+        imported = {}
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.txt'):
+                service = filename[:-4]
+                imported[service] = self.import_text(service, os.path.join(self.directory, filename))
+        return imported
+
+    def import_text(self, service, path):
+        """Append a plain text file to a service and mark it as imported"""
+        store = self._store(service)
+        added = 0
+        batch = []
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                batch.append(line)
+                if len(batch) >= 10000:
+                    added += store.append(batch)
+                    batch = []
+        added += store.append(batch)
+        os.replace(path, path + '.imported')
+        print(f'Imported {added} accounts into {store.name} from {path}')
+        return added
+
+    def _store(self, service, create=True):
+        name = normalize_service(service)
+        with self._lock:
+            store = self._stores.get(name)
+            if store is None:
+                if not create and name not in self._names:
+                    return None
+                store = self._stores[name] = ServiceStore(self.directory, name, fsync=self.fsync, pool=self.pool)
+                self._names.add(name)
+            return store
+
+    def services(self):
+        return sorted(self._names)
+
+    def warm(self):
+        # Open every store so counts are served from the in-memory live lists
+        for service in self.services():
+            self._store(service)
+        return self.counts()
+
+    def exists(self, service):
+        return normalize_service(service) in self._names
+
+    def create(self, service):
+        with self._lock:
+            if normalize_service(service) in self._names:
+                return False
+        self._store(service)
+        return True
+
+    def clear(self, service):
+        store = self._store(service, create=False)
+        return store.clear() if store else 0
+
+    def count(self, service):
+        store = self._store(service, create=False)
+        return store.count() if store else 0
+
+    def claim(self, service):
+        store = self._store(service, create=False)
+        return store.claim() if store else None
+
+    def claim_many(self, service, count):
+        store = self._store(service, create=False)
+        return store.claim_many(count) if store else []
+
+    def reserve(self, service, count):
+        store = self._store(service, create=False)
+        return store.reserve_many(count) if store else []
+
+    def commit(self, service, tokens):
+        store = self._store(service, create=False)
+        if store:
+            store.commit_many(tokens)
+
+    def release(self, service, tokens):
+        store = self._store(service, create=False)
+        if store:
+            store.release_many(tokens)
+
+    def add(self, service, lines):
+        return self._store(service).append(lines)
+
+    def compact(self, service, min_ratio=0.5, min_dead=10000):
+        store = self._store(service, create=False)
+        if store is None or store.dead < min_dead or store.dead_ratio() < min_ratio:
+            return None
+        return store.compact()
+
+    def iter_live(self, service):
+        store = self._store(service, create=False)
+        if store is not None:
+            yield from store.iter_live()
+
+    def peek(self, service, limit):
+        store = self._store(service, create=False)
+        return store.peek(limit) if store else []
+
+    def iter_lines(self, service):
+        store = self._store(service, create=False)
+        if store is not None:
+            yield from store.iter_data()
+
+    def export_text(self, service, path):
+        store = self._store(service, create=False)
+        if store is None:
+            return super().export_text(service, path)
+        return store.export_text(path)
+
+    def close(self):
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores.clear()
+
+
+class SqliteStockBackend(StockBackend):
+    """Backend in one SQLite WAL database, safe to share between bot processes"""
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS services (name TEXT PRIMARY KEY, live INTEGER NOT NULL DEFAULT 0)',
+        'CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, service TEXT NOT NULL, line TEXT NOT NULL, '
+        'state INTEGER NOT NULL DEFAULT 0, reserved_until REAL)',
+        'CREATE INDEX IF NOT EXISTS items_by_state ON items (service, state, id)',
+    )
+
+    def __init__(self, directory=STOCK_DIR, reservation_timeout=300.0):
+        self.directory = directory
+        self.reservation_timeout = reservation_timeout
+        os.makedirs(directory, exist_ok=True)
+        self.db = Database(os.path.join(directory, 'stock.db'))
+        with self.db.transaction() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+        self.import_legacy()
+
+    def import_legacy(self):
+        """Import plain `.txt` files and indexed stores left from other backends"""
+        imported = {}
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith('.txt'):
+                service = filename[:-4]
+                added = self.import_text(service, path)
+                if added is not None:
+                    imported[service] = added
+            elif filename.endswith('.idx') and not self.exists(filename[:-4]):
+                service = filename[:-4]
+                store = ServiceStore(self.directory, service)
+                imported[service] = self.add(service, store.peek(None))
+                store.close()
+                for ext in ('.idx', '.dat'):
+                    old = os.path.join(self.directory, service + ext)
+                    os.replace(old, old + '.imported')
+        for service, count in imported.items():
+            print(f'Imported {count} accounts into {service} from legacy stock files')
+        return imported
+
+    def import_text(self, service, path):
+        """Import a plain text file, None if another process got to it first"""
+        # Whichever process renames the file first owns the import
+        claimed_path = f'{path}.importing.{os.getpid()}'
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            return None
+        with open(claimed_path, 'r', encoding='utf-8', errors='replace') as f:
+            added = self.add(service, f)
+        os.replace(claimed_path, path + '.imported')
+        return added
+
+    def services(self):
+        return [row[0] for row in self.db.execute('SELECT name FROM services ORDER BY name')]
+
+    def exists(self, service):
+        return self.db.execute('SELECT 1 FROM services WHERE name = ?', (normalize_service(service),)).fetchone() is not None
+
+    def create(self, service):
+        with self.db.transaction() as conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO services (name) VALUES (?)', (normalize_service(service),))
+            return cursor.rowcount == 1
+
+    def clear(self, service):
+        name = normalize_service(service)
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT live FROM services WHERE name = ?', (name,)).fetchone()
+            conn.execute('DELETE FROM items WHERE service = ?', (name,))
+            conn.execute('UPDATE services SET live = 0 WHERE name = ?', (name,))
+            return row[0] if row else 0
+
+    def count(self, service):
+        row = self.db.execute('SELECT live FROM services WHERE name = ?', (normalize_service(service),)).fetchone()
+        return row[0] if row else 0
+
+    def counts(self):
+        return dict(self.db.execute('SELECT name, live FROM services ORDER BY name'))
+
+    def claim(self, service):
+        accounts = self.claim_many(service, 1)
+        return accounts[0] if accounts else None
+
+    def claim_many(self, service, count):
+        reserved = self.reserve(service, count)
+        self.commit(service, [token for token, _ in reserved])
+        return [line for _, line in reserved]
+
+    def reserve(self, service, count):
+        name = normalize_service(service)
+        now = time.time()
+        reserved = []
+        with self.db.transaction() as conn:
+            # Reservations abandoned by a crashed process go back to the pool
+            expired = conn.execute(
+                'UPDATE items SET state = 0, reserved_until = NULL WHERE service = ? AND state = 1 AND reserved_until < ?',
+                (name, now)
+            ).rowcount
+            if expired:
+                conn.execute('UPDATE services SET live = live + ? WHERE name = ?', (expired, name))
+            for _ in range(count):
+                bounds = conn.execute(
+                    'SELECT min(id), max(id) FROM items WHERE service = ? AND state = 0', (name,)
+                ).fetchone()
+                if bounds[0] is None:
+                    break
+                # Random point in the id range, then the next live row: O(log n)
+                row = conn.execute(
+                    'SELECT id, line FROM items WHERE service = ? AND state = 0 AND id >= ? ORDER BY id LIMIT 1',
+                    (name, random.randint(bounds[0], bounds[1]))
+                ).fetchone()
+                conn.execute(
+                    'UPDATE items SET state = 1, reserved_until = ? WHERE id = ?',
+                    (now + self.reservation_timeout, row[0])
+                )
+                reserved.append(row)
+            if reserved:
+                conn.execute('UPDATE services SET live = live - ? WHERE name = ?', (len(reserved), name))
+        return reserved
+
+    def commit(self, service, tokens):
+        if not tokens:
+            return
+        with self.db.transaction() as conn:
+            conn.executemany('DELETE FROM items WHERE id = ? AND state = 1', ((token,) for token in tokens))
+
+    def release(self, service, tokens):
+        if not tokens:
+            return
+        name = normalize_service(service)
+        with self.db.transaction() as conn:
+            released = 0
+            for token in tokens:
+                released += conn.execute(
+                    'UPDATE items SET state = 0, reserved_until = NULL WHERE id = ? AND state = 1', (token,)
+                ).rowcount
+            conn.execute('UPDATE services SET live = live + ? WHERE name = ?', (released, name))
+
+    def add(self, service, lines):
+        name = normalize_service(service)
+        added = 0
+        batch = []
+        for line in lines:
+            line = line.strip()
+            if line:
+                batch.append((name, line))
+            if len(batch) >= 10000:
+                added += self._insert(name, batch)
+                batch = []
+        return added + self._insert(name, batch)
+
+    def _insert(self, name, batch):
+        with self.db.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO services (name) VALUES (?)', (name,))
+            conn.executemany('INSERT INTO items (service, line) VALUES (?, ?)', batch)
+            conn.execute('UPDATE services SET live = live + ? WHERE name = ?', (len(batch), name))
+        return len(batch)
+
+    def peek(self, service, limit):
+        sql = 'SELECT line FROM items WHERE service = ? AND state = 0 ORDER BY id'
+        params = (normalize_service(service),)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params += (limit,)
+        return [row[0] for row in self.db.execute(sql, params)]
+
+    def iter_lines(self, service):
+        for (line,) in self.db.execute('SELECT line FROM items WHERE service = ? ORDER BY id', (normalize_service(service),)):
+            yield line
+
+    def close(self):
+        self.db.close()
+
+
+BACKENDS = {
+    'indexed': IndexedStockBackend,
+    'sqlite': SqliteStockBackend,
+    'text': TextStockBackend,
+}
+
+class StockRegistry:
+    """Maps a guild to its stock namespace backend, and through it to per-service handles
+
+    With per_guild off every guild shares the root directory, as before. With
+    it on each guild gets stock/guilds/<guild id>/, created on first use.
+    Indexed backends share one HandlePool, so open files across every
+    namespace stay under the descriptor budget.
+    """
+
+    def __init__(self, root=STOCK_DIR, backend='indexed', per_guild=False, fd_budget=512, fsync=False):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown STOCK_BACKEND: {backend}')
+        self.root = root
+        self.backend_name = backend
+        self.per_guild = per_guild
+        self.fsync = fsync
+        self.pool = HandlePool(fd_budget)
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def namespace(self, guild):
+        """Namespace key for a guild (or guild ID), None is the shared root"""
+        if not self.per_guild or guild is None:
+            return None
+        return getattr(guild, 'id', guild)
+
+    def directory(self, namespace):
+        if namespace is None:
+            return self.root
+        return os.path.join(self.root, 'guilds', str(namespace))
+
+    def _open(self, directory):
+        if self.backend_name == 'indexed':
+            backend = IndexedStockBackend(directory, fsync=self.fsync, pool=self.pool)
+        else:
+            backend = BACKENDS[self.backend_name](directory)
+        # Every storage call is counted and timed, see utils/metrics.py
+        return InstrumentedBackend(backend, get_metrics(), self.backend_name)
+
+    def backend(self, guild=None):
+        """Backend holding a guild's stock, opened on first use"""
+        namespace = self.namespace(guild)
+        backend = self._backends.get(namespace)
+        if backend is None:
+            with self._lock:
+                backend = self._backends.get(namespace)
+                if backend is None:
+                    backend = self._backends[namespace] = self._open(self.directory(namespace))
+        return backend
+
+    def namespaces(self):
+        """Every namespace with stock on disk or already open"""
+        found = {None}
+        guilds = os.path.join(self.root, 'guilds')
+        if self.per_guild and os.path.isdir(guilds):
+            found.update(int(name) for name in os.listdir(guilds) if name.isdigit())
+        return found | set(self._backends)
+
+    def warm(self):
+        """Load every namespace's counts, returning how many services were loaded"""
+        return sum(len(self.backend(namespace).warm()) for namespace in self.namespaces())
+
+    def close(self):
+        with self._lock:
+            for backend in self._backends.values():
+                close = getattr(backend, 'close', None)
+                if close is not None:
+                    close()
+            self._backends.clear()
+
+
+_registry = None
+
+
+def get_registry():
+    """Return the process-wide stock registry"""
+    global _registry
+    if _registry is None:
+        _registry = StockRegistry(
+            os.getenv('STOCK_DIR', STOCK_DIR),
+            backend=os.getenv('STOCK_BACKEND', 'indexed').lower(),
+            per_guild=os.getenv('STOCK_PER_GUILD', 'false').lower() == 'true',
+            fd_budget=int(os.getenv('STOCK_FD_BUDGET', '512')),
+            fsync=os.getenv('STOCK_FSYNC', 'false').lower() == 'true'
+        )
+    return _registry
+
+
+def get_backend():
+    """Return the backend of the shared root stock namespace"""
+    return get_registry().backend(None)
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.stock_store export <service> <output.txt>
+    if len(sys.argv) != 4 or sys.argv[1] != 'export':
+        print('Usage: python -m utils.stock_store export <service> <output.txt>')
+        sys.exit(1)
+    written = get_backend().export_text(sys.argv[2], sys.argv[3])
+    print(f'Exported {written} accounts to {sys.argv[3]}')
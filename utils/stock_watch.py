@@ -0,0 +1,136 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+
+# Stock directory watcher
+#
+# On Linux the kernel reports files as they are written or moved into a
+# watched directory (inotify), read from a non-blocking descriptor the event
+# loop wakes up on, so nothing is polled and nothing is rescanned: each
+# event names the one file that changed. Only `<service>.txt` files that
+# were closed after writing or renamed into place are reported, so a file
+# still being written is never picked up half-done. Elsewhere the watcher
+# falls back to checking the directory mtime and listing it only when it
+# changed.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII')
+
+
+class StockWatcher:
+    """Calls `callback(directory, service, path)` for `.txt` files dropped into watched directories"""
+
+    def __init__(self, callback, fallback_interval=10.0):
+        self.callback = callback
+        self.fallback_interval = fallback_interval
+        self._directories = {}
+        self._fd = None
+        self._libc = None
+        self._task = None
+        self._seen = {}
+
+    def _inotify(self):
+        if not sys.platform.startswith('linux'):
+            return None
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        self._libc = libc
+        return fd
+
+    def start(self, directories):
+        """Start watching, returns False when falling back to mtime checks"""
+        loop = asyncio.get_running_loop()
+        try:
+            self._fd = self._inotify()
+        except OSError:
+            self._fd = None
+        if self._fd is None:
+            for directory in directories:
+                self._seen[directory] = self._listing(directory)
+            self._task = loop.create_task(self._fallback())
+            return False
+        for directory in directories:
+            self.watch(directory)
+        loop.add_reader(self._fd, self._read)
+        return True
+
+    def watch(self, directory):
+        """Add a directory, e.g. a guild namespace created after startup"""
+        if self._fd is None:
+            self._seen.setdefault(directory, self._listing(directory))
+            return
+        if directory in self._directories.values():
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            print(f'Cannot watch {directory}: {os.strerror(ctypes.get_errno())}')
+            return
+        self._directories[wd] = directory
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        position = 0
+        while position + EVENT.size <= len(data):
+            wd, _, _, length = EVENT.unpack_from(data, position)
+            name = data[position + EVENT.size:position + EVENT.size + length].rstrip(b'\0')
+            position += EVENT.size + length
+            directory = self._directories.get(wd)
+            if directory is not None:
+                self._dispatch(directory, os.fsdecode(name))
+
+    def _dispatch(self, directory, filename):
+        if filename.endswith('.txt') and not filename.startswith('.'):
+            self.callback(directory, filename[:-4], os.path.join(directory, filename))
+
+    def _listing(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            files = {
+                entry.name: entry.stat().st_mtime_ns
+                for entry in os.scandir(directory) if entry.name.endswith('.txt')
+            }
+        except FileNotFoundError:
+            return None, {}
+        return mtime, files
+
+    async def _fallback(self):
+        while True:
+            await asyncio.sleep(self.fallback_interval)
+            for directory, (mtime, files) in list(self._seen.items()):
+                try:
+                    current = os.stat(directory).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                # Appending to an existing file leaves the directory mtime alone,
+                # so only new and renamed files are seen here
+                if current == mtime:
+                    continue
+                listing = self._listing(directory)
+                self._seen[directory] = listing
+                for name, stamp in listing[1].items():
+                    if files.get(name) != stamp:
+                        self._dispatch(directory, name)
+
+    def stop(self):
+        if self._fd is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._fd)
+            except RuntimeError:
+                pass
+            os.close(self._fd)
+            self._fd = None
+            self._directories = {}
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
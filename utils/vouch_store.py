@@ -0,0 +1,445 @@
+import asyncio
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+from utils.db import Database
+from utils.metrics import get_metrics
+
+# Write-behind persistence for vouch counts
+#
+# Every change is appended to a small journal as the user's new absolute
+# count, so replaying it is idempotent. The full snapshot is rewritten at
+# most once per flush interval, compactly and through a temp file plus
+# rename, so a crash mid-write can never leave a half-written vouches.json.
+#
+# Durability modes (VOUCH_DURABILITY):
+#   snapshot - no journal, changes since the last flush can be lost
+#   journal  - journal line written and flushed to the OS per change
+#   fsync    - journal line fsynced per change, survives power loss
+#
+# CompactVouchStore keeps the same journal but snapshots to a binary file
+# that is memory-mapped at startup instead of parsed:
+#   header - magic and user count (VOUCH_HEADER)
+#   IDs    - user IDs, sorted, uint64 each
+#   counts - vouch counts in ID order, uint32 each
+
+VOUCH_FILE = 'data/vouches.json'
+DURABILITY_MODES = ('snapshot', 'journal', 'fsync')
+VOUCH_HEADER = struct.Struct('<8sQ')
+VOUCH_MAGIC = b'VOUCHES1'
+
+
+def atomic_write(path, data):
+    """Write bytes to path via a synced temp file and an atomic rename"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    get_metrics().inc('storage_bytes_written_total', len(data), store=os.path.basename(path))
+
+
+class VouchStore:
+    """Vouch counts keyed by user ID with debounced, crash-safe saves"""
+
+    # get/add only touch memory, callers may use them on the event loop
+    blocking = False
+
+    def __init__(self, path=VOUCH_FILE, flush_interval=1.0, durability='journal'):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown vouch durability mode: {durability}')
+        self.path = path
+        self.journal_path = f'{path}.journal'
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.data = {}
+        self.dirty = False
+        self._journal = None
+        self._flush_handle = None
+        self._flush_task = None
+
+    def load(self):
+        """Load the last snapshot and replay any journals written after it"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        replayed = 0
+        for path in (f'{self.journal_path}.old', self.journal_path):
+            if os.path.exists(path):
+                replayed += self._replay(path)
+        if replayed:
+            print(f'Replayed {replayed} vouch journal entries')
+            self.dirty = True
+            self._write_snapshot(self._rotate_journal())
+        return self
+
+    def _replay(self, path):
+        replayed = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    user_id, count = json.loads(line)
+                except ValueError:
+                    # Torn final line from a crash mid-append
+                    break
+                self._apply(user_id, count)
+                replayed += 1
+        return replayed
+
+    def _apply(self, user_id, count):
+        self.data[user_id] = count
+
+    def get(self, user_id):
+        return self.data.get(str(user_id), 0)
+
+    def add(self, user_id, amount=1):
+        """Adjust a user's count (never below zero) and return the new value"""
+        user_id = str(user_id)
+        count = max(0, self.data.get(user_id, 0) + amount)
+        self.data[user_id] = count
+        self._record(user_id, count)
+        return count
+
+    def items(self):
+        """(user_id, count) for every user with a recorded count"""
+        return ((int(user_id), count) for user_id, count in self.data.items())
+
+    def snapshot_source(self):
+        """Copy the counts on the event loop, returning a callable that builds the JSON payload off it"""
+        data = dict(self.data)
+        return lambda: data
+
+    def items_source(self):
+        """Copy the counts on the event loop, returning a callable that iterates them off it"""
+        data = dict(self.data)
+        return lambda: ((int(user_id), count) for user_id, count in data.items())
+
+    def __contains__(self, user_id):
+        return str(user_id) in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def _record(self, user_id, count):
+        if self.durability != 'snapshot':
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            entry = json.dumps([user_id, count]) + '\n'
+            self._journal.write(entry)
+            get_metrics().inc('storage_bytes_written_total', len(entry), store='vouch_journal')
+            self._journal.flush()
+            if self.durability == 'fsync':
+                os.fsync(self._journal.fileno())
+        self.dirty = True
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None or self._flush_task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, migrations), save right away
+            self.flush_now()
+            return
+        self._flush_handle = loop.call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _rotate_journal(self):
+        """Move the live journal aside so changes made during a flush are kept"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        old_path = f'{self.journal_path}.old'
+        if os.path.exists(self.journal_path):
+            if os.path.exists(old_path):
+                # A previous snapshot never landed, keep both journals' entries
+                with open(self.journal_path, 'rb') as src, open(old_path, 'ab') as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, old_path)
+        self.dirty = False
+        return self._capture()
+
+    def _capture(self):
+        """What the next snapshot writes, taken on the event loop"""
+        return dict(self.data)
+
+    def _snapshot_written(self):
+        """Called on the event loop once a snapshot has landed"""
+
+    def _write_snapshot(self, snapshot):
+        atomic_write(self.path, json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+        # Everything in the old journal is now part of the snapshot
+        if os.path.exists(f'{self.journal_path}.old'):
+            os.remove(f'{self.journal_path}.old')
+
+    async def flush(self):
+        """Write a snapshot off the event loop if anything changed"""
+        try:
+            if self.dirty:
+                await asyncio.to_thread(self._write_snapshot, self._rotate_journal())
+                self._snapshot_written()
+        except OSError as e:
+            print(f'Failed to save vouches: {e}')
+            self.dirty = True
+        finally:
+            self._flush_task = None
+        # Changes that arrived while writing get their own debounced flush
+        if self.dirty:
+            self._schedule_flush()
+
+    def flush_now(self):
+        """Synchronously write a snapshot if anything changed"""
+        if self.dirty:
+            self._write_snapshot(self._rotate_journal())
+            self._snapshot_written()
+
+    async def close(self):
+        """Cancel the pending debounce and write a final snapshot"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        self.flush_now()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+def write_vouch_file(path, ids, counts, extra):
+    """Write sorted IDs and their counts, splicing in the `extra` {user_id: count} users"""
+    extra_ids = sorted(extra)
+    positions = [bisect_left(ids, user_id) for user_id in extra_ids]
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(VOUCH_HEADER.pack(VOUCH_MAGIC, len(ids) + len(extra_ids)))
+        # Runs of the existing arrays are written straight from their buffers
+        for values, new_values, typecode in ((ids, extra_ids, 'Q'), (counts, [extra[u] for u in extra_ids], 'I')):
+            start = 0
+            for position, value in zip(positions, new_values):
+                f.write(values[start:position])
+                f.write(array(typecode, (value,)))
+                start = position
+            f.write(values[start:])
+        written = f.tell()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    get_metrics().inc('storage_bytes_written_total', written, store=os.path.basename(path))
+
+
+class CompactVouchStore(VouchStore):
+    """Vouch counts as a memory-mapped sorted ID array with a parallel counts array
+
+    Loading maps the file instead of parsing it, and a user costs 12 bytes
+    instead of a str key and an int in a dict. Counts of known users are
+    updated in place in a private copy-on-write mapping. New users wait in a
+    small dict until the next snapshot splices them into the arrays.
+    """
+
+    def __init__(self, path=VOUCH_FILE, flush_interval=1.0, durability='journal'):
+        super().__init__(path, flush_interval, durability)
+        self.binary_path = os.path.splitext(path)[0] + '.bin'
+        self.journal_path = f'{self.binary_path}.journal'
+        self._map = None
+        self._view = None
+        self._ids = array('Q')
+        self._counts = array('I')
+        self._extra = {}
+        self._changed = {}
+
+    def load(self):
+        """Map the binary snapshot, migrating vouches.json the first time, then replay journals"""
+        os.makedirs(os.path.dirname(self.binary_path) or '.', exist_ok=True)
+        if not os.path.exists(self.binary_path):
+            legacy = VouchStore(self.path).load().data if os.path.exists(self.path) else {}
+            keys = sorted(legacy, key=int)
+            write_vouch_file(self.binary_path, array('Q', map(int, keys)), array('I', map(legacy.__getitem__, keys)), {})
+            if keys:
+                print(f'Migrated {len(keys)} vouch counts into {self.binary_path}')
+        self._map_file()
+        replayed = 0
+        for path in (f'{self.journal_path}.old', self.journal_path):
+            if os.path.exists(path):
+                replayed += self._replay(path)
+        if replayed:
+            print(f'Replayed {replayed} vouch journal entries')
+            self.dirty = True
+            self.flush_now()
+        return self
+
+    def _map_file(self):
+        with open(self.binary_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, users = VOUCH_HEADER.unpack_from(mapped)
+        if magic != VOUCH_MAGIC or len(mapped) != VOUCH_HEADER.size + users * 12:
+            mapped.close()
+            raise ValueError(f'{self.binary_path} is not a vouch file or is truncated')
+        self._unmap()
+        self._map = mapped
+        self._view = memoryview(mapped)
+        ids_end = VOUCH_HEADER.size + users * 8
+        self._ids = self._view[VOUCH_HEADER.size:ids_end].cast('Q')
+        self._counts = self._view[ids_end:].cast('I')
+
+    def _unmap(self):
+        if self._map is None:
+            return
+        self._ids.release()
+        self._counts.release()
+        self._view.release()
+        self._map.close()
+        self._map = None
+
+    def _find(self, user_id):
+        i = bisect_left(self._ids, user_id)
+        return i if i < len(self._ids) and self._ids[i] == user_id else -1
+
+    def get(self, user_id):
+        user_id = int(user_id)
+        i = self._find(user_id)
+        return self._counts[i] if i >= 0 else self._extra.get(user_id, 0)
+
+    def _apply(self, user_id, count):
+        user_id = int(user_id)
+        i = self._find(user_id)
+        if i >= 0:
+            self._counts[i] = count
+        else:
+            self._extra[user_id] = count
+
+    def add(self, user_id, amount=1):
+        """Adjust a user's count (never below zero) and return the new value"""
+        user_id = int(user_id)
+        count = max(0, self.get(user_id) + amount)
+        self._apply(user_id, count)
+        self._changed[user_id] = count
+        self._record(str(user_id), count)
+        return count
+
+    def items(self):
+        yield from zip(self._ids, self._counts)
+        yield from self._extra.items()
+
+    def _copy(self):
+        # A memcpy of the mapped arrays, a snapshot may remap them under a reader thread
+        ids = array('Q')
+        ids.frombytes(memoryview(self._ids).cast('B'))
+        counts = array('I')
+        counts.frombytes(memoryview(self._counts).cast('B'))
+        return ids, counts, dict(self._extra)
+
+    def snapshot_source(self):
+        """Copy the arrays on the event loop (a memcpy), the payload dict is built off it"""
+        ids, counts, extra = self._copy()
+        return lambda: {**{str(user_id): count for user_id, count in zip(ids, counts)},
+                        **{str(user_id): count for user_id, count in extra.items()}}
+
+    def items_source(self):
+        """Copy the arrays on the event loop (a memcpy), they are iterated off it"""
+        ids, counts, extra = self._copy()
+        return lambda: chain(zip(ids, counts), extra.items())
+
+    def __contains__(self, user_id):
+        user_id = int(user_id)
+        return self._find(user_id) >= 0 or user_id in self._extra
+
+    def __len__(self):
+        return len(self._ids) + len(self._extra)
+
+    def _capture(self):
+        # The writer reads the mapped arrays directly, a count changed while it
+        # runs is written either way and re-applied from _changed afterwards
+        self._changed = {}
+        return self._ids, self._counts, dict(self._extra)
+
+    def _write_snapshot(self, snapshot):
+        write_vouch_file(self.binary_path, *snapshot)
+        if os.path.exists(f'{self.journal_path}.old'):
+            os.remove(f'{self.journal_path}.old')
+
+    def _snapshot_written(self):
+        # Switch to the merged file, then replay what changed since the capture
+        self._map_file()
+        self._extra = {}
+        for user_id, count in self._changed.items():
+            self._apply(user_id, count)
+
+    async def close(self):
+        await super().close()
+        self._unmap()
+
+
+class SqliteVouchStore:
+    """Vouch counts in a shared SQLite WAL database for multi-process deployments"""
+
+    # Every call is a query that can wait on another process's write lock
+    blocking = True
+
+    def __init__(self, path=VOUCH_FILE):
+        self.path = path
+        self.db_path = os.path.splitext(path)[0] + '.db'
+        self.db = None
+
+    def load(self):
+        """Open the database, migrating vouches.json the first time"""
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        self.db = Database(self.db_path)
+        with self.db.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS vouches (user_id TEXT PRIMARY KEY, count INTEGER NOT NULL)')
+            empty = conn.execute('SELECT 1 FROM vouches LIMIT 1').fetchone() is None
+            if empty and os.path.exists(self.path):
+                legacy = VouchStore(self.path).load()
+                conn.executemany('INSERT INTO vouches (user_id, count) VALUES (?, ?)', legacy.data.items())
+                print(f'Migrated {len(legacy.data)} vouch counts into {self.db_path}')
+        return self
+
+    def get(self, user_id):
+        row = self.db.execute('SELECT count FROM vouches WHERE user_id = ?', (str(user_id),)).fetchone()
+        return row[0] if row else 0
+
+    def add(self, user_id, amount=1):
+        """Atomically adjust a user's count (never below zero) and return the new value"""
+        user_id = str(user_id)
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT INTO vouches (user_id, count) VALUES (?, max(0, ?)) '
+                'ON CONFLICT (user_id) DO UPDATE SET count = max(0, count + ?)',
+                (user_id, amount, amount)
+            )
+            return conn.execute('SELECT count FROM vouches WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    def items(self):
+        return ((int(user_id), count) for user_id, count in self.db.execute('SELECT user_id, count FROM vouches'))
+
+    def snapshot_source(self):
+        """Nothing to copy, the snapshot thread reads the database through its own connection"""
+        return lambda: {str(user_id): count for user_id, count in self.items()}
+
+    def items_source(self):
+        """Nothing to copy, the reading thread queries the database through its own connection"""
+        return self.items
+
+    def __contains__(self, user_id):
+        return self.db.execute('SELECT 1 FROM vouches WHERE user_id = ?', (str(user_id),)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM vouches').fetchone()[0]
+
+    async def close(self):
+        # Every change is already committed
+        if self.db is not None:
+            self.db.close()